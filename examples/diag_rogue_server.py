@@ -29,7 +29,7 @@ import pysap
 from pysap.SAPDiagItems import *
 from pysap.SAPDiag import SAPDiag, SAPDiagDP
 from pysap.SAPNI import (SAPNI, SAPNIClient, SAPNIServerHandler,
-                         SAPNIServerThreaded)
+                         SAPNIServerThreaded, SAPNIServerPreforked)
 
 
 # Bind the SAPDiag layer
@@ -228,6 +228,10 @@ class SAPDiagThreadedServer(SAPNIServerThreaded):
     clients_cls = SAPDiagClient
 
 
+class SAPDiagPreforkedServer(SAPNIServerPreforked):
+    clients_cls = SAPDiagClient
+
+
 # Command line options parser
 def parse_options():
 
@@ -254,6 +258,8 @@ def parse_options():
                         help="Hostname [%(default)s]")
     server.add_argument("--session-title", dest="server_session_title", default="SAP Netweaver Demo Server",
                         help="Session Title [%(default)s]")
+    server.add_argument("--workers", dest="workers", type=int,
+                        help="Number of worker processes to serve clients [single process]")
 
     misc = parser.add_argument_group("Misc options")
     misc.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose output")
@@ -271,9 +277,16 @@ def main():
         logging.basicConfig(level=logging.DEBUG)
 
     print("[*] Setting up the Diag server on %s:%d" % (options.local_host, options.local_port))
-    server = SAPDiagThreadedServer((options.local_host, options.local_port),
-                                   SAPDiagServerHandler,
-                                   base_cls=SAPDiag)
+    if options.workers:
+        print("[*] Using %d worker processes" % options.workers)
+        server = SAPDiagPreforkedServer((options.local_host, options.local_port),
+                                        SAPDiagServerHandler,
+                                        base_cls=SAPDiag,
+                                        workers=options.workers)
+    else:
+        server = SAPDiagThreadedServer((options.local_host, options.local_port),
+                                       SAPDiagServerHandler,
+                                       base_cls=SAPDiag)
     server.allow_reuse_address = True
     server.options = options
     print("[*] Waiting for clients ...")
@@ -29,7 +29,7 @@ import pysap
 from pysap.SAPNI import SAPNI, SAPNIStreamSocket
 from pysap.utils.fields import saptimestamp_to_datetime
 from pysap.SAPRouter import (SAPRouter, router_is_error, get_router_version,
-                             SAPRouterInfoClients, SAPRouterInfoServer)
+                             router_info_clients, SAPRouterInfoServer)
 # Optional imports
 try:
     from tabulate import tabulate
@@ -237,18 +237,16 @@ def main():
 
             if options.info:
                 # Decode the first packet as a list of info client
-                raw_response.decode_payload_as(SAPRouterInfoClients)
-
                 clients = [["ID", "Client", "Partner", "Service", "Connected on"]]
-                for client in raw_response.clients:
+                for client in router_info_clients(bytes(raw_response.payload)):
 
                     # If the trace flag is set, add a mark
-                    flag = "(*)" if client.flag_traced else "(+)" if client.flag_routed else ""
+                    flag = "(*)" if client.traced else "(+)" if client.routed else ""
 
                     fields = [str(client.id),
                               client.address,
-                              "%s%s" % (flag, client.partner) if client.flag_routed else "(no partner)",
-                              client.service if client.flag_routed else "",
+                              "%s%s" % (flag, client.partner) if client.routed else "(no partner)",
+                              client.service if client.routed else "",
                               saptimestamp_to_datetime(client.connected_on).ctime()]
                     clients.append(fields)
 
@@ -27,7 +27,8 @@ from scapy.packet import bind_layers, Raw
 # Custom imports
 import pysap
 from pysap.SAPNI import SAPNIStreamSocket, SAPNI
-from pysap.SAPRouter import SAPRouter, SAPRouterRouteHop
+from pysap.SAPRouter import (SAPRouter, SAPRouterRouteHop, SAPRouterFingerprintDB,
+                             router_fingerprint_fields)
 
 
 # Bind the SAPRouter layer
@@ -77,11 +78,6 @@ def parse_options():
     return options
 
 
-# This is the list of fields we want to track when checking for fingerprints
-fingerprint_fields = ["error", "return_code", "component", "release", "version", "module", "line", "errorno",
-                      "errorno_text", "system_call"]
-
-
 # The fields used to identify a version being fingerprinted
 version_info_fields = ["version", "release", "patch_number", "source_id", "update_level", "file_version", "platform",
                        "submitted_by", "comment"]
@@ -164,58 +160,6 @@ fingerprint_targets = {
 }
 
 
-class FingerprintDB(object):
-
-    def __init__(self, fingerprints_file):
-        self.fingerprints_db = {}
-        self.fingerprints_file = fingerprints_file
-        self.load_fingerprints(fingerprints_file)
-
-    def load_fingerprints(self, fingerprints_file):
-        with open(fingerprints_file, 'r') as f:
-            fingerprints = json.load(f)
-
-        for target in fingerprint_targets:
-            if target in fingerprints:
-                self.fingerprints_db[target] = fingerprints[target]
-
-    def add_fingerprint(self, new_fingerprint, version_info):
-        with open(new_fingerprint, 'r') as f:
-            new_fingerprint = json.load(f)
-        if version_info:
-            version_info = json.loads(version_info)
-        else:
-            version_info = {}
-
-        for target in fingerprint_targets:
-            if target in new_fingerprint:
-                if target not in self.fingerprints_db:
-                    self.fingerprints_db[target] = []
-                for entry in new_fingerprint[target]:
-                    entry.update(version_info)
-                    if entry not in self.fingerprints_db[target]:
-                        logging.info("[*]\tAdded a new entry for the target %s" % target)
-                        self.fingerprints_db[target].append(entry)
-
-        with open(self.fingerprints_file, 'w') as f:
-            json.dump(self.fingerprints_db, f, sort_keys=True, indent=4, separators=(',', ': '))
-
-    def match_fingerprint(self, target, error_text):
-        matches = []
-        if target in self.fingerprints_db:
-            for finger in self.fingerprints_db[target]:
-                match = True
-                for key, value in list(finger.items()):
-                    if key in fingerprint_fields and hasattr(error_text, key) and getattr(error_text, key) != value:
-                        match = False
-                        logging.debug("[ ]\tUnmatched field: \"%s\" Value: \"%s\" vs \"%s\"" % (key, value,
-                                                                                                getattr(error_text,
-                                                                                                        key)))
-                if match:
-                    matches.append(finger)
-        return matches
-
-
 # Main function
 def main():
     options = parse_options()
@@ -226,7 +170,7 @@ def main():
     logging.basicConfig(level=level, format='%(message)s')
 
     logging.info("[*] Loading fingerprint database")
-    fingerprint_db = FingerprintDB(options.fingerprints)
+    fingerprint_db = SAPRouterFingerprintDB.from_json(options.fingerprints, targets=list(fingerprint_targets))
 
     # Check if we were asked to add a new fingerprint
     if options.add_fingerprint:
@@ -234,7 +178,16 @@ def main():
             logging.info("[-] You must provide version info to add new entries to the fingerprint database !")
             return
         logging.info("[*] Adding a new entry to the fingerprint database")
-        fingerprint_db.add_fingerprint(options.new_fingerprint_file, options.version_info)
+        with open(options.new_fingerprint_file, 'r') as f:
+            new_fingerprint = json.load(f)
+        version_info = json.loads(options.version_info)
+
+        for target in fingerprint_targets:
+            for entry in new_fingerprint.get(target, []):
+                entry.update(version_info)
+                if fingerprint_db.add(target, entry):
+                    logging.info("[*]\tAdded a new entry for the target %s" % target)
+        fingerprint_db.save(options.fingerprints)
         return
 
     misses = []
@@ -257,7 +210,7 @@ def main():
         else:
             error_text = conn.sr(packet).err_text_value
 
-        matched = fingerprint_db.match_fingerprint(target, error_text)
+        matched = fingerprint_db.match(target, error_text)
 
         if matched:
             logging.info("[*] (%d/%d) Fingerprint for packet '%s' matched !" % (i, l, target))
@@ -306,7 +259,7 @@ def main():
         new_fingerprint = {}
         for (target, error_text) in misses:
             new_fingerprint[target] = [{}]
-            for field in fingerprint_fields:
+            for field in router_fingerprint_fields:
                 new_fingerprint[target][0][field] = getattr(error_text, field)
         # Expand with matched targets also
         for (target, fingerprint) in matches:
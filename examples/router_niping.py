@@ -18,8 +18,13 @@
 #
 
 # Standard imports
+import sys
+import json
 import logging
+from math import ceil
+from time import perf_counter
 from datetime import datetime
+from threading import Thread
 from argparse import ArgumentParser
 from socket import socket, SHUT_RDWR, error as SocketError
 # External imports
@@ -28,7 +33,7 @@ from scapy.config import conf
 # Custom imports
 import pysap
 from pysap.SAPNI import SAPNIStreamSocket
-from pysap.SAPRouter import SAPRoutedStreamSocket
+from pysap.SAPRouter import SAPRoutedStreamSocket, SAPRouteException, SAPRouteVersionException
 
 
 # Set the verbosity to 0
@@ -59,11 +64,21 @@ def parse_options():
 
     misc = parser.add_argument_group("Misc options")
     misc.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose output")
-    misc.add_argument("-B", "--buffer-size", dest="buffer_size", type=int, default=1000,
-                      help="Size of data-buffer [%(default)d]")
+    misc.add_argument("-B", "--buffer-size", dest="buffer_sizes", type=parse_sizes, default=[1000],
+                      help="Size of data-buffer, or comma-separated list of sizes to benchmark [1000]")
     misc.add_argument("-L", "--loops", dest="loops", type=int, default=10,
                       help="Number of loops [%(default)d]")
 
+    benchmark = parser.add_argument_group("Benchmark options")
+    benchmark.add_argument("-P", "--parallel", dest="parallel", type=int, default=1,
+                           help="Number of parallel streams [%(default)d]")
+    benchmark.add_argument("--warmup", dest="warmup", type=int, default=0,
+                           help="Number of loops on each stream not included in the results [%(default)d]")
+    benchmark.add_argument("--compare-direct", dest="compare_direct", action="store_true",
+                           help="When using a route string, also benchmark the direct path to the host")
+    benchmark.add_argument("--json", dest="json", metavar="FILE",
+                           help="Write the results in json format to a file, or to stdout if '-'")
+
     options = parser.parse_args()
 
     if not options.server and not options.client:
@@ -72,80 +87,246 @@ def parse_options():
     if options.client and not (options.host or options.route_string):
         parser.error("Remote host is required for starting a client")
 
+    if options.compare_direct and not (options.host and options.route_string):
+        parser.error("Remote host and route string are required for comparing with the direct path")
+
+    if options.parallel < 1:
+        parser.error("Number of parallel streams must be at least 1")
+
     return options
 
 
-def client_mode(options):
-    """"Implements the niping client running mode
+def parse_sizes(value):
+    """Parses a comma-separated list of buffer sizes
+
+    :param value: list of buffer sizes
+    :type value: C{string}
+
+    :return: buffer sizes
+    :rtype: ``list`` of ``int``
+    """
+    return [int(size) for size in value.split(",")]
+
+
+def percentile(times, percentile):
+    """Returns the value at the given percentile of a sorted list of times,
+    using the nearest-rank method
+
+    :param times: sorted list of times
+    :type times: ``list`` of ``float``
+
+    :param percentile: percentile between 0 and 100
+    :type percentile: ``float``
+
+    :rtype: ``float``
+    """
+    index = max(0, int(ceil(percentile * len(times) / 100.0)) - 1)
+    return times[min(index, len(times) - 1)]
+
+
+def run_stream(options, route_string, buffer_size, result):
+    """Runs the loops of a single benchmark stream over its own connection
 
     :param options: option set from the command line
     :type options: Values
-    """
 
-    times = []
-    p = Raw("EYECATCHER" + "\x00" * (options.buffer_size - 10))
+    :param route_string: route string to use, None for the direct path
+    :type route_string: C{string}
+
+    :param buffer_size: size of the data-buffer
+    :type buffer_size: ``int``
+
+    :param result: dictionary where to store the times and errors
+    :type result: ``dict``
+    """
+    p = Raw(b"EYECATCHER" + b"\x00" * (buffer_size - 10))
+    expected = bytes(p)
 
     try:
-        # Establish the connection
         conn = SAPRoutedStreamSocket.get_nisocket(options.host,
                                                   options.port,
-                                                  options.route_string)
-        logging.info("")
-        logging.info(datetime.today().ctime())
-        logging.info("connect to server o.k.")
+                                                  route_string)
+        try:
+            for i in range(options.warmup + options.loops):
 
-        # Send the messages
-        for i in range(options.loops):
+                # Send the packet and grab the response
+                start_time = perf_counter()
+                r = conn.sr(p)
+                end_time = perf_counter()
 
-            # Send the packet and grab the response
-            start_time = datetime.now()
-            r = conn.sr(p)
-            end_time = datetime.now()
+                # Check the response
+                if bytes(r.payload) != expected:
+                    result["errors"] += 1
+                    logging.debug("[-] Response on message {} differs".format(i))
 
-            # Check the response
-            if str(r.payload) != str(p):
-                logging.info("[-] Response on message {} differs".format(i))
+                # Record the elapsed time once the warmup loops are done
+                if i == options.warmup:
+                    result["start_time"] = start_time
+                if i >= options.warmup:
+                    result["times"].append(end_time - start_time)
+                    result["end_time"] = end_time
 
-            # Calculate and record the elapsed time
-            times.append(end_time - start_time)
+            # Close the connection properly
+            conn.send(Raw())
+        finally:
+            conn.close()
 
-        # Close the connection properly
-        conn.send(Raw())
-        conn.close()
+    except (SocketError, SAPRouteException, SAPRouteVersionException) as e:
+        result["error"] = str(e)
 
-    except SocketError:
-        logging.error("[*] Connection error")
+
+def benchmark(options, path, route_string, buffer_size):
+    """Benchmarks a path with the given buffer size, running the configured
+    number of parallel streams.
+
+    :param options: option set from the command line
+    :type options: Values
+
+    :param path: name of the path being benchmarked
+    :type path: C{string}
+
+    :param route_string: route string to use, None for the direct path
+    :type route_string: C{string}
+
+    :param buffer_size: size of the data-buffer
+    :type buffer_size: ``int``
+
+    :return: benchmark results
+    :rtype: ``dict``
+    """
+    results = [{"times": [], "errors": 0, "error": None} for _ in range(options.parallel)]
+    streams = [Thread(target=run_stream, args=(options, route_string, buffer_size, result))
+               for result in results]
+
+    start_time = perf_counter()
+    for stream in streams:
+        stream.start()
+    for stream in streams:
+        stream.join()
+    elapsed = perf_counter() - start_time
+
+    times = sorted(time * 1000 for result in results for time in result["times"])
+    summary = {"path": path,
+               "buffer_size": buffer_size,
+               "parallel": options.parallel,
+               "loops": options.loops,
+               "messages": len(times),
+               "errors": sum(result["errors"] for result in results),
+               "connection_errors": [result["error"] for result in results if result["error"]],
+               "elapsed_s": elapsed}
+    if times:
+        # Payload sent over the measured loops of all the streams, as in niping
+        duration = (max(result["end_time"] for result in results if result["times"]) -
+                    min(result["start_time"] for result in results if result["times"]))
+        summary.update({"throughput_mb_s": float(buffer_size * len(times)) / duration / 1e6,
+                        "avg_ms": sum(times) / len(times),
+                        "min_ms": times[0],
+                        "p50_ms": percentile(times, 50),
+                        "p90_ms": percentile(times, 90),
+                        "p99_ms": percentile(times, 99),
+                        "max_ms": times[-1]})
+    return summary
+
+
+def print_summary(summary):
+    """Prints the results of a benchmark in niping format
+
+    :param summary: benchmark results
+    :type summary: ``dict``
+    """
+    logging.info("")
+    logging.info(datetime.today().ctime())
+    logging.info("send and receive {} messages (len {}, {} streams, {} path)".format(summary["messages"],
+                                                                                   summary["buffer_size"],
+                                                                                   summary["parallel"],
+                                                                                   summary["path"]))
+    for error in summary["connection_errors"]:
+        logging.error("[*] Connection error: {}".format(error))
+    if summary["errors"]:
+        logging.info("[-] {} responses differ".format(summary["errors"]))
+    if not summary["messages"]:
+        return
+
+    logging.info("")
+    logging.info("------- times -----")
+    logging.info("avg  {:8.3f} ms".format(summary["avg_ms"]))
+    logging.info("max  {:8.3f} ms".format(summary["max_ms"]))
+    logging.info("min  {:8.3f} ms".format(summary["min_ms"]))
+    logging.info("p50  {:8.3f} ms".format(summary["p50_ms"]))
+    logging.info("p90  {:8.3f} ms".format(summary["p90_ms"]))
+    logging.info("p99  {:8.3f} ms".format(summary["p99_ms"]))
+    logging.info("tr   {:8.3f} MB/s".format(summary["throughput_mb_s"]))
+    logging.info("")
+
+
+def client_mode(options):
+    """"Implements the niping client running mode, benchmarking each of the
+    buffer sizes over the direct and/or routed paths
+
+    :param options: option set from the command line
+    :type options: Values
+    """
+    paths = []
+    if options.route_string:
+        paths.append(("routed", options.route_string))
+    if not options.route_string or options.compare_direct:
+        paths.append(("direct", None))
+
+    logging.info("")
+    logging.info(datetime.today().ctime())
+    logging.info("starting benchmark with {} streams ...".format(options.parallel))
+
+    summaries = []
+    try:
+        for buffer_size in options.buffer_sizes:
+            for path, route_string in paths:
+                summary = benchmark(options, path, route_string, buffer_size)
+                print_summary(summary)
+                summaries.append(summary)
     except KeyboardInterrupt:
         logging.error("[*] Cancelled by the user")
 
-    if times:
-        logging.info("")
-        logging.info(datetime.today().ctime())
-        logging.info("send and receive {} messages (len {})".format(len(times), options.buffer_size))
+    if options.json:
+        output = {"host": options.host,
+                  "port": options.port,
+                  "route_string": options.route_string,
+                  "results": summaries}
+        if options.json == "-":
+            json.dump(output, sys.stdout, indent=4)
+            sys.stdout.write("\n")
+        else:
+            with open(options.json, "w") as f:
+                json.dump(output, f, indent=4)
 
-        # Calculate the stats
-        times = [x.total_seconds() * 1000 for x in times]
-        times_min = min(times)
-        times_max = max(times)
-        times_avg = float(sum(times)) / max(len(times), 1)
-        times_tr = float(options.buffer_size * len(times)) / float(sum(times))
 
-        times2 = [x for x in times if x not in [times_min, times_max]]
-        times2_avg = float(sum(times2)) / max(len(times2), 1)
-        times2_tr = float(options.buffer_size * len(times2)) / float(sum(times2))
+def handle_client(sc, sockname):
+    """Echoes the packets received from a niping client
 
-        # Print the stats
-        logging.info("")
-        logging.info("------- times -----")
-        logging.info("avg  {:8.3f} ms".format(times_avg))
-        logging.info("max  {:8.3f} ms".format(times_max))
-        logging.info("min  {:8.3f} ms".format(times_min))
-        logging.info("tr   {:8.3f} kB/s".format(times_tr))
-
-        logging.info("excluding max and min:")
-        logging.info("av2  {:8.3f} ms".format(times2_avg))
-        logging.info("tr2  {:8.3f} kB/s".format(times2_tr))
+    :param sc: client socket
+    :type sc: socket
+
+    :param sockname: address of the client
+    :type sockname: ``tuple``
+    """
+    client = SAPNIStreamSocket(sc)
+
+    logging.info("")
+    logging.info(datetime.today().ctime())
+    logging.info("connect from host '{}', client hdl {} o.k.".format(sockname[0], client.fileno()))
+
+    try:
+        while True:
+            r = client.recv()
+            client.send(r.payload)
+
+    except SocketError:
+        pass
+
+    finally:
         logging.info("")
+        logging.info(datetime.today().ctime())
+        logging.info("client hdl {} disconnected ...".format(client.fileno()))
+        client.close()
 
 
 def server_mode(options):
@@ -161,31 +342,17 @@ def server_mode(options):
     sock = socket()
     try:
         sock.bind((options.host, options.port))
-        sock.listen(0)
+        sock.listen(5)
         logging.info("")
         logging.info(datetime.today().ctime())
         logging.info("ready for connect from client ...")
 
         while True:
             sc, sockname = sock.accept()
-            client = SAPNIStreamSocket(sc)
-
-            logging.info("")
-            logging.info(datetime.today().ctime())
-            logging.info("connect from host '{}', client hdl {} o.k.".format(sockname[0], client.fileno()))
-
-            try:
-                while True:
-                    r = client.recv()
-                    client.send(r.payload)
-
-            except SocketError:
-                pass
-
-            finally:
-                logging.info("")
-                logging.info(datetime.today().ctime())
-                logging.info("client hdl {} disconnected ...".format(client.fileno()))
+            # Serve each client on its own thread to allow parallel streams
+            client = Thread(target=handle_client, args=(sc, sockname))
+            client.daemon = True
+            client.start()
 
     except SocketError:
         logging.error("[*] Connection error")
@@ -206,9 +373,9 @@ def main():
         level = logging.DEBUG
     logging.basicConfig(level=level, format='%(message)s')
 
-    if options.buffer_size < 10:
+    if min(options.buffer_sizes) < 10:
         logging.info("[*] Using minimum buffer size of 10 bytes")
-        options.buffer_size = 10
+        options.buffer_sizes = [max(size, 10) for size in options.buffer_sizes]
 
     # Client running mode
     if options.client:
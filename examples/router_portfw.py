@@ -75,6 +75,10 @@ def parse_options():
                         help="Route String for connecting through a SAP Router")
     misc = parser.add_argument_group("Misc options")
     misc.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose output")
+    misc.add_argument("--passthrough", dest="passthrough", action="store_true",
+                      help="Forward the data without processing it, using zero-copy transfers if available")
+    misc.add_argument("--warm-routes", dest="warm_routes", type=int, default=0,
+                      help="Number of routes to establish in advance for new clients [%(default)d]")
 
     options = parser.parse_args()
 
@@ -132,7 +136,9 @@ def main():
                                  target_pass=options.target_pass,
                                  talk_mode=options.talk_mode,
                                  keep_alive=False,
-                                 options=options)
+                                 options=options,
+                                 passthrough=options.passthrough,
+                                 warm_routes=options.warm_routes)
 
     try:
         while True:
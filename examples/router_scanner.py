@@ -18,6 +18,7 @@
 #
 
 # Standard imports
+import asyncio
 import logging
 from argparse import ArgumentParser
 # External imports
@@ -26,9 +27,7 @@ from scapy.packet import bind_layers
 # Custom imports
 import pysap
 from pysap.SAPNI import SAPNIStreamSocket, SAPNI
-from pysap.SAPRouter import (SAPRouterRouteHop, get_router_version,
-                             SAPRoutedStreamSocket, SAPRouteException,
-                             SAPRouter,
+from pysap.SAPRouter import (get_router_version, SAPRouter, SAPRouterScanner, SAPRouterRouteTable,
                              ROUTER_TALK_MODE_NI_MSG_IO, ROUTER_TALK_MODE_NI_RAW_IO)
 # Optional imports
 try:
@@ -71,6 +70,25 @@ def parse_options():
     target.add_argument("--talk-mode", dest="talk_mode", default="raw",
                         help="Talk mode to use when requesting the route (raw or ni) [%(default)s]")
 
+    scan = parser.add_argument_group("Scan options")
+    scan.add_argument("--concurrency", dest="concurrency", type=int, default=16,
+                      help="Number of route requests to perform concurrently [%(default)d]")
+    scan.add_argument("--rate", dest="rate", type=float,
+                      help="Maximum number of route requests per second [unlimited]")
+    scan.add_argument("--timeout", dest="timeout", type=float, default=5.0,
+                      help="Timeout in seconds for each route request [%(default)s]")
+    scan.add_argument("--retries", dest="retries", type=int, default=2,
+                      help="Number of retries of route requests failing with transient errors [%(default)d]")
+
+    offline = parser.add_argument_group("Offline evaluation options")
+    offline.add_argument("--route-table", dest="route_table", metavar="FILE",
+                         help="Evaluate the targets against a route table file in saprouttab format instead of "
+                              "scanning through the SAP Router")
+    offline.add_argument("--source-host", dest="source_host",
+                         help="Source host of the routes to evaluate [match only entries for any source host]")
+    offline.add_argument("--route-pass", dest="route_pass",
+                         help="Password to use for the routes to evaluate")
+
     misc = parser.add_argument_group("Misc options")
     misc.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose output")
 
@@ -108,34 +126,37 @@ def parse_target_hosts(target_hosts, target_ports):
                 yield (host, port)
 
 
-def route_test(rhost, rport, thost, tport, talk_mode, router_version):
-
-    logging.info("[*] Routing connections to %s:%s" % (thost, tport))
-
-    # Build the route to the target host passing through the SAP Router
-    route = [SAPRouterRouteHop(hostname=rhost,
-                               port=rport),
-             SAPRouterRouteHop(hostname=thost,
-                               port=tport)]
+async def scan(options):
+    scanner = SAPRouterScanner(concurrency=options.concurrency,
+                               rate=options.rate,
+                               timeout=options.timeout,
+                               retries=options.retries,
+                               talk_mode=options.talk_mode,
+                               router_version=options.router_version)
+    targets = parse_target_hosts(options.target_hosts, options.target_ports)
 
-    # Try to connect to the target host using the routed stream socket
-    try:
-        conn = SAPRoutedStreamSocket.get_nisocket(route=route,
-                                                  talk_mode=talk_mode,
-                                                  router_version=router_version)
-        conn.close()
-        status = 'open'
+    results = []
+    async for result in scanner.scan(targets, router=(options.remote_host, options.remote_port)):
+        if options.verbose:
+            logging.info("[*] Status of %s:%s: %s" % (result.host, result.port, result.status))
+        if result.status == SAPRouterScanner.STATUS_OPEN:
+            results.append((result.host, result.port))
+    return results
 
-    # If an SAPRouteException is raised, the route was denied or an error
-    # occurred with the SAP router
-    except SAPRouteException:
-        status = 'denied'
 
-    # Another error occurred on the server (e.g. timeout), mark the target as error
-    except Exception:
-        status = 'error'
+def evaluate(options):
+    route_table = SAPRouterRouteTable.from_file(options.route_table)
+    targets = parse_target_hosts(options.target_hosts, options.target_ports)
 
-    return status
+    results = []
+    for result in route_table.evaluate(targets, source=options.source_host, password=options.route_pass,
+                                       talk_mode=options.talk_mode):
+        if options.verbose:
+            logging.info("[*] Route to %s:%s: %s" % (result.host, result.port,
+                                                     "permitted" if result.permitted else "denied"))
+        if result.permitted:
+            results.append((result.host, result.port))
+    return results
 
 
 # Main function
@@ -147,6 +168,17 @@ def main():
         level = logging.DEBUG
     logging.basicConfig(level=level, format='%(message)s')
 
+    if options.route_table:
+        logging.info("[*] Evaluating routes against route table %s" % options.route_table)
+        options.talk_mode = {"raw": ROUTER_TALK_MODE_NI_RAW_IO,
+                             "ni": ROUTER_TALK_MODE_NI_MSG_IO}[options.talk_mode]
+        results = evaluate(options)
+
+        logging.info("[*] Host/Ports permitted:")
+        for (host, port) in results:
+            logging.info("\tHost: %s\tPort:%s" % (host, port))
+        return
+
     logging.info("[*] Connecting to SAP Router %s:%d (talk mode %s)" % (options.remote_host,
                                                                         options.remote_port,
                                                                         options.talk_mode))
@@ -163,14 +195,7 @@ def main():
     options.talk_mode = {"raw": ROUTER_TALK_MODE_NI_RAW_IO,
                          "ni": ROUTER_TALK_MODE_NI_MSG_IO}[options.talk_mode]
 
-    results = []
-    for (host, port) in parse_target_hosts(options.target_hosts, options.target_ports):
-        status = route_test(options.remote_host, options.remote_port, host, port,
-                            options.talk_mode, options.router_version)
-        if options.verbose:
-            logging.info("[*] Status of %s:%s: %s" % (host, port, status))
-        if status == "open":
-            results.append((host, port))
+    results = asyncio.run(scan(options))
 
     logging.info("[*] Host/Ports found open:")
     for (host, port) in results:
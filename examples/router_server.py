@@ -0,0 +1,115 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+# pysap - Python library for crafting SAP's network protocols packets
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import logging
+from argparse import ArgumentParser
+# External imports
+from scapy.config import conf
+# Custom imports
+import pysap
+from pysap.SAPRouter import (SAPRouterServer, SAPRouterServerPreforked, SAPRouterRouteTable,
+                             ROUTER_TALK_MODE_NI_MSG_IO, ROUTER_TALK_MODE_NI_RAW_IO)
+
+
+# Set the verbosity to 0
+conf.verb = 0
+
+
+# Command line options parser
+def parse_options():
+
+    description = "This example script runs a SAP Router emulator, that can be used as a target for testing " \
+                  "and load testing SAP Router clients without a real SAP Router."
+
+    usage = "%(prog)s [options]"
+
+    parser = ArgumentParser(usage=usage, description=description, epilog=pysap.epilog)
+
+    local = parser.add_argument_group("Local options")
+    local.add_argument("-a", "--local-host", dest="local_host", default="127.0.0.1",
+                       help="Local host to listen [%(default)s]")
+    local.add_argument("-l", "--local-port", dest="local_port", type=int, default=3299,
+                       help="Local port to listen [%(default)d]")
+
+    router = parser.add_argument_group("Router options")
+    router.add_argument("-t", "--route-table", dest="route_table", metavar="FILE",
+                        help="Route table file in saprouttab format, all routes are permitted if not specified")
+    router.add_argument("--router-version", dest="router_version", type=int, default=40,
+                        help="Router version to report [%(default)d]")
+    router.add_argument("--talk-modes", dest="talk_modes", default="ni,raw",
+                        help="Comma-separated list of talk modes allowed (raw or ni) [%(default)s]")
+    router.add_argument("--info-password", dest="info_password",
+                        help="Password required for information requests")
+    router.add_argument("-w", "--workers", dest="workers", type=int, default=0,
+                        help="Number of worker processes, 0 to serve all the clients in a single process "
+                             "[%(default)d]")
+
+    misc = parser.add_argument_group("Misc options")
+    misc.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose output")
+
+    options = parser.parse_args()
+
+    talk_modes = {"ni": ROUTER_TALK_MODE_NI_MSG_IO, "raw": ROUTER_TALK_MODE_NI_RAW_IO}
+    try:
+        options.talk_modes = [talk_modes[mode.strip().lower()] for mode in options.talk_modes.split(",")]
+    except KeyError:
+        parser.error("Invalid talk mode")
+
+    return options
+
+
+# Main function
+def main():
+    options = parse_options()
+
+    level = logging.INFO
+    if options.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(level=level, format='%(message)s')
+
+    route_table = None
+    if options.route_table:
+        route_table = SAPRouterRouteTable.from_file(options.route_table)
+        logging.info("[*] Loaded %d route table entries" % len(route_table.entries))
+
+    kwargs = {}
+    server_cls = SAPRouterServer
+    if options.workers:
+        server_cls = SAPRouterServerPreforked
+        kwargs["workers"] = options.workers
+
+    server = server_cls((options.local_host, options.local_port),
+                        route_table=route_table,
+                        router_version=options.router_version,
+                        talk_modes=options.talk_modes,
+                        info_password=options.info_password,
+                        **kwargs)
+
+    logging.info("[*] SAP Router emulator listening on %s:%d" % (options.local_host, options.local_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.error("[*] Cancelled by the user !")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
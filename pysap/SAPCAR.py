@@ -19,11 +19,15 @@
 # Standard imports
 import stat
 from zlib import crc32
-from struct import pack
+from struct import Struct, pack
 from stat import filemode
 from datetime import datetime
-from os import stat as os_stat
-from io import BytesIO
+from os import cpu_count, stat as os_stat
+from time import time
+from io import BufferedReader, RawIOBase
+from collections import deque, namedtuple
+from queue import Queue
+from threading import Event
 # External imports
 from scapy.packet import Packet
 from scapy.fields import (ByteField, ByteEnumField, LEIntField, FieldLenField,
@@ -31,12 +35,24 @@ from scapy.fields import (ByteField, ByteEnumField, LEIntField, FieldLenField,
                           ConditionalField, LESignedIntField, StrField, LELongField)
 # Custom imports
 from pysap.utils.fields import (PacketNoPadded, StrNullFixedLenField, PacketListStopField)
-from pysapcompress import (decompress, compress, ALG_LZH, CompressError,
+from pysapcompress import (ALG_LZH, CompressError, Compressor, Decompressor,
                            DecompressError)
 
 
 SIZE_FOUR_GB = 0xffffffff + 1
 
+SAPCAR_CHUNK_SIZE = 0x10000
+"""Size of the chunks read from archives and written to extracted files"""
+
+SAPCAR_BLOCK_SIZE = 0x10000
+"""Maximum size of the compressed data stored in each block when adding files to archives"""
+
+SAPCAR_STREAM_SIZE = 0x40000000
+"""Maximum size of the content compressed in a single stream when adding files to archives"""
+
+SAPCAR_BLOB_HEADER_SIZE = 8
+"""Size of the compression header at the start of compressed streams"""
+
 
 class SAPCARInvalidFileException(Exception):
     """Exception to denote an invalid SAP CAR file"""
@@ -81,7 +97,8 @@ SAPCAR_BLOCK_TYPE_UNCOMPRESSED = b"UD"
 class SAPCARCompressedBlockFormat(PacketNoPadded):
     """SAP CAR compressed block
 
-    This is used for decompressing blocks inside the file info format.
+    This is used for decompressing blocks inside the file info format. Uncompressed blocks hold the length of the
+    data followed by the data itself.
     """
     name = "SAP CAR Archive Compressed block"
 
@@ -89,8 +106,12 @@ class SAPCARCompressedBlockFormat(PacketNoPadded):
         StrFixedLenField("type", SAPCAR_BLOCK_TYPE_COMPRESSED_LAST, 2),
         ConditionalField(PacketField("compressed", None, SAPCARCompressedBlobFormat),
                          lambda x: x.type in [SAPCAR_BLOCK_TYPE_COMPRESSED_LAST, SAPCAR_BLOCK_TYPE_COMPRESSED]),
+        ConditionalField(FieldLenField("data_length", None, length_of="data", fmt="<I"),
+                         lambda x: x.type in [SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST, SAPCAR_BLOCK_TYPE_UNCOMPRESSED]),
+        ConditionalField(StrFixedLenField("data", None, length_from=lambda x: x.data_length),
+                         lambda x: x.type in [SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST, SAPCAR_BLOCK_TYPE_UNCOMPRESSED]),
         ConditionalField(LESignedIntField("checksum", 0),
-                         lambda x: x.type == SAPCAR_BLOCK_TYPE_COMPRESSED_LAST),
+                         lambda x: x.type in [SAPCAR_BLOCK_TYPE_COMPRESSED_LAST, SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST]),
     ]
 
 
@@ -106,6 +127,243 @@ def sapcar_is_last_block(packet):
     return packet.type in [SAPCAR_BLOCK_TYPE_COMPRESSED_LAST, SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST]
 
 
+def sapcar_checksum(crc):
+    """Helper function that converts a CRC32 value obtained with L{zlib.crc32}, starting with C{0xffffffff}, to the
+    checksum stored in archive files.
+
+    :param crc: CRC32 value
+    :type crc: int
+
+    :return: checksum as stored in the end of data block
+    :rtype: int
+    """
+    checksum = crc ^ 0xffffffff
+    if checksum & 0x80000000:
+        checksum -= SIZE_FOUR_GB
+    return checksum
+
+
+def sapcar_compress_blocks(fd, file_length, block_size=SAPCAR_BLOCK_SIZE, stream_size=SAPCAR_STREAM_SIZE,
+                           chunk_size=SAPCAR_CHUNK_SIZE):
+    """Helper function that reads the content of a file in chunks and compresses it using the LZH algorithm in a single
+    stream, split in blocks of a fixed size as the compressed data is produced. As the length of the stream is stored
+    as a signed 32-bit integer, files larger than the stream size are compressed in several streams, each one of them
+    starting in a new block. The last block is an end of data block, along with the checksum of the whole content.
+
+    Blocks not longer than a compression header are parsed as holding the rest of the data, so all blocks are kept
+    longer than that, and the block size should be more than twice its length.
+
+    :param fd: file object to read from
+    :type fd: file
+
+    :param file_length: expected length of the file
+    :type file_length: int
+
+    :param block_size: maximum size of the compressed data stored in each block
+    :type block_size: int
+
+    :param stream_size: maximum size of the content compressed in each stream
+    :type stream_size: int
+
+    :param chunk_size: size of the chunks read from the file
+    :type chunk_size: int
+
+    :return: blocks of the file, as tuples of block type, block data following the length field, and checksum for
+        end of data blocks
+    :rtype: iterator of tuple
+
+    :raise CompressError: If there's a compression error
+    :raise SAPCARInvalidFileException: If the length of the file doesn't match the expected one
+    """
+    crc = 0xffffffff
+    remaining = file_length
+    while remaining > 0:
+        compressor = Compressor(min(stream_size, remaining), ALG_LZH)
+        stream_remaining = compressor.length
+        compressed = bytearray()
+        while stream_remaining > 0:
+            chunk = fd.read(min(chunk_size, stream_remaining))
+            if not chunk:
+                raise SAPCARInvalidFileException("File length changed while reading it")
+            stream_remaining -= len(chunk)
+            remaining -= len(chunk)
+            crc = crc32(chunk, crc)
+            compressed += compressor.compress(chunk)
+            while len(compressed) > block_size + SAPCAR_BLOB_HEADER_SIZE:
+                yield SAPCAR_BLOCK_TYPE_COMPRESSED, bytes(compressed[:block_size]), None
+                del compressed[:block_size]
+
+        # Split the rest of the stream in one or two blocks, both longer than the header
+        if len(compressed) > block_size:
+            yield SAPCAR_BLOCK_TYPE_COMPRESSED, bytes(compressed[:len(compressed) // 2]), None
+            del compressed[:len(compressed) // 2]
+        if remaining > 0:
+            yield SAPCAR_BLOCK_TYPE_COMPRESSED, bytes(compressed), None
+        else:
+            if fd.read(1):
+                raise SAPCARInvalidFileException("File length changed while reading it")
+            yield SAPCAR_BLOCK_TYPE_COMPRESSED_LAST, bytes(compressed), sapcar_checksum(crc)
+    # Empty files have no blocks
+    if file_length == 0 and fd.read(1):
+        raise SAPCARInvalidFileException("File length changed while reading it")
+
+
+def sapcar_decompress_blocks(blocks, chunk_size=SAPCAR_CHUNK_SIZE):
+    """Helper function that decompresses the content of a file from its blocks, generating it in chunks as the blocks
+    are decompressed. The checksum obtained from the archive is returned once all the content was generated.
+
+    :param blocks: blocks of the file, as tuples of block type, iterable of chunks of the block data following the
+        length field, and checksum for end of data blocks
+    :type blocks: iterable
+
+    :param chunk_size: maximum size of the chunks generated
+    :type chunk_size: int
+
+    :return: chunks of the file content, returning the checksum obtained from the archive
+    :rtype: generator of bytes
+
+    :raise DecompressError: If there's a decompression error
+    :raise SAPCARInvalidFileException: If the file is invalid
+    """
+    checksum = 0
+    decompressor = None
+
+    def decompressed(data):
+        # Obtain the output still pending for the input already fed to the decompressor
+        while data:
+            yield data
+            if decompressor.eof or decompressor.needs_input:
+                break
+            data = decompressor.decompress(b"", chunk_size)
+
+    for (block_type, chunks, block_checksum) in blocks:
+        # Process uncompressed block types
+        if block_type in [SAPCAR_BLOCK_TYPE_UNCOMPRESSED, SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST]:
+            for chunk in chunks:
+                yield chunk
+        # Feed compressed block types to the decompressor. A compressed stream usually spans all the blocks of the
+        # file, but files might also be compressed in several streams, so a new decompressor is only used once the
+        # previous stream ended.
+        elif block_type in [SAPCAR_BLOCK_TYPE_COMPRESSED, SAPCAR_BLOCK_TYPE_COMPRESSED_LAST]:
+            if decompressor is None or decompressor.eof:
+                decompressor = Decompressor()
+            for chunk in chunks:
+                if decompressor.eof:
+                    break
+                for data in decompressed(decompressor.decompress(chunk, chunk_size)):
+                    yield data
+            # The end of LZC streams is only decoded once it's known that there's no more input
+            if block_type == SAPCAR_BLOCK_TYPE_COMPRESSED_LAST and not decompressor.eof:
+                for data in decompressed(decompressor.flush(chunk_size)):
+                    yield data
+        else:
+            raise SAPCARInvalidFileException("Invalid block type found")
+
+        # Check end of data block
+        if block_type in [SAPCAR_BLOCK_TYPE_COMPRESSED_LAST, SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST]:
+            checksum = block_checksum
+            break
+
+    if decompressor is not None and not decompressor.eof:
+        raise DecompressError("Error decompressing block")
+
+    return checksum
+
+
+def sapcar_extract_blocks(blocks, fd, chunk_size=SAPCAR_CHUNK_SIZE):
+    """Helper function that extracts the content of a file from its blocks, writing it to the provided file object
+    in chunks as the blocks are decompressed. The checksum of the extracted content is calculated along the way.
+
+    :param blocks: blocks of the file, as tuples of block type, iterable of chunks of the block data following the
+        length field, and checksum for end of data blocks
+    :type blocks: iterable
+
+    :param fd: file-like object to write the extracted file to, or None to discard the content
+    :type fd: file
+
+    :param chunk_size: maximum size of the chunks written
+    :type chunk_size: int
+
+    :return: checksum obtained from the archive and checksum of the extracted content
+    :rtype: tuple of int
+
+    :raise DecompressError: If there's a decompression error
+    :raise SAPCARInvalidFileException: If the file is invalid
+    """
+    crc = 0xffffffff
+    chunks = sapcar_decompress_blocks(blocks, chunk_size)
+    while True:
+        try:
+            data = next(chunks)
+        except StopIteration as e:
+            return e.value, sapcar_checksum(crc)
+        crc = crc32(data, crc)
+        if fd is not None:
+            fd.write(data)
+
+
+class SAPCARArchiveFileReader(RawIOBase):
+    """Read-only file object giving access to the content of a file inside a SAP CAR archive. The blocks of the file
+    are decompressed as the content is read, so only a few chunks are kept in memory regardless of the size of the
+    file. The checksum is validated once all the content was read.
+    """
+
+    def __init__(self, blocks, enforce_checksum=False, chunk_size=SAPCAR_CHUNK_SIZE):
+        """
+        :param blocks: blocks of the file, as tuples of block type, iterable of chunks of the block data following
+            the length field, and checksum for end of data blocks
+        :type blocks: iterable
+
+        :param enforce_checksum: If the checksum validation should be enforced
+        :type enforce_checksum: bool
+
+        :param chunk_size: maximum size of the chunks decompressed
+        :type chunk_size: int
+        """
+        super(SAPCARArchiveFileReader, self).__init__()
+        self.enforce_checksum = enforce_checksum
+        self.checksum = None
+        """ :ivar: checksum obtained from the archive, available once all the content was read """
+        self.valid_checksum = None
+        """ :ivar: if the checksum matches, available once all the content was read """
+        self._chunks = sapcar_decompress_blocks(blocks, chunk_size)
+        self._crc = 0xffffffff
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """Reads decompressed content into a buffer.
+
+        :raise DecompressError: If there's a decompression error
+        :raise SAPCARInvalidFileException: If the file is invalid
+        :raise SAPCARInvalidChecksumException: If the checksum is invalid and its validation is enforced
+        """
+        while not self._buffer and self._chunks is not None:
+            try:
+                data = next(self._chunks)
+            except StopIteration as e:
+                self._chunks = None
+                self.checksum = e.value
+                self.valid_checksum = self.checksum == sapcar_checksum(self._crc)
+                if self.enforce_checksum and not self.valid_checksum:
+                    raise SAPCARInvalidChecksumException("Invalid checksum found")
+                break
+            self._crc = crc32(data, self._crc)
+            self._buffer = memoryview(data)
+        length = min(len(buffer), len(self._buffer))
+        buffer[:length] = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        return length
+
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close()
+            self._chunks = None
+        super(SAPCARArchiveFileReader, self).close()
+
+
 SAPCAR_TYPE_FILE = b"RG"
 """SAP CAR regular file string"""
 
@@ -173,58 +431,63 @@ class SAPCARArchiveFilev200Format(PacketNoPadded):
         self.file_length_low = file_length & 0xffffffff
         self.file_length_high = file_length >> 32
 
-    def extract(self, fd):
+    def extract(self, fd, chunk_size=SAPCAR_CHUNK_SIZE):
         """Extracts the archive file and writes the extracted file to the provided file object. Returns the checksum
         obtained from the archive. If blocks are uncompressed, the file is directly extracted. If the blocks are
-        compressed, each block is added to a buffer, skipping the length field, and decompression is performed after
-        the block marked as end of data. Expected length and compression header is obtained from the first block and
-        checksum from the end of data block.
+        compressed, each block is fed to a decompressor, skipping the length field, and the decompressed content
+        written in chunks.
 
         :param fd: file-like object to write the extracted file to
         :type fd: file
 
+        :param chunk_size: maximum size of the chunks written
+        :type chunk_size: int
+
         :return: checksum
         :rtype: int
 
         :raise DecompressError: If there's a decompression error
         :raise SAPCARInvalidFileException: If the file is invalid
         """
+        return self.extract_checksums(fd, chunk_size)[0]
 
-        if self.file_length == 0:
-            return 0
-
-        compressed = b""
-        checksum = 0
-        exp_length = None
-
-        remaining_length = self.file_length
-        for block in self.blocks:
-            # Process uncompressed block types
-            if block.type in [SAPCAR_BLOCK_TYPE_UNCOMPRESSED, SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST]:
-                fd.write(block.compressed)
-                remaining_length -= len(block.compressed)
-            # Store compressed block types for later decompression
-            elif block.type in [SAPCAR_BLOCK_TYPE_COMPRESSED, SAPCAR_BLOCK_TYPE_COMPRESSED_LAST]:
-                # Add compressed block to a buffer, skipping the first 4 bytes of each block (uncompressed length)
-                compressed += bytes(block.compressed)[4:]
-                # If the expected length wasn't already set, do it
-                if not exp_length:
-                    exp_length = block.compressed.uncompress_length
-            else:
-                raise SAPCARInvalidFileException("Invalid block type found")
+    def extract_checksums(self, fd, chunk_size=SAPCAR_CHUNK_SIZE):
+        """Extracts the archive file and writes the extracted file to the provided file object. Returns the checksum
+        obtained from the archive and the one calculated over the extracted content.
 
-            # Check end of data block, performing decompression if needed
-            if sapcar_is_last_block(block):
-                checksum = block.checksum
-                # If there was at least one compressed block that set the expected length, decompress it
-                if exp_length:
-                    (_, block_length, block_buffer) = decompress(bytes(compressed), exp_length)
-                    if block_length != exp_length or not block_buffer:
-                        raise DecompressError("Error decompressing block")
-                    fd.write(block_buffer)
-                break
+        :param fd: file-like object to write the extracted file to, or None to discard the content
+        :type fd: file
 
-        return checksum
+        :param chunk_size: maximum size of the chunks written
+        :type chunk_size: int
+
+        :return: checksum obtained from the archive and checksum of the extracted content
+        :rtype: tuple of int
+
+        :raise DecompressError: If there's a decompression error
+        :raise SAPCARInvalidFileException: If the file is invalid
+        """
+        return sapcar_extract_blocks(self.read_blocks(chunk_size), fd, chunk_size)
+
+    def read_blocks(self, chunk_size=SAPCAR_CHUNK_SIZE):
+        """Returns the blocks of the file, as expected by L{sapcar_decompress_blocks}.
+
+        :param chunk_size: size of the chunks of data of each block, not used as blocks are already in memory
+        :type chunk_size: int
+
+        :return: blocks of the file, as tuples of block type, list with the block data and checksum
+        :rtype: iterator of tuple
+        """
+        if self.file_length == 0:
+            return iter([])
+        return ((block.type, self._block_data(block), block.checksum) for block in self.blocks or [])
+
+    @staticmethod
+    def _block_data(block):
+        if block.type in [SAPCAR_BLOCK_TYPE_UNCOMPRESSED, SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST]:
+            return [block.data] if block.data else []
+        # Skip the first 4 bytes of compressed blocks (compressed length)
+        return [bytes(block.compressed)[4:]] if block.compressed is not None else []
 
 
 class SAPCARArchiveFilev201Format(SAPCARArchiveFilev200Format):
@@ -269,6 +532,230 @@ class SAPCARArchiveFormat(Packet):
     ]
 
 
+sapcar_archive_header = Struct("<4s4s")
+"""SAP CAR archive header layout: magic string and version"""
+
+sapcar_file_header = Struct("<2sIQIQIHH")
+"""SAP CAR file header layout, up to the filename and user info fields"""
+
+sapcar_block_header = Struct("<2sI")
+"""SAP CAR block header layout: block type and length of the block data"""
+
+sapcar_block_checksum = Struct("<i")
+"""SAP CAR end of data block checksum layout"""
+
+
+SAPCARBlockInfo = namedtuple("SAPCARBlockInfo", ["type", "offset", "length", "checksum"])
+"""Location of a block inside a SAP CAR archive: type, offset in the archive
+of the block data following the length field, its length and the checksum for
+end of data blocks"""
+
+
+class SAPCARArchiveFileEntry(object):
+    """SAP CAR file entry in an archive index
+
+    Holds the header fields of a file inside a SAP CAR archive along with the
+    location of the entry and its blocks in the archive, without reading the
+    file content. It provides the same fields as the file format objects, so
+    it can be used with :class:`SAPCARArchiveFile`.
+    """
+
+    def __init__(self, fd, version, offset):
+        """Reads the entry header and walks its blocks.
+
+        :param fd: archive file object
+        :type fd: file
+
+        :param version: version of the archive
+        :type version: string
+
+        :param offset: offset of the entry in the archive
+        :type offset: int
+
+        :raise SAPCARInvalidFileException: if the entry is truncated or
+            contains an invalid block type
+        """
+        self.fd = fd
+        self.version = version
+        self.offset = offset
+        self.blocks = []
+
+        fd.seek(offset)
+        header = fd.read(sapcar_file_header.size)
+        if len(header) < sapcar_file_header.size:
+            raise SAPCARInvalidFileException("Truncated file header")
+        (self.type, self.perm_mode, self.file_length_low, self.file_length_high, self.timestamp,
+         self.code_page, self.user_info_length, self.filename_length) = sapcar_file_header.unpack(header)
+        self.filename = fd.read(self.filename_length)
+        self.user_info = fd.read(self.user_info_length)
+        if len(self.filename) < self.filename_length or len(self.user_info) < self.user_info_length:
+            raise SAPCARInvalidFileException("Truncated file header")
+        if version == SAPCAR_VERSION_201 and self.filename_length:
+            self.filename = self.filename[:-1]
+
+        # Walk the blocks skipping their data
+        position = fd.tell()
+        if self.type == SAPCAR_TYPE_FILE and self.file_length > 0:
+            while True:
+                block_header = fd.read(sapcar_block_header.size)
+                if len(block_header) < sapcar_block_header.size:
+                    raise SAPCARInvalidFileException("Truncated block")
+                (block_type, block_length) = sapcar_block_header.unpack(block_header)
+                if block_type not in [SAPCAR_BLOCK_TYPE_COMPRESSED, SAPCAR_BLOCK_TYPE_COMPRESSED_LAST,
+                                      SAPCAR_BLOCK_TYPE_UNCOMPRESSED, SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST]:
+                    raise SAPCARInvalidFileException("Invalid block type found")
+                position += sapcar_block_header.size
+                checksum = None
+                if block_type in [SAPCAR_BLOCK_TYPE_COMPRESSED_LAST, SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST]:
+                    fd.seek(position + block_length)
+                    block_checksum = fd.read(sapcar_block_checksum.size)
+                    if len(block_checksum) < sapcar_block_checksum.size:
+                        raise SAPCARInvalidFileException("Truncated block")
+                    (checksum, ) = sapcar_block_checksum.unpack(block_checksum)
+                self.blocks.append(SAPCARBlockInfo(block_type, position, block_length, checksum))
+                position += block_length
+                if checksum is not None:
+                    position += sapcar_block_checksum.size
+                    break
+                fd.seek(position)
+        self.length = position - offset
+        """ :ivar: length of the entry in the archive """
+
+    @property
+    def file_length(self):
+        """The file length, obtained from the two length fields (low and high) as provided in the archive file.
+        """
+        return (self.file_length_high * SIZE_FOUR_GB) + self.file_length_low
+
+    def load(self):
+        """Reads the entry from the archive and dissects it.
+
+        :return: file format object
+        :rtype: L{SAPCARArchiveFilev200Format} or L{SAPCARArchiveFilev201Format}
+        """
+        self.fd.seek(self.offset)
+        return sapcar_archive_file_versions[self.version](self.fd.read(self.length))
+
+    def read_block(self, block, chunk_size=SAPCAR_CHUNK_SIZE):
+        """Reads the data of a block from the archive in chunks.
+
+        :param block: block to read
+        :type block: L{SAPCARBlockInfo}
+
+        :param chunk_size: size of the chunks to read
+        :type chunk_size: int
+
+        :return: chunks of the block data
+        :rtype: iterator of bytes
+
+        :raise SAPCARInvalidFileException: if the block is truncated
+        """
+        offset = block.offset
+        remaining = block.length
+        while remaining > 0:
+            self.fd.seek(offset)
+            chunk = self.fd.read(min(chunk_size, remaining))
+            if not chunk:
+                raise SAPCARInvalidFileException("Truncated block")
+            offset += len(chunk)
+            remaining -= len(chunk)
+            yield chunk
+
+    def extract(self, fd, chunk_size=SAPCAR_CHUNK_SIZE):
+        """Extracts the archive file reading its blocks from the archive and writes the extracted file to the
+        provided file object in chunks. Returns the checksum obtained from the archive.
+
+        :param fd: file-like object to write the extracted file to
+        :type fd: file
+
+        :param chunk_size: size of the chunks read and written
+        :type chunk_size: int
+
+        :return: checksum
+        :rtype: int
+
+        :raise DecompressError: If there's a decompression error
+        :raise SAPCARInvalidFileException: If the file is invalid
+        """
+        return self.extract_checksums(fd, chunk_size)[0]
+
+    def extract_checksums(self, fd, chunk_size=SAPCAR_CHUNK_SIZE):
+        """Extracts the archive file reading its blocks from the archive and writes the extracted file to the
+        provided file object in chunks. Returns the checksum obtained from the archive and the one calculated over
+        the extracted content.
+
+        :param fd: file-like object to write the extracted file to, or None to discard the content
+        :type fd: file
+
+        :param chunk_size: size of the chunks read and written
+        :type chunk_size: int
+
+        :return: checksum obtained from the archive and checksum of the extracted content
+        :rtype: tuple of int
+
+        :raise DecompressError: If there's a decompression error
+        :raise SAPCARInvalidFileException: If the file is invalid
+        """
+        return sapcar_extract_blocks(self.read_blocks(chunk_size), fd, chunk_size)
+
+    def read_blocks(self, chunk_size=SAPCAR_CHUNK_SIZE):
+        """Returns the blocks of the file, reading their data from the archive in chunks as they are consumed.
+
+        :param chunk_size: size of the chunks to read
+        :type chunk_size: int
+
+        :return: blocks of the file, as tuples of block type, iterator of chunks of the block data and checksum
+        :rtype: iterator of tuple
+        """
+        if self.file_length == 0:
+            return iter([])
+        return ((block.type, self.read_block(block, chunk_size), block.checksum) for block in self.blocks)
+
+
+class SAPCARArchiveIndex(object):
+    """SAP CAR archive index
+
+    Walks the headers of the files inside a SAP CAR archive, seeking past
+    the content of each block using its length. Listing the files in the
+    archive then takes a few reads per file regardless of their size, and
+    their content is read from the archive only when extracted.
+    """
+
+    def __init__(self, fd):
+        """Reads the archive header and the headers of the files in it.
+
+        :param fd: archive file object, should be seekable
+        :type fd: file
+
+        :raise SAPCARInvalidFileException: if the archive is truncated or
+            contains an invalid block type
+        """
+        self.fd = fd
+        self.entries = []
+
+        fd.seek(0)
+        header = fd.read(sapcar_archive_header.size)
+        if len(header) < sapcar_archive_header.size:
+            raise SAPCARInvalidFileException("Truncated archive header")
+        (self.magic_string, version) = sapcar_archive_header.unpack(header)
+        self.version = version.decode(errors="replace")
+
+        if self.magic_string in [SAPCAR_HEADER_MAGIC_STRING_STANDARD, SAPCAR_HEADER_MAGIC_STRING_BACKUP] and \
+                self.version in sapcar_archive_file_versions:
+            offset = sapcar_archive_header.size
+            while fd.read(1):
+                entry = SAPCARArchiveFileEntry(fd, self.version, offset)
+                self.entries.append(entry)
+                offset += entry.length
+                fd.seek(offset)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class SAPCARArchiveFile(object):
     """Proxy class that can be used to access a file inside a SAP CAR
     archive and obtain its properties.
@@ -311,6 +798,15 @@ class SAPCARArchiveFile(object):
         """
         return self._file_format.version
 
+    @property
+    def offset(self):
+        """The offset of the file in the archive, only available for files in indexed archives.
+
+        :return: offset of the file in the archive
+        :rtype: int
+        """
+        return getattr(self._file_format, "offset", None)
+
     @property
     def type(self):
         """The type of the file.
@@ -425,7 +921,7 @@ class SAPCARArchiveFile(object):
         checksum = None
         if self._file_format.blocks:
             for block in self._file_format.blocks:
-                if block.type == SAPCAR_BLOCK_TYPE_COMPRESSED_LAST:
+                if sapcar_is_last_block(block):
                     if checksum is not None:
                         raise SAPCARInvalidFileException("More than one end of data block found for the file")
                     checksum = block.checksum
@@ -442,7 +938,7 @@ class SAPCARArchiveFile(object):
         """
         checksum_set = False
         for block in self._file_format.blocks:
-            if block.type == SAPCAR_BLOCK_TYPE_COMPRESSED_LAST:
+            if sapcar_is_last_block(block):
                 if checksum_set:
                     raise SAPCARInvalidFileException("More than one end of data block found for the file")
                 block.checksum = checksum
@@ -460,7 +956,7 @@ class SAPCARArchiveFile(object):
         :return: the CRC32 checksum
         :rtype: int
         """
-        return -crc32(data, -1) - 1
+        return sapcar_checksum(crc32(data, 0xffffffff))
 
     @classmethod
     def from_file(cls, filename, version=SAPCAR_VERSION_201, archive_filename=None):
@@ -479,18 +975,6 @@ class SAPCARArchiveFile(object):
         :raise ValueError: if the version requested is invalid
         """
 
-        # Read the file properties and its content
-        stat = os_stat(filename)
-        with open(filename, "rb") as fd:
-            data = fd.read()
-
-        # Compress the file content and build the compressed string
-        try:
-            (_, out_length, out_buffer) = compress(data, ALG_LZH)
-        except CompressError:
-            return None
-        out_buffer = pack("<I", out_length) + out_buffer
-
         # Check the version and grab the file format class
         if version not in list(sapcar_archive_file_versions.keys()):
             raise ValueError("Invalid version")
@@ -499,28 +983,55 @@ class SAPCARArchiveFile(object):
         # If an archive filename was not provided, use the actual filename
         if archive_filename is None:
             archive_filename = filename
-        print(archive_filename)
 
         # Build the object and fill the fields
+        file_stat = os_stat(filename)
         archive_file = cls()
         archive_file._file_format = ff()
-        archive_file._file_format.perm_mode = stat.st_mode
-        archive_file._file_format.timestamp = stat.st_atime_ns
-        archive_file._file_format.file_length = stat.st_size
+        archive_file._file_format.perm_mode = file_stat.st_mode
+        archive_file._file_format.timestamp = int(file_stat.st_mtime)
+        archive_file._file_format.file_length = file_stat.st_size
         archive_file._file_format.filename = archive_filename.encode('utf-8')
-        archive_file._file_format.filename_length = len(archive_filename)
+        archive_file._file_format.filename_length = len(archive_file._file_format.filename)
         if archive_file._file_format.version == SAPCAR_VERSION_201:
             archive_file._file_format.filename_length += 1
-        # Put the compressed blob inside a end of data block and add it to the object
-        block = SAPCARCompressedBlockFormat()
-        block.type = SAPCAR_BLOCK_TYPE_COMPRESSED_LAST
-        block.compressed = SAPCARCompressedBlobFormat(out_buffer)
-        block.checksum = cls.calculate_checksum(data)
-        archive_file._file_format.blocks.append(block)
-
-        archive_file._file_format.show()
+
+        # Compress the file content in blocks, the last one being the end of data block
+        try:
+            with open(filename, "rb") as fd:
+                for (block_type, compressed, checksum) in sapcar_compress_blocks(fd, file_stat.st_size):
+                    block = SAPCARCompressedBlockFormat()
+                    block.type = block_type
+                    block.compressed = SAPCARCompressedBlobFormat(pack("<I", len(compressed)) + compressed)
+                    if checksum is not None:
+                        block.checksum = checksum
+                    archive_file._file_format.blocks.append(block)
+        except CompressError:
+            return None
+
         return archive_file
 
+    @classmethod
+    def from_offset(cls, fd, offset, version=SAPCAR_VERSION_201):
+        """Populates the file object from the entry found at a given offset of an archive, as obtained from the
+        L{offset} of a file in an indexed archive. Only the header of the file is read.
+
+        :param fd: archive file object
+        :type fd: file
+
+        :param offset: offset of the file in the archive
+        :type offset: int
+
+        :param version: version of the archive
+        :type version: string
+
+        :raise ValueError: if the version requested is invalid
+        :raise SAPCARInvalidFileException: if the file is invalid
+        """
+        if version not in list(sapcar_archive_file_versions.keys()):
+            raise ValueError("Invalid version")
+        return cls(SAPCARArchiveFileEntry(fd, version, offset))
+
     @classmethod
     def from_archive_file(cls, archive_file, version=SAPCAR_VERSION_201):
         """Populates the file format object from another archive file object.
@@ -538,16 +1049,20 @@ class SAPCARArchiveFile(object):
             raise ValueError("Invalid version")
         ff = sapcar_archive_file_versions[version]
 
+        file_format = archive_file._file_format
+        if isinstance(file_format, SAPCARArchiveFileEntry):
+            file_format = file_format.load()
+
         new_archive_file = cls()
         new_archive_file._file_format = ff()
-        new_archive_file._file_format.type = archive_file._file_format.type
-        new_archive_file._file_format.perm_mode = archive_file._file_format.perm_mode
-        new_archive_file._file_format.timestamp = archive_file._file_format.timestamp
-        new_archive_file._file_format.file_length = archive_file._file_format.file_length
-        new_archive_file._file_format.filename = archive_file._file_format.filename
-        new_archive_file._file_format.filename_length = archive_file._file_format.filename_length
-
-        for block in archive_file._file_format.blocks:
+        new_archive_file._file_format.type = file_format.type
+        new_archive_file._file_format.perm_mode = file_format.perm_mode
+        new_archive_file._file_format.timestamp = file_format.timestamp
+        new_archive_file._file_format.file_length = file_format.file_length
+        new_archive_file._file_format.filename = file_format.filename
+        new_archive_file._file_format.filename_length = file_format.filename_length
+
+        for block in file_format.blocks:
             new_block = SAPCARCompressedBlockFormat()
             new_block.type = block.type
             new_block.compressed = SAPCARCompressedBlobFormat(bytes(block.compressed))
@@ -556,59 +1071,89 @@ class SAPCARArchiveFile(object):
 
         return new_archive_file
 
-    def open(self, enforce_checksum=False):
-        """Opens the compressed file and returns a file-like object that
-        can be used to access its uncompressed content.
+    def extract(self, fd, enforce_checksum=False, chunk_size=SAPCAR_CHUNK_SIZE):
+        """Extracts the file to a file object, writing its uncompressed content in chunks. The checksum is calculated
+        while extracting the file.
+
+        :param fd: file-like object to write the extracted file to, or None to discard the content
+        :type fd: file
 
         :param enforce_checksum: If the checksum validation should be enforce
         :type enforce_checksum: bool
 
-        :return: file-like object with the uncompressed file content
-        :rtype: file
+        :param chunk_size: maximum size of the chunks written
+        :type chunk_size: int
 
-        :raise Exception: If the file to open is a directory
+        :return: if the checksum matches
+        :rtype: bool
+
+        :raise Exception: If the file to extract is a directory
         :raise DecompressError: If there's a decompression error
         :raise SAPCARInvalidFileException: If the file is invalid
-        :raise SAPCARInvalidChecksumException: If the checksum is invalid
+        :raise SAPCARInvalidChecksumException: If the checksum is invalid and its validation is enforced
         """
         # Check that the type is file, so we don't try to extract from a directory
         if self.is_directory():
             raise Exception("Invalid file type")
 
-        # Extract the file to a file-like object
-        out_file = BytesIO()
-        checksum = self._file_format.extract(out_file)
-        out_file.seek(0)
+        (checksum, calculated_checksum) = self._file_format.extract_checksums(fd, chunk_size)
 
         # Validate the checksum if required
-        if enforce_checksum:
-            if checksum != self.calculate_checksum(out_file.getvalue()):
-                raise SAPCARInvalidChecksumException("Invalid checksum found")
-            out_file.seek(0)
+        if enforce_checksum and checksum != calculated_checksum:
+            raise SAPCARInvalidChecksumException("Invalid checksum found")
+        return checksum == calculated_checksum
+
+    def open(self, enforce_checksum=False, chunk_size=SAPCAR_CHUNK_SIZE):
+        """Opens the compressed file and returns a read-only file-like object
+        that can be used to access its uncompressed content. The content is
+        decompressed as it's read, and the checksum validated once all of it
+        was read.
+
+        :param enforce_checksum: If the checksum validation should be enforce
+        :type enforce_checksum: bool
+
+        :param chunk_size: maximum size of the chunks decompressed
+        :type chunk_size: int
+
+        :return: file-like object with the uncompressed file content
+        :rtype: L{io.BufferedReader}
 
-        # Return the extracted file
-        return out_file
+        :raise Exception: If the file to open is a directory
+        :raise DecompressError: If there's a decompression error while reading
+        :raise SAPCARInvalidFileException: If the file is invalid, while reading
+        :raise SAPCARInvalidChecksumException: If the checksum is invalid, after
+            reading all the content
+        """
+        # Check that the type is file, so we don't try to open a directory
+        if self.is_directory():
+            raise Exception("Invalid file type")
+        reader = SAPCARArchiveFileReader(self._file_format.read_blocks(chunk_size), enforce_checksum, chunk_size)
+        return BufferedReader(reader, chunk_size)
 
     def check_checksum(self):
-        """Checks if the checksum of the file is valid.
+        """Checks if the checksum of the file is valid. The file is decompressed without keeping its content.
 
         :return: if the checksum matches
         :rtype: bool
         """
         if self.size == 0:
             return True
-        crc = self.calculate_checksum(self.open().read())
-        return crc == self.checksum
+        return self.extract(None)
 
 
 class SAPCARArchive(object):
     """Proxy class that can be used to read SAP CAR archive files.
+
+    Archives opened for reading are indexed walking only the headers of the
+    files in them, and the whole archive is dissected only when it's needed
+    for modifying or writing it.
     """
 
     # Instance attributes
     filename = None
     fd = None
-    _sapcar = None
+    _index = None
+    _sapcar_format = None
 
     def __init__(self, fil, mode="rb+", version=SAPCAR_VERSION_201):
         """Opens an archive file and allow access to it.
@@ -656,7 +1201,10 @@ class SAPCARArchive(object):
         :rtype: L{dict} of L{SAPCARArchiveFile}
         """
         fils = {}
-        if self._files:
+        if self._sapcar_format is None and self._index is not None:
+            for entry in self._index:
+                fils[entry.filename.decode()] = SAPCARArchiveFile(entry)
+        elif self._files:
             for fil in self._files:
                 fils[fil.filename.decode()] = SAPCARArchiveFile(fil)
         return fils
@@ -677,6 +1225,8 @@ class SAPCARArchive(object):
         :return: version
         :rtype: string
         """
+        if self._sapcar_format is None and self._index is not None:
+            return self._index.version
         return self._sapcar.version.decode()
 
     @version.setter
@@ -702,18 +1252,40 @@ class SAPCARArchive(object):
             self._files.extend(fils)
 
     def read(self):
-        """Reads the SAP CAR archive file and populates the files list.
+        """Reads the SAP CAR archive file and populates the files list. If the file is seekable, only the headers of
+        the files are read.
 
         :raise Exception: if the file is invalid or unsupported
         """
-        self.fd.seek(0)
-        self._sapcar = SAPCARArchiveFormat(self.fd.read())
-        if self._sapcar.magic_string not in [SAPCAR_HEADER_MAGIC_STRING_STANDARD, SAPCAR_HEADER_MAGIC_STRING_BACKUP]:
+        self._index = self._sapcar_format = None
+        if getattr(self.fd, "seekable", None) and self.fd.seekable():
+            self._index = SAPCARArchiveIndex(self.fd)
+            (magic_string, version) = (self._index.magic_string, self._index.version)
+        else:
+            self.fd.seek(0)
+            self._sapcar = SAPCARArchiveFormat(self.fd.read())
+            (magic_string, version) = (self._sapcar.magic_string, self._sapcar.version.decode())
+        if magic_string not in [SAPCAR_HEADER_MAGIC_STRING_STANDARD, SAPCAR_HEADER_MAGIC_STRING_BACKUP]:
             raise Exception("Invalid or unsupported magic string in file")
-        print(self._sapcar.version)
-        if self._sapcar.version.decode() not in list(sapcar_archive_file_versions.keys()):
+        if version not in list(sapcar_archive_file_versions.keys()):
             raise Exception("Invalid or unsupported version in file")
 
+    @property
+    def _sapcar(self):
+        """The archive format object. If the archive was indexed, it's dissected from the file on first access.
+
+        :return: archive format object
+        :rtype: L{SAPCARArchiveFormat}
+        """
+        if self._sapcar_format is None and self._index is not None:
+            self.fd.seek(0)
+            self._sapcar_format = SAPCARArchiveFormat(self.fd.read())
+        return self._sapcar_format
+
+    @_sapcar.setter
+    def _sapcar(self, sapcar):
+        self._sapcar_format = sapcar
+
     @property
     def _files(self):
         """The file format objects according to the version.
@@ -735,13 +1307,17 @@ class SAPCARArchive(object):
     def create(self):
         """Creates the structure for holding a new SAP CAR archive file.
         """
+        self._index = None
         self._sapcar = SAPCARArchiveFormat()
 
     def write(self):
         """Writes the SAP CAR archive file to the file descriptor.
         """
+        # Indexed archives are dissected from the same file descriptor, so that's done before rewriting it
+        self._sapcar
         self.fd.seek(0)
-        self.fd.write(bytes(self._sapcar))
+        self._write_to(self.fd)
+        self.fd.truncate()
         self.fd.flush()
 
     def write_as(self, filename=None):
@@ -753,8 +1329,18 @@ class SAPCARArchive(object):
         if not filename:
             self.write()
         else:
-            with open(filename, "w") as fd:
-                fd.write(bytes(self._sapcar))
+            with open(filename, "wb") as fd:
+                self._write_to(fd)
+
+    def _write_to(self, fd):
+        """Writes the archive header and each of the files to a file object, serializing one file at a time.
+
+        :param fd: file object to write to
+        :type fd: file
+        """
+        fd.write(sapcar_archive_header.pack(self._sapcar.magic_string, self.version.encode()))
+        for fil in self._files or []:
+            fd.write(bytes(fil))
 
     def add_file(self, filename, archive_filename=None):
         """Adds a new file to the SAP CAR archive file.
@@ -793,6 +1379,280 @@ class SAPCARArchive(object):
         :return: raw data
         :rtype: string
         """
-        if self._sapcar:
+        if self._sapcar_format is not None or self._index is not None:
             return bytes(self._sapcar)
         return ""
+
+
+class SAPCARArchiveWriter(object):
+    """Streaming writer for SAP CAR archive files.
+
+    Files are written straight to the archive file object one at a time. The
+    content of each file is read in chunks and compressed in a single stream,
+    that is written in blocks of a fixed size as it's produced, so only a few
+    buffers are kept in memory regardless of the size of the files added.
+
+    If an executor is provided, several files added with L{add_files} are
+    compressed concurrently and written in order, keeping at most a given
+    number of files in flight and a few compressed blocks for each one of
+    them. LZH compression releases the GIL, so a thread pool executor can be
+    used to compress in several cores.
+    """
+
+    # Instance attributes
+    fd = None
+    version = None
+    block_size = None
+    executor = None
+    max_pending = None
+
+    max_pending_blocks = 4
+    """Maximum number of compressed blocks kept for each file waiting to be written"""
+
+    def __init__(self, fd, version=SAPCAR_VERSION_201, block_size=SAPCAR_BLOCK_SIZE, append=False, executor=None,
+                 max_pending=None):
+        """Writes the archive header, or checks the existing one and moves to the end of the archive when appending.
+
+        :param fd: archive file object to write to
+        :type fd: file
+
+        :param version: archive file version to use when creating
+        :type version: string
+
+        :param block_size: maximum size of the compressed data stored in each block
+        :type block_size: int
+
+        :param append: whether to append files to an existing archive
+        :type append: bool
+
+        :param executor: thread pool executor used to compress files concurrently
+        :type executor: L{concurrent.futures.ThreadPoolExecutor}
+
+        :param max_pending: maximum number of files being compressed by the executor, defaults to twice the number
+            of CPUs
+        :type max_pending: int
+
+        :raise ValueError: if the version requested is invalid
+        :raise SAPCARInvalidFileException: if appending to an invalid or unsupported archive
+        """
+        if version not in list(sapcar_archive_file_versions.keys()):
+            raise ValueError("Invalid version")
+        if block_size <= 2 * SAPCAR_BLOB_HEADER_SIZE:
+            raise ValueError("Invalid block size")
+
+        self.fd = fd
+        self.version = version
+        self.block_size = block_size
+        self.executor = executor
+        self.max_pending = max_pending or 2 * (cpu_count() or 1)
+
+        header = b""
+        if append:
+            fd.seek(0)
+            header = fd.read(sapcar_archive_header.size)
+        if header:
+            if len(header) < sapcar_archive_header.size:
+                raise SAPCARInvalidFileException("Truncated archive header")
+            (magic_string, version) = sapcar_archive_header.unpack(header)
+            self.version = version.decode("ascii", "replace")
+            if magic_string not in [SAPCAR_HEADER_MAGIC_STRING_STANDARD, SAPCAR_HEADER_MAGIC_STRING_BACKUP]:
+                raise SAPCARInvalidFileException("Invalid or unsupported magic string in file")
+            if self.version not in list(sapcar_archive_file_versions.keys()):
+                raise SAPCARInvalidFileException("Invalid or unsupported version in file")
+            fd.seek(0, 2)
+        else:
+            fd.write(sapcar_archive_header.pack(SAPCAR_HEADER_MAGIC_STRING_STANDARD, self.version.encode()))
+
+    def add_file(self, filename, archive_filename=None):
+        """Adds a file or directory from the local file system to the archive.
+
+        :param filename: name of the file to add
+        :type filename: string
+
+        :param archive_filename: name of the file to use in the archive
+        :type archive_filename: string
+
+        :raise CompressError: If there's a compression error
+        :raise SAPCARInvalidFileException: If the file length changed while adding it
+        """
+        if archive_filename is None:
+            archive_filename = filename
+        file_stat = os_stat(filename)
+        if stat.S_ISDIR(file_stat.st_mode):
+            self.add_directory(archive_filename, file_stat.st_mode, int(file_stat.st_mtime))
+        else:
+            with open(filename, "rb") as fd:
+                self.add_fileobj(fd, archive_filename, file_stat.st_size, file_stat.st_mode,
+                                 int(file_stat.st_mtime))
+
+    def add_files(self, filenames):
+        """Adds several files or directories from the local file system to the archive, in the given order. Files
+        that can't be added are skipped, and their errors reported along with their names.
+
+        :param filenames: names of the files to add and names to use for them in the archive
+        :type filenames: iterable of tuple of strings
+
+        :return: names of the files processed, along with the exception raised if a file couldn't be added
+        :rtype: iterator of tuple
+        """
+        if self.executor is None:
+            for (filename, archive_filename) in filenames:
+                try:
+                    self.add_file(filename, archive_filename)
+                except (IOError, OSError, CompressError, SAPCARInvalidFileException) as e:
+                    yield filename, archive_filename, e
+                else:
+                    yield filename, archive_filename, None
+            return
+
+        # Files are compressed ahead while the previous ones are written. If the iteration is stopped, the
+        # compression of the files still pending is cancelled or stopped.
+        pending = deque()
+        try:
+            for (filename, archive_filename) in filenames:
+                blocks, stop = Queue(self.max_pending_blocks), Event()
+                future = self.executor.submit(self._compress_file, filename, blocks, stop)
+                pending.append((filename, archive_filename or filename, blocks, stop, future))
+                while len(pending) >= self.max_pending:
+                    yield self._write_compressed_file(*pending.popleft())
+            while pending:
+                yield self._write_compressed_file(*pending.popleft())
+        finally:
+            for (_, _, blocks, stop, future) in pending:
+                if not future.cancel():
+                    self._stop_compression(blocks, stop)
+
+    def add_directory(self, archive_filename, perm_mode=stat.S_IFDIR | 0o755, timestamp=None):
+        """Adds a directory entry to the archive.
+
+        :param archive_filename: name of the directory to use in the archive
+        :type archive_filename: string
+
+        :param perm_mode: permissions of the directory
+        :type perm_mode: int
+
+        :param timestamp: timestamp of the directory, defaults to the current time
+        :type timestamp: int
+        """
+        self._write_header(SAPCAR_TYPE_DIR, perm_mode, 0, timestamp, archive_filename)
+
+    def add_fileobj(self, fd, archive_filename, file_length, perm_mode=stat.S_IFREG | 0o644, timestamp=None):
+        """Adds the content of a file object to the archive. The content is read and compressed in chunks, and
+        written to the archive as each block of compressed data is filled.
+
+        If the archive file object is seekable, the archive is truncated to its previous length when the file
+        can't be added, so it doesn't contain a partial entry.
+
+        :param fd: file object to read the content from
+        :type fd: file
+
+        :param archive_filename: name of the file to use in the archive
+        :type archive_filename: string
+
+        :param file_length: length of the content to read from the file object
+        :type file_length: int
+
+        :param perm_mode: permissions of the file
+        :type perm_mode: int
+
+        :param timestamp: timestamp of the file, defaults to the current time
+        :type timestamp: int
+
+        :raise CompressError: If there's a compression error
+        :raise SAPCARInvalidFileException: If the length of the content doesn't match the one provided
+        """
+        self._write_file(archive_filename, perm_mode, file_length, timestamp,
+                         sapcar_compress_blocks(fd, file_length, self.block_size))
+
+    def flush(self):
+        """Flushes the archive file object.
+        """
+        self.fd.flush()
+
+    def _compress_file(self, filename, blocks, stop):
+        """Compresses a file from the local file system, putting its status and compressed blocks in a queue, and
+        finally None or the exception raised. Used by the executor when adding several files.
+        """
+        try:
+            file_stat = os_stat(filename)
+            blocks.put(file_stat)
+            if not stat.S_ISDIR(file_stat.st_mode):
+                with open(filename, "rb") as fd:
+                    for block in sapcar_compress_blocks(fd, file_stat.st_size, self.block_size):
+                        if stop.is_set():
+                            return
+                        blocks.put(block)
+            blocks.put(None)
+        except Exception as e:
+            blocks.put(e)
+
+    @staticmethod
+    def _stop_compression(blocks, stop):
+        """Stops the compression of a file, unblocking the worker if it's waiting for room in the queue.
+        """
+        stop.set()
+        while not blocks.empty():
+            blocks.get_nowait()
+
+    def _write_compressed_file(self, filename, archive_filename, blocks, stop, future):
+        """Writes a file compressed by the executor as its blocks are available.
+
+        :return: names of the file, along with the exception raised if it couldn't be added
+        """
+        def queued_blocks():
+            block = blocks.get()
+            while block is not None:
+                if isinstance(block, Exception):
+                    raise block
+                yield block
+                block = blocks.get()
+
+        try:
+            file_stat = blocks.get()
+            if isinstance(file_stat, Exception):
+                raise file_stat
+            if stat.S_ISDIR(file_stat.st_mode):
+                self.add_directory(archive_filename, file_stat.st_mode, int(file_stat.st_mtime))
+                blocks.get()
+            else:
+                self._write_file(archive_filename, file_stat.st_mode, file_stat.st_size, int(file_stat.st_mtime),
+                                 queued_blocks())
+        except (IOError, OSError, CompressError, SAPCARInvalidFileException) as e:
+            if not future.done():
+                self._stop_compression(blocks, stop)
+            return filename, archive_filename, e
+        except Exception:
+            self._stop_compression(blocks, stop)
+            raise
+        return filename, archive_filename, None
+
+    def _write_file(self, archive_filename, perm_mode, file_length, timestamp, blocks):
+        """Writes a file entry with its compressed blocks. If the archive file object is seekable, the archive is
+        truncated to its previous length when the blocks can't be obtained.
+        """
+        offset = self.fd.tell() if getattr(self.fd, "seekable", None) and self.fd.seekable() else None
+        try:
+            self._write_header(SAPCAR_TYPE_FILE, perm_mode, file_length, timestamp, archive_filename)
+            for (block_type, data, checksum) in blocks:
+                self.fd.write(sapcar_block_header.pack(block_type, len(data)))
+                self.fd.write(data)
+                if checksum is not None:
+                    self.fd.write(sapcar_block_checksum.pack(checksum))
+        except (IOError, OSError, CompressError, SAPCARInvalidFileException):
+            if offset is not None:
+                self.fd.seek(offset)
+                self.fd.truncate()
+            raise
+
+    def _write_header(self, file_type, perm_mode, file_length, timestamp, archive_filename):
+        """Writes the header of a file entry. The file length is split in the low and high length fields, so
+        files over 4GB are supported.
+        """
+        if timestamp is None:
+            timestamp = int(time())
+        filename = archive_filename.encode("utf-8")
+        if self.version == SAPCAR_VERSION_201:
+            filename += b"\x00"
+        self.fd.write(sapcar_file_header.pack(file_type, perm_mode, file_length & 0xffffffff, file_length >> 32,
+                                              timestamp, 0, 0, len(filename)))
+        self.fd.write(filename)
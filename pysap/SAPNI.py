@@ -17,11 +17,18 @@
 #
 
 # Standard imports
+import os
 import sys
+import signal
+import asyncio
 import logging
+import selectors
+from collections import deque
 from select import select
-from struct import unpack
-from threading import Event
+from time import monotonic, sleep
+from struct import pack, unpack_from
+from threading import Event, Lock, Thread, current_thread, main_thread
+from concurrent.futures import ThreadPoolExecutor
 from socketserver import BaseRequestHandler, ThreadingMixIn, TCPServer
 # External imports
 from scapy.fields import LenField
@@ -29,6 +36,11 @@ from scapy.packet import Packet, Raw
 from scapy.supersocket import socket, StreamSocket
 # Custom imports
 from pysap.utils import Worker
+# Try to import OS-dependent modules
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 # Create a logger for the SAPNI layer
@@ -67,14 +79,283 @@ class SAPNI(Packet):
         :type: C{string} """
 
 
+class SAPNIHistogram(object):
+    """Latency histogram with logarithmic buckets
+
+    Values are recorded in microseconds in buckets that are linear within
+    each power of two, in the style of HDR histograms. It keeps a bounded
+    relative error (1/16 with the default precision) with a small number of
+    buckets, and recording a value takes constant time.
+    """
+
+    def __init__(self, precision=4):
+        """Initializes the histogram.
+
+        :param precision: number of bits of linear sub-buckets for each power
+            of two
+        :type precision: ``int``
+        """
+        self.precision = precision
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        """Returns the bucket index of a value in microseconds."""
+        shift = value.bit_length() - self.precision - 1
+        if shift <= 0:
+            return value
+        return ((shift + 1) << self.precision) + (value >> shift) - (1 << self.precision)
+
+    def _bucket_bounds(self, bucket):
+        """Returns the lowest and highest values in microseconds of a bucket."""
+        sub_buckets = 1 << self.precision
+        if bucket < 2 * sub_buckets:
+            return bucket, bucket
+        shift = (bucket >> self.precision) - 1
+        mantissa = (bucket & (sub_buckets - 1)) + sub_buckets
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        """Records a value.
+
+        :param value: value in seconds
+        :type value: ``float``
+        """
+        bucket = self._bucket(max(0, int(value * 1000000)))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """Returns the value at the given percentile, as the highest value of
+        the bucket where it falls.
+
+        :param percentile: percentile between 0 and 100
+        :type percentile: ``float``
+
+        :return: value in seconds, or None if no values were recorded
+        :rtype: ``float``
+        """
+        if not self.count:
+            return None
+        target = max(1, percentile * self.count / 100.0)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= target:
+                return min(self._bucket_bounds(bucket)[1] / 1000000.0, self.max)
+        return self.max
+
+    def buckets(self):
+        """Returns the cumulative count of values for each non-empty bucket.
+
+        :return: list of (upper bound in seconds, cumulative count)
+        :rtype: ``list``
+        """
+        result = []
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            result.append(((self._bucket_bounds(bucket)[1] + 1) / 1000000.0, seen))
+        return result
+
+    def snapshot(self):
+        """Returns a summary of the recorded values.
+
+        :rtype: ``dict``
+        """
+        return {"count": self.count,
+                "sum": self.total,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "p999": self.percentile(99.9)}
+
+
+class SAPNIMetrics(object):
+    """Traffic and latency metrics of a :class:`SAPNIStreamSocket`
+
+    Counters are updated by the socket on each send and receive call, and
+    latencies are recorded for :class:`SAPNIStreamSocket.sr` calls and for
+    keep-alive requests sent by a :class:`SAPNIKeepAliveScheduler`.
+    """
+
+    counters = ("bytes_sent", "bytes_received", "frames_sent", "frames_received",
+                "pings_sent", "pings_received", "pongs_sent", "pongs_received")
+    """ :cvar: Names of the counters
+        :type: ``tuple`` """
+
+    histograms = ("sr_latency", "keepalive_rtt")
+    """ :cvar: Names of the latency histograms
+        :type: ``tuple`` """
+
+    def __init__(self):
+        for name in self.counters:
+            setattr(self, name, 0)
+        for name in self.histograms:
+            setattr(self, name, SAPNIHistogram())
+
+    def snapshot(self):
+        """Returns the current value of the counters and a summary of the
+        latency histograms.
+
+        :rtype: ``dict``
+        """
+        result = {name: getattr(self, name) for name in self.counters}
+        for name in self.histograms:
+            result[name] = getattr(self, name).snapshot()
+        return result
+
+    def to_prometheus(self, prefix="pysap_ni", labels=None):
+        """Exports the metrics in the Prometheus text exposition format.
+
+        :param prefix: prefix for the metric names
+        :type prefix: C{string}
+
+        :param labels: labels to add to each sample, e.g. to tell apart the
+            metrics of different sockets
+        :type labels: ``dict``
+
+        :return: metrics in Prometheus text format
+        :rtype: C{string}
+        """
+        def format_labels(extra=None):
+            items = list((labels or {}).items()) + list((extra or {}).items())
+            if not items:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                                     for key, value in items)
+
+        lines = []
+        for name in self.counters:
+            metric = "%s_%s_total" % (prefix, name)
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s%s %d" % (metric, format_labels(), getattr(self, name)))
+        for name in self.histograms:
+            histogram = getattr(self, name)
+            metric = "%s_%s_seconds" % (prefix, name)
+            lines.append("# TYPE %s histogram" % metric)
+            for upper, count in histogram.buckets():
+                lines.append("%s_bucket%s %d" % (metric, format_labels({"le": repr(upper)}), count))
+            lines.append("%s_bucket%s %d" % (metric, format_labels({"le": "+Inf"}), histogram.count))
+            lines.append("%s_sum%s %r" % (metric, format_labels(), histogram.total))
+            lines.append("%s_count%s %d" % (metric, format_labels(), histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+class SAPNIFrame(object):
+    """Lazily dissected NI frame
+
+    Holds the raw data of a received NI frame, including the length field.
+    The frame is dissected as a :class:`SAPNI` packet only when one of the
+    packet's fields or layers is accessed, so frames that are only forwarded
+    are never dissected and can be sent as they were received.
+    """
+
+    __slots__ = ("data", "basecls", "_packet")
+
+    def __init__(self, data, base_cls=None):
+        """Initializes the frame.
+
+        :param data: raw frame data, including the NI length field
+        :type data: ``bytes``
+
+        :param base_cls: the base class to use when dissecting the payload
+        :type base_cls: :class:`Packet` class
+        """
+        self.data = data
+        self.basecls = base_cls
+        self._packet = None
+
+    @property
+    def length(self):
+        """Length of the payload as found in the NI length field."""
+        return unpack_from("!I", self.data)[0]
+
+    @property
+    def load(self):
+        """Raw payload of the frame, without the NI length field."""
+        return self.data[4:]
+
+    @property
+    def dissected(self):
+        """If the frame was already dissected."""
+        return self._packet is not None
+
+    @property
+    def packet(self):
+        """The frame dissected as a :class:`SAPNI` packet.
+
+        :rtype: :class:`SAPNI`
+        """
+        if self._packet is None:
+            self._packet = SAPNI(self.data)
+            if self.basecls:
+                self._packet.decode_payload_as(self.basecls)
+        return self._packet
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, which for special names and the
+        # frame's own slots (e.g. while copying or unpickling, before they're
+        # set) shouldn't be looked up in the packet
+        if name in self.__slots__ or (name.startswith("__") and name.endswith("__")):
+            raise AttributeError(name)
+        return getattr(self.packet, name)
+
+    def __getitem__(self, cls):
+        return self.packet[cls]
+
+    def __contains__(self, cls):
+        return cls in self.packet
+
+    def __truediv__(self, other):
+        return self.packet / other
+
+    def __bytes__(self):
+        # Once dissected the packet might have been modified, so it's built
+        # again to get an updated length field
+        if self._packet is not None:
+            return bytes(SAPNI() / self._packet.payload)
+        return self.data
+
+    def __len__(self):
+        return len(bytes(self))
+
+    def __repr__(self):
+        if self._packet is not None:
+            return repr(self._packet)
+        return "<SAPNIFrame length=%d>" % self.length
+
+
 class SAPNIStreamSocket(StreamSocket):
     """Stream socket implementation of the SAP Network Interface (NI) layer.
 
+    Received data is read into a per-socket buffer, so a single read from the
+    underlying socket can provide several pipelined NI frames. Frames are
+    sliced out of that buffer without additional copies.
     """
 
     desc = "NI Stream socket"
 
-    def __init__(self, sock, keep_alive=True, base_cls=None):
+    recv_buffer_size = 65536
+    """ :cvar: Initial size of the receive buffer, grown if a larger frame arrives
+        :type: ``int`` """
+
+    sendmsg_max_buffers = 1024
+    """ :cvar: Maximum number of buffers written in a single `sendmsg` call, as
+        limited by the system's IOV_MAX
+        :type: ``int`` """
+
+    def __init__(self, sock, keep_alive=True, base_cls=None, lazy=False):
         """Initializes the NI stream socket.
 
         :param sock: socket to wrap
@@ -88,20 +369,193 @@ class SAPNIStreamSocket(StreamSocket):
         :param base_cls: the base class to use when receiving packets, it uses
             :class:`SAPNI` as default if no class specified
         :type base_cls: :class:`Packet` class
+
+        :param lazy: if true, :class:`recv` returns :class:`SAPNIFrame` objects
+            that are dissected only when accessed
+        :type lazy: ``bool``
         """
         StreamSocket.__init__(self, sock, Raw)
         self.keep_alive = keep_alive
         self.basecls = base_cls
+        self.lazy = lazy
+        self._recv_buffer = bytearray(self.recv_buffer_size)
+        self._recv_start = 0
+        self._recv_end = 0
+        self._send_lock = Lock()
+        self.keep_alive_scheduler = None
+        self.last_activity = self.last_received = monotonic()
+        self.metrics = SAPNIMetrics()
 
     def send(self, packet):
-        """Send a packet at the NI layer, prepending the length field.
+        """Send a packet at the NI layer, prepending the length field. Frames
+        obtained in lazy mode already include it and are sent as they are.
 
         :param packet: packet to send
-        :type packet: Packet
+        :type packet: Packet or :class:`SAPNIFrame`
         """
-        # Add the NI layer and send
-        log_sapni.debug("To send %d bytes data + 4 bytes NI header", len(packet))
-        return StreamSocket.send(self, SAPNI() / packet)
+        if isinstance(packet, SAPNIFrame):
+            data = bytes(packet)
+            log_sapni.debug("To send %d bytes NI frame", len(data))
+        else:
+            # Add the NI layer and send
+            log_sapni.debug("To send %d bytes data + 4 bytes NI header", len(packet))
+            data = bytes(SAPNI() / packet)
+        # The lock prevents frames sent by a keep-alive scheduler from being
+        # interleaved with the ones sent by the thread owning the socket
+        with self._send_lock:
+            return self._send_frame(data)
+
+    def _send_frame(self, data):
+        """Sends a NI frame, with the send lock already held."""
+        sent = self.outs.send(data)
+        self.last_activity = monotonic()
+        self.metrics.frames_sent += 1
+        self.metrics.bytes_sent += sent
+        return sent
+
+    def send_many(self, packets):
+        """Send several packets at the NI layer, prepending the length field to
+        each one of them and writing all the frames with a single scatter-gather
+        call to the underlying socket when possible.
+
+        :param packets: packets to send, either as Packet or already serialized
+            payloads as ``bytes`` or ``memoryview``
+        :type packets: ``list``
+
+        :return: number of bytes sent, including the NI headers
+        :rtype: ``int``
+        """
+        buffers = []
+        for packet in packets:
+            if isinstance(packet, memoryview):
+                packet = packet.cast("B")
+            elif not isinstance(packet, (bytes, bytearray)):
+                packet = bytes(packet)
+            buffers.append(pack("!I", len(packet)))
+            buffers.append(packet)
+        log_sapni.debug("To send %d frames in a single batch", len(buffers) // 2)
+
+        with self._send_lock:
+            sent = self._sendmsg_all(self.outs, buffers)
+        self.last_activity = monotonic()
+        self.metrics.frames_sent += len(buffers) // 2
+        self.metrics.bytes_sent += sent
+        return sent
+
+    @classmethod
+    def _sendmsg_all(cls, sock, buffers):
+        """Writes all the buffers to the socket, using `sendmsg` and handling
+        partial writes. Falls back to a single `sendall` call if `sendmsg` is
+        not available on the platform.
+        """
+        total = sum(len(buf) for buf in buffers)
+        if not hasattr(sock, "sendmsg"):
+            sock.sendall(b"".join(buffers))
+            return total
+
+        index = 0
+        while index < len(buffers):
+            sent = sock.sendmsg(buffers[index:index + cls.sendmsg_max_buffers])
+            # Skip the buffers completely written, and keep the remaining part
+            # of the one partially written
+            while index < len(buffers):
+                buf = buffers[index]
+                if sent < len(buf):
+                    if sent:
+                        buffers[index] = memoryview(buf)[sent:]
+                    break
+                sent -= len(buf)
+                index += 1
+        return total
+
+    def _buffered_frame_length(self):
+        """Returns the length of the NI frame (header + payload) at the start of
+        the receive buffer, or None if not even the header was received yet.
+        """
+        if self._recv_end - self._recv_start < 4:
+            return None
+        (nilength, ) = unpack_from("!I", self._recv_buffer, self._recv_start)
+        return nilength + 4
+
+    def _fill_buffer(self, frame_length):
+        """Reads from the underlying socket into the free space of the receive
+        buffer. The buffered data is moved to the start of the buffer, or to a
+        new larger buffer if the frame being received doesn't fit on it.
+
+        :param frame_length: length of the frame being received, if known
+        :type frame_length: ``int``
+
+        :raise socket.error: if the connection was closed
+        """
+        buffered = self._recv_end - self._recv_start
+        required = max(frame_length or 4, buffered + 1)
+        if required > len(self._recv_buffer):
+            # Allocate a new buffer instead of resizing, as frames previously
+            # returned might still be referencing the old one
+            new_buffer = bytearray(max(required, len(self._recv_buffer) * 2))
+            new_buffer[:buffered] = self._recv_buffer[self._recv_start:self._recv_end]
+            self._recv_buffer = new_buffer
+            self._recv_start, self._recv_end = 0, buffered
+        elif self._recv_start and self._recv_start + required > len(self._recv_buffer):
+            self._recv_buffer[:buffered] = self._recv_buffer[self._recv_start:self._recv_end]
+            self._recv_start, self._recv_end = 0, buffered
+
+        with memoryview(self._recv_buffer) as view:
+            received = self.ins.recv_into(view[self._recv_end:])
+        if received == 0:
+            raise socket.error((100, "Underlying stream socket tore down"))
+        self._recv_end += received
+        self.last_activity = self.last_received = monotonic()
+        self.metrics.bytes_received += received
+
+    def has_pending_frame(self):
+        """Returns if a complete NI frame was already received and is waiting
+        in the receive buffer. As the data is no longer in the underlying
+        socket, callers polling with `select` should check this first.
+
+        :return: if there's a complete frame in the receive buffer
+        :rtype: ``bool``
+        """
+        frame_length = self._buffered_frame_length()
+        return frame_length is not None and self._recv_end - self._recv_start >= frame_length
+
+    def drain_buffer(self):
+        """Returns and discards all the data held in the receive buffer. Used
+        when the NI layer is no longer in use on the connection (e.g. after a
+        route in native talk mode is established) and the plain socket is
+        read directly.
+
+        :return: data in the receive buffer
+        :rtype: ``bytes``
+        """
+        data = bytes(self._recv_buffer[self._recv_start:self._recv_end])
+        self._recv_start = self._recv_end = 0
+        return data
+
+    def recv_frame(self):
+        """Receive a whole NI frame, including the length field, without
+        dissecting it. The frame is returned as a view on the receive buffer
+        and it's only valid until the next receive call on the socket.
+
+        :return: received NI frame
+        :rtype: ``memoryview``
+
+        :raise socket.error: if the connection was closed
+        """
+        frame_length = self._buffered_frame_length()
+        while frame_length is None or self._recv_end - self._recv_start < frame_length:
+            self._fill_buffer(frame_length)
+            if frame_length is None:
+                frame_length = self._buffered_frame_length()
+                if frame_length is not None:
+                    log_sapni.debug("Received 4 bytes NI header, to receive %d bytes data", frame_length - 4)
+
+        frame = memoryview(self._recv_buffer)[self._recv_start:self._recv_start + frame_length]
+        self._recv_start += frame_length
+        self.metrics.frames_received += 1
+        if self._recv_start == self._recv_end:
+            self._recv_start = self._recv_end = 0
+        return frame
 
     def recv(self):
         """Receive a packet at the NI layer, first reading the length field and
@@ -110,39 +564,42 @@ class SAPNIStreamSocket(StreamSocket):
         the receive method will respond with a keep-alive response
         (:class:`NI_PONG<SAPNI.SAPNI_PONG>`) to keep the communication stable.
 
-        :return: received :class:`SAPNI` packet
+        :return: received :class:`SAPNI` packet, or :class:`SAPNIFrame` in lazy mode
         :rtype: :class:`SAPNI`
 
         :raise socket.error: if the connection was close
         """
-        # Receive the NI length field
-        nidata = self.ins.recv(4, socket.MSG_PEEK)
-        if len(nidata) == 0:
-            raise socket.error((100, "Underlying stream socket tore down"))
-        (nilength, ) = unpack("!I", nidata)
-        log_sapni.debug("Received 4 bytes NI header, to receive %d bytes data", nilength)
-
-        # Receive the whole NI packet (length+payload)
-        nidata = b''
-        while len(nidata) < nilength + 4:
-            nidata += self.ins.recv(nilength - len(nidata) + 4)
-            if len(nidata) == 0:
-                raise socket.error((100, "Underlying stream socket tore down"))
-
-        # If the packet received is a keep-alive request (NI_PING), send a
-        # response (NI_PONG) and make a new receive call
-        if nilength == len(SAPNI.SAPNI_PING) and nidata[4:] == SAPNI.SAPNI_PING:
-            log_sapni.debug("Received NI_PING")
-            if self.keep_alive:
-                log_sapni.debug("Keep alive set, sending NI_PONG")
-                self.send(Raw(SAPNI.SAPNI_PONG))
-                return self.recv()
+        while True:
+            nidata = self.recv_frame()
+            nilength = len(nidata) - 4
+
+            # If the packet received is a keep-alive request (NI_PING), send a
+            # response (NI_PONG) and make a new receive call
+            if nilength == len(SAPNI.SAPNI_PING) and nidata[4:] == SAPNI.SAPNI_PING.encode():
+                log_sapni.debug("Received NI_PING")
+                self.metrics.pings_received += 1
+                if self.keep_alive:
+                    log_sapni.debug("Keep alive set, sending NI_PONG")
+                    self.send(Raw(SAPNI.SAPNI_PONG))
+                    self.metrics.pongs_sent += 1
+                    continue
+
+            # If a keep-alive scheduler is waiting for a response (NI_PONG),
+            # hand it over and make a new receive call
+            elif nilength == len(SAPNI.SAPNI_PONG) and nidata[4:] == SAPNI.SAPNI_PONG.encode():
+                log_sapni.debug("Received NI_PONG")
+                self.metrics.pongs_received += 1
+                if self.keep_alive_scheduler and self.keep_alive_scheduler.pong_received(self):
+                    continue
+            break
 
         # Build the SAPNI packet with the received data
         log_sapni.debug("Received %d bytes data", nilength)
+        if self.lazy:
+            return SAPNIFrame(bytes(nidata), self.basecls)
 
         # Decode the packet payload according to the base class defined
-        packet = SAPNI(nidata)
+        packet = SAPNI(bytes(nidata))
         if self.basecls:
             packet.decode_payload_as(self.basecls)
         return packet
@@ -157,8 +614,11 @@ class SAPNIStreamSocket(StreamSocket):
         :return: packet received
         :rtype: Packet
         """
+        start = monotonic()
         self.send(packet)
-        return self.recv()
+        response = self.recv()
+        self.metrics.sr_latency.record(monotonic() - start)
+        return response
 
     @classmethod
     def get_nisocket(cls, host, port, **kwargs):
@@ -181,6 +641,633 @@ class SAPNIStreamSocket(StreamSocket):
         return cls(sock, **kwargs)
 
 
+class SAPNIKeepAliveEntry(object):
+    """Keep-alive state of a socket registered in a :class:`SAPNIKeepAliveScheduler`.
+    """
+
+    __slots__ = ("nisocket", "interval", "callback", "deadline", "rounds",
+                 "ping_sent", "rtt", "cancelled")
+
+    def __init__(self, nisocket, interval, callback):
+        self.nisocket = nisocket
+        self.interval = interval
+        self.callback = callback
+        self.deadline = None
+        self.rounds = 0
+        self.ping_sent = None
+        self.rtt = None
+        self.cancelled = False
+
+
+class SAPNIKeepAliveScheduler(object):
+    """Keep-alive scheduler for idle NI sessions.
+
+    Sends keep-alive requests (:class:`NI_PING<SAPNI.SAPNI_PING>`) on the
+    registered :class:`SAPNIStreamSocket` that were idle for the configured
+    interval, and measures the round-trip time of the keep-alive responses
+    (:class:`NI_PONG<SAPNI.SAPNI_PONG>`). Peers not answering nor sending any
+    other data before the timeout are reported as dead through a callback.
+
+    Sockets are tracked on a hashed timer wheel, so a single thread can serve
+    thousands of them: each tick only visits the sockets whose deadline falls
+    on the current slot. Responses are received by the thread reading from
+    the socket, as :class:`SAPNIStreamSocket.recv` hands them over to the
+    scheduler. Any data received from the peer counts as activity as well.
+    """
+
+    ping_frame = pack("!I", len(SAPNI.SAPNI_PING)) + SAPNI.SAPNI_PING.encode()
+    """ :cvar: Keep-alive request NI frame
+        :type: ``bytes`` """
+
+    def __init__(self, interval=60, timeout=30, tick=1.0, wheel_size=512, callback=None):
+        """Initializes the scheduler.
+
+        :param interval: idle time in seconds after which a keep-alive request
+            is sent
+        :type interval: ``float``
+
+        :param timeout: time in seconds to wait for activity after a keep-alive
+            request before considering the peer dead
+        :type timeout: ``float``
+
+        :param tick: resolution of the timer wheel in seconds
+        :type tick: ``float``
+
+        :param wheel_size: number of slots in the timer wheel
+        :type wheel_size: ``int``
+
+        :param callback: default function called with the socket when a peer is
+            detected dead
+        :type callback: ``callable``
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self.callback = callback
+        self.entries = {}
+        self._wheel = [set() for _ in range(wheel_size)]
+        self._current = 0
+        self._started = monotonic()
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def register(self, nisocket, interval=None, callback=None):
+        """Registers a socket in the scheduler.
+
+        :param nisocket: socket to keep alive
+        :type nisocket: :class:`SAPNIStreamSocket`
+
+        :param interval: idle interval for this socket, the scheduler's one
+            is used if not specified
+        :type interval: ``float``
+
+        :param callback: function called with the socket if the peer is
+            detected dead, the scheduler's one is used if not specified
+        :type callback: ``callable``
+
+        :return: keep-alive state of the socket
+        :rtype: :class:`SAPNIKeepAliveEntry`
+        """
+        entry = SAPNIKeepAliveEntry(nisocket, interval or self.interval, callback or self.callback)
+        with self._lock:
+            previous = self.entries.get(nisocket)
+            if previous:
+                previous.cancelled = True
+            self.entries[nisocket] = entry
+            nisocket.keep_alive_scheduler = self
+            self._schedule(entry, nisocket.last_activity + entry.interval)
+        return entry
+
+    def unregister(self, nisocket):
+        """Removes a socket from the scheduler.
+
+        :param nisocket: socket to remove
+        :type nisocket: :class:`SAPNIStreamSocket`
+        """
+        with self._lock:
+            entry = self.entries.pop(nisocket, None)
+            if entry:
+                # Entries are discarded lazily when their slot is visited
+                entry.cancelled = True
+                nisocket.keep_alive_scheduler = None
+
+    def get_rtt(self, nisocket):
+        """Returns the round-trip time of the last keep-alive request sent to
+        a socket.
+
+        :param nisocket: registered socket
+        :type nisocket: :class:`SAPNIStreamSocket`
+
+        :return: round-trip time in seconds, or None if not yet measured
+        :rtype: ``float``
+        """
+        entry = self.entries.get(nisocket)
+        return entry.rtt if entry else None
+
+    def pong_received(self, nisocket):
+        """Called by the socket when a keep-alive response was received.
+
+        :param nisocket: socket that received the response
+        :type nisocket: :class:`SAPNIStreamSocket`
+
+        :return: if the response was expected by the scheduler
+        :rtype: ``bool``
+        """
+        entry = self.entries.get(nisocket)
+        if entry is None or entry.ping_sent is None:
+            return False
+        entry.rtt = monotonic() - entry.ping_sent
+        entry.ping_sent = None
+        nisocket.metrics.keepalive_rtt.record(entry.rtt)
+        log_sapni.debug("SAPNIKeepAliveScheduler: NI_PONG received, rtt %.6f", entry.rtt)
+        return True
+
+    def _schedule(self, entry, deadline):
+        """Places an entry in the slot of the wheel matching the deadline."""
+        ticks = max(1, int((deadline - self._started) / self.tick + 0.999999) - self._current)
+        entry.deadline = deadline
+        entry.rounds, offset = divmod(ticks, len(self._wheel))
+        if not offset:
+            entry.rounds, offset = entry.rounds - 1, len(self._wheel)
+        self._wheel[(self._current + offset) % len(self._wheel)].add(entry)
+
+    def _expire(self, entry, now, pings):
+        """Handles an entry whose deadline was reached, reporting the peer as
+        dead or adding the entry to the ones a keep-alive request should be
+        sent to. Called with the lock held.
+
+        :return: if the peer was detected dead
+        :rtype: ``bool``
+        """
+        nisocket, ping_sent = entry.nisocket, entry.ping_sent
+        if ping_sent is not None and nisocket.last_received <= ping_sent:
+            if now - ping_sent >= self.timeout:
+                return True
+            self._schedule(entry, ping_sent + self.timeout)
+            return False
+
+        if now - nisocket.last_activity < entry.interval:
+            self._schedule(entry, nisocket.last_activity + entry.interval)
+            return False
+
+        pings.append(entry)
+        return False
+
+    def _ping(self, entry):
+        """Sends a keep-alive request to the peer of an entry. Called without
+        the lock held, as sending might block.
+
+        :return: if the peer was detected dead
+        :rtype: ``bool``
+        """
+        nisocket = entry.nisocket
+        # Don't wait for the thread owning the socket if it's sending data
+        if not nisocket._send_lock.acquire(False):
+            with self._lock:
+                if not entry.cancelled:
+                    self._schedule(entry, monotonic() + self.tick)
+            return False
+
+        try:
+            # The request is marked as sent first, as the response might be
+            # received by the thread owning the socket before send returns
+            log_sapni.debug("SAPNIKeepAliveScheduler: Sending NI_PING")
+            entry.ping_sent = ping_sent = monotonic()
+            nisocket.metrics.pings_sent += 1
+            nisocket._send_frame(self.ping_frame)
+        except (socket.error, OSError, ValueError):
+            return True
+        finally:
+            nisocket._send_lock.release()
+
+        with self._lock:
+            if not entry.cancelled:
+                self._schedule(entry, ping_sent + self.timeout)
+        return False
+
+    def _remove_dead(self, entry):
+        """Removes the entry of a peer detected dead. Called with the lock
+        held."""
+        log_sapni.debug("SAPNIKeepAliveScheduler: Peer detected dead")
+        if self.entries.get(entry.nisocket) is entry:
+            del self.entries[entry.nisocket]
+            entry.nisocket.keep_alive_scheduler = None
+        entry.cancelled = True
+
+    def run_tick(self, now=None):
+        """Advances the wheel one slot, processing the entries whose deadline
+        was reached.
+
+        :param now: current time as returned by `time.monotonic`
+        :type now: ``float``
+        """
+        dead, pings = [], []
+        with self._lock:
+            self._current += 1
+            slot = self._wheel[self._current % len(self._wheel)]
+            due = [entry for entry in slot if not entry.cancelled and entry.rounds == 0]
+            for entry in list(slot):
+                if entry.cancelled:
+                    slot.discard(entry)
+                elif entry.rounds:
+                    entry.rounds -= 1
+            slot.difference_update(due)
+
+            now = now or monotonic()
+            for entry in due:
+                if self._expire(entry, now, pings):
+                    self._remove_dead(entry)
+                    dead.append(entry)
+
+        # Keep-alive requests are sent without holding the lock, so sockets
+        # blocked on send don't stall the registration of other sockets
+        for entry in pings:
+            if not entry.cancelled and self._ping(entry):
+                with self._lock:
+                    if entry.cancelled:
+                        continue
+                    self._remove_dead(entry)
+                dead.append(entry)
+
+        for entry in dead:
+            if entry.callback:
+                entry.callback(entry.nisocket)
+
+    def run(self):
+        """Runs the scheduler until stopped, advancing the wheel at each tick.
+        """
+        next_tick = self._started + (self._current + 1) * self.tick
+        while not self._stopped.is_set():
+            delay = next_tick - monotonic()
+            if delay > 0 and self._stopped.wait(delay):
+                break
+            self.run_tick()
+            next_tick += self.tick
+
+    def start(self):
+        """Starts the scheduler in a background thread.
+        """
+        self._stopped.clear()
+        self._thread = Thread(target=self.run, name="SAPNIKeepAliveScheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the scheduler's background thread.
+        """
+        self._stopped.set()
+        if self._thread and self._thread is not current_thread():
+            self._thread.join()
+        self._thread = None
+
+
+class SAPNIProtocol(asyncio.Protocol):
+    """asyncio protocol implementation of the SAP Network Interface (NI) layer.
+
+    It performs the NI length framing of the data received on the transport
+    and queues complete frames for :class:`SAPNIStream`. Keep-alive requests
+    are answered directly from the protocol when the keep alive flag is set.
+    """
+
+    max_queued_frames = 64
+    """ :cvar: Number of received frames to queue before pausing the transport
+        :type: ``int`` """
+
+    def __init__(self, keep_alive=True):
+        """Initializes the NI protocol.
+
+        :param keep_alive: if true, the protocol will automatically respond to
+            keep-alive request messages. Otherwise, the keep-alive messages
+            are queued as regular frames.
+        :type keep_alive: ``bool``
+        """
+        self.keep_alive = keep_alive
+        self.transport = None
+        self._buffer = bytearray()
+        self._frames = deque()
+        self._frame_waiter = None
+        self._drain_waiter = None
+        self._connection_lost = None
+        self._exception = None
+        self._closed = False
+        self._paused = False
+        self._reading_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._connection_lost = asyncio.get_running_loop().create_future()
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self._exception = exc
+        self._wakeup(self._frame_waiter)
+        self._wakeup(self._drain_waiter)
+        self._wakeup(self._connection_lost)
+
+    def data_received(self, data):
+        """Splits the data received on NI frames and queues them."""
+        self._buffer += data
+        offset = 0
+        while len(self._buffer) - offset >= 4:
+            (nilength, ) = unpack_from("!I", self._buffer, offset)
+            if len(self._buffer) - offset < nilength + 4:
+                break
+            frame = bytes(self._buffer[offset:offset + nilength + 4])
+            offset += nilength + 4
+
+            if self.keep_alive and frame[4:] == SAPNI.SAPNI_PING.encode():
+                log_sapni.debug("SAPNIProtocol: Received NI_PING, sending NI_PONG")
+                self.transport.write(pack("!I", len(SAPNI.SAPNI_PONG)) + SAPNI.SAPNI_PONG.encode())
+                continue
+            self._frames.append(frame)
+        if offset:
+            del self._buffer[:offset]
+
+        if len(self._frames) >= self.max_queued_frames and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+        if self._frames:
+            self._wakeup(self._frame_waiter)
+
+    def eof_received(self):
+        self._closed = True
+        self._wakeup(self._frame_waiter)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wakeup(self._drain_waiter)
+
+    @staticmethod
+    def _wakeup(waiter):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def recv_frame(self):
+        """Waits for a complete NI frame, including the length field.
+
+        :return: received NI frame
+        :rtype: ``bytes``
+
+        :raise socket.error: if the connection was closed
+        """
+        while not self._frames:
+            if self._closed:
+                raise socket.error((100, "Underlying stream socket tore down")) from self._exception
+            self._frame_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._frame_waiter
+            finally:
+                self._frame_waiter = None
+
+        frame = self._frames.popleft()
+        if self._reading_paused and len(self._frames) < self.max_queued_frames // 2:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        return frame
+
+    async def drain(self):
+        """Waits until the transport write buffer is flushed below its high
+        water mark.
+
+        :raise socket.error: if the connection was closed
+        """
+        if self._closed:
+            raise socket.error((100, "Underlying stream socket tore down")) from self._exception
+        if not self._paused:
+            return
+        self._drain_waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self._drain_waiter
+        finally:
+            self._drain_waiter = None
+
+
+class SAPNIStream(object):
+    """asyncio stream of the SAP Network Interface (NI) layer. It provides
+    the same interface as :class:`SAPNIStreamSocket` with coroutines, so a
+    single event loop can handle a large amount of NI connections.
+
+    Example usage::
+        stream = await open_ni_connection(host, port, base_cls=SAPRouter)
+        response = await stream.sr(packet)
+        stream.close()
+        await stream.wait_closed()
+    """
+
+    desc = "NI asyncio stream"
+
+    def __init__(self, transport, protocol, base_cls=None):
+        """Initializes the NI stream.
+
+        :param transport: transport connected with the remote peer
+        :type transport: :class:`asyncio.Transport`
+
+        :param protocol: NI protocol instance handling the transport
+        :type protocol: :class:`SAPNIProtocol`
+
+        :param base_cls: the base class to use when receiving packets, it uses
+            :class:`SAPNI` as default if no class specified
+        :type base_cls: :class:`Packet` class
+        """
+        self.transport = transport
+        self.protocol = protocol
+        self.basecls = base_cls
+
+    @property
+    def keep_alive(self):
+        """If the stream automatically responds to keep-alive requests."""
+        return self.protocol.keep_alive
+
+    def send(self, packet):
+        """Send a packet at the NI layer, prepending the length field. The data
+        is buffered on the transport, use :class:`drain` for flow control.
+
+        :param packet: packet to send
+        :type packet: Packet
+        """
+        log_sapni.debug("To send %d bytes data + 4 bytes NI header", len(packet))
+        self.transport.write(bytes(SAPNI() / packet))
+
+    async def drain(self):
+        """Waits until it's appropriate to resume writing to the stream."""
+        await self.protocol.drain()
+
+    async def recv_frame(self):
+        """Receive a whole NI frame, including the length field, without
+        dissecting it.
+
+        :return: received NI frame
+        :rtype: ``bytes``
+
+        :raise socket.error: if the connection was closed
+        """
+        return await self.protocol.recv_frame()
+
+    async def recv(self):
+        """Receive a packet at the NI layer.
+
+        :return: received :class:`SAPNI` packet
+        :rtype: :class:`SAPNI`
+
+        :raise socket.error: if the connection was closed
+        """
+        nidata = await self.protocol.recv_frame()
+        log_sapni.debug("Received %d bytes data", len(nidata) - 4)
+
+        # Decode the packet payload according to the base class defined
+        packet = SAPNI(nidata)
+        if self.basecls:
+            packet.decode_payload_as(self.basecls)
+        return packet
+
+    async def sr(self, packet):
+        """Send a given packet and receive the response.
+
+        :param packet: packet to send
+        :type packet: Packet
+
+        :return: packet received
+        :rtype: Packet
+        """
+        self.send(packet)
+        await self.drain()
+        return await self.recv()
+
+    def close(self):
+        """Close the underlying transport."""
+        self.transport.close()
+
+    async def wait_closed(self):
+        """Waits until the underlying transport is closed."""
+        await self.protocol._connection_lost
+
+
+async def open_ni_connection(host, port, keep_alive=True, base_cls=None, **kwargs):
+    """Helper coroutine to obtain a :class:`SAPNIStream`. It's the asyncio
+    counterpart of :class:`SAPNIStreamSocket.get_nisocket`.
+
+    :param host: host to connect to
+    :type host: C{string}
+
+    :param port: port to connect to
+    :type port: ``int``
+
+    :param keep_alive: if true, the stream will automatically respond to
+        keep-alive request messages
+    :type keep_alive: ``bool``
+
+    :param base_cls: the base class to use when receiving packets
+    :type base_cls: :class:`Packet` class
+
+    :keyword kwargs: arguments to pass to the loop's `create_connection`
+
+    :return: connected stream
+    :rtype: :class:`SAPNIStream`
+
+    :raise socket.error: if the connection to the target host/port failed
+    """
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_connection(lambda: SAPNIProtocol(keep_alive),
+                                                       host, port, **kwargs)
+    return SAPNIStream(transport, protocol, base_cls)
+
+
+class SAPNIForwarder(object):
+    """Moves data from one socket to another one without dissecting it. It
+    uses `os.splice` through a pipe where available, so the data is never
+    copied into user space, and falls back to copying it through a large
+    reusable buffer.
+    """
+
+    buffer_size = 256 * 1024
+    """ :cvar: Size of the pipe or buffer used to move the data
+        :type: ``int`` """
+
+    use_splice = hasattr(os, "splice")
+    """ :cvar: If the data should be moved using `os.splice`
+        :type: ``bool`` """
+
+    def __init__(self, source, destination, data=b""):
+        """
+        :param source: socket to read data from
+        :type source: C{socket}
+
+        :param destination: socket to write data to
+        :type destination: C{socket}
+
+        :param data: data already received from the source, to be sent before
+            reading new data
+        :type data: ``bytes``
+        """
+        self.source = source
+        self.destination = destination
+        self._head = bytearray(data)
+        self._pending = 0
+        self._pipe = None
+        self._buffer = None
+        if self.use_splice:
+            self._pipe = os.pipe()
+            if hasattr(fcntl, "F_SETPIPE_SZ"):
+                try:
+                    fcntl.fcntl(self._pipe[1], fcntl.F_SETPIPE_SZ, self.buffer_size)
+                except OSError:
+                    pass
+        else:
+            self._buffer = memoryview(bytearray(self.buffer_size))
+            self._start = 0
+
+    @property
+    def pending(self):
+        """Amount of data read from the source and not yet written."""
+        return len(self._head) + self._pending
+
+    def read(self):
+        """Reads the data available on the source socket.
+
+        :return: amount of data read, 0 if the source socket was closed
+        :rtype: ``int``
+        """
+        if self._pipe:
+            received = os.splice(self.source.fileno(), self._pipe[1], self.buffer_size - self._pending,
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        else:
+            if not self._pending:
+                self._start = 0
+            received = self.source.recv_into(self._buffer[self._start + self._pending:])
+        self._pending += received
+        return received
+
+    def write(self):
+        """Writes the pending data to the destination socket.
+
+        :return: amount of data written
+        :rtype: ``int``
+        """
+        if self._head:
+            sent = self.destination.send(self._head)
+            del self._head[:sent]
+            return sent
+        if self._pipe:
+            sent = os.splice(self._pipe[0], self.destination.fileno(), self._pending,
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        else:
+            sent = self.destination.send(self._buffer[self._start:self._start + self._pending])
+            self._start += sent
+        self._pending -= sent
+        return sent
+
+    def close(self):
+        """Closes the pipe used to move the data."""
+        if self._pipe:
+            os.close(self._pipe[0])
+            os.close(self._pipe[1])
+            self._pipe = None
+
+
 class SAPNIProxy(object):
     """SAP NI Proxy
 
@@ -190,10 +1277,30 @@ class SAPNIProxy(object):
     Example usage::
         proxy = SAPNIProxy(local_host, local_port, remote_host, remote_port, handler_class)
         proxy.handle_connection()
+
+    Or to serve all the clients from a single thread::
+        proxy.serve_forever()
     """
 
+    max_buffer_size = 1024 * 1024
+    """ :cvar: Amount of data pending to be sent to a peer after which the
+        event loop stops reading from the other peer
+        :type: ``int`` """
+
+    blocking_connect = False
+    """ :cvar: Whether connecting to the remote host blocks, in which case the
+        event loop connects from a pool of threads and registers the clients
+        once connected
+        :type: ``bool`` """
+
+    connect_workers = 4
+    """ :cvar: Number of threads used to connect to the remote host when
+        connecting blocks
+        :type: ``int`` """
+
     def __init__(self, bind_address, bind_port, remote_address, remote_port,
-                 handler, backlog=5, keep_alive=True, options=None):
+                 handler, backlog=5, keep_alive=True, options=None, passthrough=False,
+                 lazy=False):
         """Create the proxy binding a socket in the giving port and setting the
         handler for the incoming connections.
 
@@ -222,11 +1329,23 @@ class SAPNIProxy(object):
 
         :param options: options to pass to the handler instance
         :type options: ``dict``
+
+        :param passthrough: if true and the handler doesn't process the
+            packets, data is forwarded between the peers without dissecting
+            it. Keep-alive messages are then forwarded as well.
+        :type passthrough: ``bool``
+
+        :param lazy: if true, packets are passed to the handler as
+            :class:`SAPNIFrame` objects, dissected only if the handler accesses
+            them, and forwarded untouched otherwise
+        :type lazy: ``bool``
         """
         self.remote_host = (remote_address, remote_port)
         self.handler = handler
         self.keep_alive = keep_alive
         self.options = options
+        self.passthrough = passthrough and handler.can_passthrough()
+        self.lazy = lazy
 
         # Create and bind the listener socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -237,6 +1356,14 @@ class SAPNIProxy(object):
         # Create the NI Stream Socket
         self.listener = SAPNIStreamSocket(sock, keep_alive)
 
+        self.connections = set()
+        self._selector = None
+        self._stopped = Event()
+        self._executor = None
+        self._connecting = set()
+        self._connected = deque()
+        self._connected_lock = Lock()
+
         log_sapni.debug("SAPNIProxy: Binded to address %s:%d, proxying to %s:%d",
                         bind_address, bind_port, remote_address, remote_port)
 
@@ -255,26 +1382,350 @@ class SAPNIProxy(object):
         remote.connect(self.remote_host)
 
         # Create the NI Stream Socket and handle it
-        proxy = self.handler(SAPNIStreamSocket(client, self.keep_alive),
-                             SAPNIStreamSocket(remote, self.keep_alive),
-                             self.options)
+        proxy = self.handler(SAPNIStreamSocket(client, self.keep_alive, lazy=self.lazy),
+                             SAPNIStreamSocket(remote, self.keep_alive, lazy=self.lazy),
+                             self.options, passthrough=self.passthrough)
 
         log_sapni.debug("SAPNIProxy: Handled a connection from %s", address)
         return proxy
 
+    def serve_forever(self):
+        """Serve clients until :class:`stop` is called, using a single thread
+        and an event loop based on the `selectors` module instead of a thread
+        per client. Handlers are created for each client but their processor
+        threads are not started, the event loop calls the `process_client` and
+        `process_server` methods instead. When one peer is slower than the
+        other one, reading from the faster peer is paused until the data
+        pending to be sent goes below :class:`max_buffer_size`.
+        """
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._stopped.clear()
+        self.connections = set()
+        if self.blocking_connect:
+            self._executor = ThreadPoolExecutor(max_workers=self.connect_workers)
+
+        self.listener.ins.setblocking(False)
+        self._selector.register(self.listener.ins, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        log_sapni.debug("SAPNIProxy: Serving connections on the event loop")
+        try:
+            while not self._stopped.is_set():
+                for key, events in self._selector.select():
+                    if key.fileobj is self.listener.ins:
+                        self._accept_connections()
+                    elif key.fileobj is self._wakeup_recv:
+                        self._wakeup_recv.recv(1024)
+                        self._register_connected()
+                    else:
+                        (connection, local) = key.data
+                        if events & selectors.EVENT_WRITE:
+                            self._handle_writable(connection, local)
+                        if events & selectors.EVENT_READ and not connection.closed:
+                            self._handle_readable(connection, local)
+        finally:
+            if self._executor is not None:
+                # Clients still connecting are closed once connected
+                with self._connected_lock:
+                    executor, self._executor = self._executor, None
+                    connecting = list(self._connecting)
+                    for (client, remote) in self._connected:
+                        client.close()
+                        remote.close()
+                    self._connected.clear()
+                for future in connecting:
+                    future.cancel()
+                executor.shutdown(wait=False)
+            for connection in list(self.connections):
+                self._close_connection(connection)
+            self._selector.close()
+            self._wakeup_recv.close()
+            self._wakeup_send.close()
+            self._selector = None
+
+    def _connect_remote(self):
+        """Starts a non-blocking connection with the remote host.
+
+        :return: socket connecting to the remote host
+        :rtype: :class:`SAPNIStreamSocket`
+        """
+        remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        remote.setblocking(False)
+        remote.connect_ex(self.remote_host)
+        return SAPNIStreamSocket(remote, self.keep_alive, lazy=self.lazy)
+
+    def _accept_connections(self):
+        """Accepts all the clients pending on the listener and registers them
+        along with the connections to the remote host in the event loop.
+        """
+        while True:
+            try:
+                (client, address) = self.listener.ins.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client.setblocking(False)
+            log_sapni.debug("SAPNIProxy: Accepted a connection from %s", address)
+            if self._executor is not None:
+                future = self._executor.submit(self._connect_remote)
+                with self._connected_lock:
+                    self._connecting.add(future)
+                future.add_done_callback(lambda future, client=client: self._connect_done(client, future))
+                continue
+            try:
+                remote = self._connect_remote()
+            except Exception:
+                log_sapni.exception("SAPNIProxy: Error connecting to the remote host")
+                client.close()
+                continue
+            self._register_connection(client, remote)
+
+    def _connect_done(self, client, future):
+        """Queues a client connected to the remote host by the pool of threads
+        and wakes up the event loop to register it.
+        """
+        with self._connected_lock:
+            self._connecting.discard(future)
+        if future.cancelled():
+            client.close()
+            return
+        try:
+            remote = future.result()
+        except Exception:
+            log_sapni.exception("SAPNIProxy: Error connecting to the remote host")
+            client.close()
+            return
+        with self._connected_lock:
+            if self._executor is None:
+                client.close()
+                remote.close()
+                return
+            self._connected.append((client, remote))
+            try:
+                self._wakeup_send.send(b"\x00")
+            except socket.error:
+                pass
+
+    def _register_connected(self):
+        """Registers in the event loop the clients connected to the remote
+        host by the pool of threads.
+        """
+        with self._connected_lock:
+            connected = list(self._connected)
+            self._connected.clear()
+        for (client, remote) in connected:
+            self._register_connection(client, remote)
+
+    def _register_connection(self, client, remote):
+        """Creates the handler for a client and registers the connection in
+        the event loop.
+        """
+        handler = self.handler(SAPNIStreamSocket(client, self.keep_alive, lazy=self.lazy), remote,
+                               self.options, threaded=False, passthrough=self.passthrough)
+        connection = SAPNIProxyConnection(handler)
+        self.connections.add(connection)
+        self._update_events(connection)
+
+    def _read_packets(self, connection, local):
+        """Reads the data available on the local socket and returns the NI
+        packets completely received. Keep-alive requests are answered and not
+        passed to the handler if the proxy handles keep-alive.
+
+        :return: packets received
+        :rtype: ``list`` of :class:`SAPNI` or :class:`SAPNIFrame`
+        """
+        local._fill_buffer(local._buffered_frame_length())
+        packets = []
+        while local.has_pending_frame():
+            nidata = local.recv_frame()
+            if self.keep_alive and len(nidata) == len(SAPNI.SAPNI_PING) + 4 and \
+                    nidata[4:] == SAPNI.SAPNI_PING.encode():
+                log_sapni.debug("SAPNIProxy: Received NI_PING, sending NI_PONG")
+                connection.buffers[local] += bytes(SAPNI() / Raw(SAPNI.SAPNI_PONG))
+                continue
+            if local.lazy:
+                packets.append(SAPNIFrame(bytes(nidata), local.basecls))
+                continue
+            packet = SAPNI(bytes(nidata))
+            if local.basecls:
+                packet.decode_payload_as(local.basecls)
+            packets.append(packet)
+        return packets
+
+    def _build_packet(self, packet):
+        """Builds a packet returned by the handler to send it to the peer.
+
+        :rtype: ``bytes``
+        """
+        if isinstance(packet, SAPNIFrame):
+            return bytes(packet)
+        return bytes(SAPNI() / packet.payload)
+
+    def _handle_readable(self, connection, local):
+        """Reads, process and queues the packets received on a socket."""
+        remote = connection.peer(local)
+        if connection.handler.passthrough:
+            self._forward(connection, local)
+            return
+        if local is connection.client:
+            process = connection.handler.process_client
+        else:
+            process = connection.handler.process_server
+
+        try:
+            packets = self._read_packets(connection, local)
+            for packet in packets:
+                packet = process(packet)
+                connection.buffers[remote] += self._build_packet(packet)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            log_sapni.debug("SAPNIProxy: %s connection down",
+                            "Client" if local is connection.client else "Server")
+            self._close_connection(connection)
+            return
+        except Exception:
+            log_sapni.exception("SAPNIProxy: Error processing packet")
+            self._close_connection(connection)
+            return
+
+        self._flush(connection, remote)
+        self._flush(connection, local)
+
+    def _forward(self, connection, local):
+        """Moves the data received on a socket to its peer in passthrough mode."""
+        try:
+            if connection.handler.forwarders[local].read() == 0:
+                raise socket.error((100, "Underlying stream socket tore down"))
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            log_sapni.debug("SAPNIProxy: %s connection down",
+                            "Client" if local is connection.client else "Server")
+            self._close_connection(connection)
+            return
+        self._flush(connection, connection.peer(local))
+
+    def _handle_writable(self, connection, local):
+        """Completes the connection with the remote host or sends the data
+        pending on a socket."""
+        if local is connection.server and connection.connecting:
+            error = local.ins.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                log_sapni.error("SAPNIProxy: Error connecting to the remote host (errno %d)", error)
+                self._close_connection(connection)
+                return
+            connection.connecting = False
+        self._flush(connection, local)
+
+    def _flush(self, connection, local):
+        """Sends as much of the data pending on a socket as possible without
+        blocking and updates the events the connection is waiting for."""
+        if connection.closed:
+            return
+        if not (local is connection.server and connection.connecting):
+            try:
+                if connection.handler.passthrough:
+                    forwarder = connection.handler.forwarders[connection.peer(local)]
+                    while forwarder.pending and forwarder.write():
+                        pass
+                elif connection.buffers[local]:
+                    sent = local.ins.send(connection.buffers[local])
+                    del connection.buffers[local][:sent]
+                    local.metrics.bytes_sent += sent
+            except (BlockingIOError, InterruptedError):
+                pass
+            except socket.error:
+                self._close_connection(connection)
+                return
+        self._update_events(connection)
+
+    def _update_events(self, connection):
+        """Registers the events each socket of the connection should wait for.
+        A socket is not read while the data pending to be sent to its peer is
+        over the maximum buffer size."""
+        for local in (connection.client, connection.server):
+            remote = connection.peer(local)
+            if connection.handler.passthrough:
+                # The data read from a socket is written before reading again
+                to_remote = connection.handler.forwarders[local].pending
+                to_local = connection.handler.forwarders[remote].pending
+                can_read = not to_remote
+            else:
+                to_local = len(connection.buffers[local])
+                can_read = len(connection.buffers[remote]) < self.max_buffer_size
+            events = 0
+            if can_read and not (local is connection.server and connection.connecting):
+                events |= selectors.EVENT_READ
+            if to_local or (local is connection.server and connection.connecting):
+                events |= selectors.EVENT_WRITE
+
+            registered = connection.events.get(local, 0)
+            if events == registered:
+                continue
+            if not registered:
+                self._selector.register(local.ins, events, (connection, local))
+            elif not events:
+                self._selector.unregister(local.ins)
+            else:
+                self._selector.modify(local.ins, events, (connection, local))
+            connection.events[local] = events
+
+    def _close_connection(self, connection):
+        """Unregisters and closes both sockets of a connection."""
+        if connection.closed:
+            return
+        connection.closed = True
+        for local in (connection.client, connection.server):
+            if connection.events.get(local):
+                self._selector.unregister(local.ins)
+        self.connections.discard(connection)
+        connection.handler.stop_workers()
+
     def stop(self):
-        """Stop the proxy by closing the listener socket."""
+        """Stop the proxy by closing the listener socket. If the proxy is
+        serving on the event loop, the loop is stopped and the connections
+        handled closed."""
+        self._stopped.set()
+        if self._selector is not None:
+            try:
+                self._wakeup_send.send(b"\x00")
+            except socket.error:
+                pass
         self.listener.close()
 
 
+class SAPNIProxyConnection(object):
+    """Client/server pair handled by the event loop of a :class:`SAPNIProxy`.
+    Keeps the data pending to be sent to each peer.
+    """
+
+    def __init__(self, handler):
+        """
+        :param handler: handler instance for this client
+        :type handler: :class:`SAPNIProxyHandler`
+        """
+        self.handler = handler
+        self.client = handler.client
+        self.server = handler.server
+        self.buffers = {self.client: bytearray(), self.server: bytearray()}
+        self.events = {}
+        self.connecting = True
+        self.closed = False
+
+    def peer(self, local):
+        """Returns the other end of the pair."""
+        return self.server if local is self.client else self.client
+
+
 class SAPNIProxyHandler(object):
     """SAP NI Proxy Handler
 
     Handles NI packets. Works spawning one thread for processing data coming
-    from each pair of client/server.
+    from each pair of client/server, or from the event loop of the proxy when
+    served using :class:`SAPNIProxy.serve_forever`.
     """
 
-    def __init__(self, client, server, options=None):
+    def __init__(self, client, server, options=None, threaded=True, passthrough=False):
         """It receives two :class:`SAPNIStreamSocket`s objects and creates the worker
         for processing data. Thread is started as daemon.
 
@@ -286,14 +1737,66 @@ class SAPNIProxyHandler(object):
 
         :param options: options received from the proxy
         :type options: ``dict``
+
+        :param threaded: if false, the worker thread is not started and the
+            data is processed by the proxy's event loop
+        :type threaded: ``bool``
+
+        :param passthrough: if true, data is forwarded between client and
+            server without processing it
+        :type passthrough: ``bool``
         """
         self.client = client
         self.server = server
         self.poll_interval = 0.5
 
-        self.processor = Worker(self, self._handle)
-        self.processor.daemon = True
-        self.processor.start()
+        self.passthrough = passthrough
+        self.forwarders = {}
+        if passthrough:
+            self.forwarders = {client: SAPNIForwarder(client.ins, server.ins, client.drain_buffer()),
+                               server: SAPNIForwarder(server.ins, client.ins, server.drain_buffer())}
+            if threaded:
+                for forwarder in self.forwarders.values():
+                    while forwarder.pending:
+                        forwarder.write()
+
+        self.processor = None
+        if threaded:
+            self.processor = Worker(self, self._handle)
+            self.processor.daemon = True
+            self.processor.start()
+
+    @classmethod
+    def can_passthrough(cls):
+        """Returns if the handler forwards the packets without modifying them,
+        in which case the proxy can avoid dissecting and rebuilding them.
+
+        :return: if the packets are not processed by the handler
+        :rtype: ``bool``
+        """
+        return cls.process_client is SAPNIProxyHandler.process_client and \
+            cls.process_server is SAPNIProxyHandler.process_server
+
+    def forward(self, local, remote, process):
+        """Moves the data available on one socket connection to the remote
+        connection without processing it.
+
+        :param local: the local socket
+        :type local: :class:`SAPNIStreamSocket`
+
+        :param remote: the remote socket
+        :type remote: :class:`SAPNIStreamSocket`
+
+        :param process: not used, as the data is not processed
+        :type process: function
+        """
+        forwarder = self.forwarders[local]
+        received = forwarder.read()
+        if received == 0:
+            raise socket.error((100, "Underlying stream socket tore down"))
+        while forwarder.pending:
+            forwarder.write()
+        log_sapni.debug("SAPNIProxyHandler: Forwarded %d bytes", received)
 
     def recv_send(self, local, remote, process):
         """Receives data from one socket connection, process it and send to the
@@ -315,24 +1818,29 @@ class SAPNIProxyHandler(object):
         # Process the packet using the given function
         packet = process(packet)
 
-        # Send the packet to the remote peer
-        remote.send(packet.payload)
+        # Send the packet to the remote peer, frames not dissected are sent as
+        # they were received
+        remote.send(packet if isinstance(packet, SAPNIFrame) else packet.payload)
         log_sapni.debug("SAPNIProxyHandler: Sent %d bytes", len(packet))
 
     def _handle(self):
         """Handles data coming from either the client or the server"""
-        r, __, __ = select([self.client, self.server], [], [], self.poll_interval)
+        # Frames already in the receive buffers are not signaled by select
+        r = [sock for sock in (self.client, self.server) if sock.has_pending_frame()]
+        if not r:
+            r, __, __ = select([self.client, self.server], [], [], self.poll_interval)
+        recv_send = self.forward if self.passthrough else self.recv_send
         if self.client in r:
             try:
                 log_sapni.debug("SAPNIProxyHandler: Client --> Server connection")
-                self.recv_send(self.client, self.server, self.process_client)
+                recv_send(self.client, self.server, self.process_client)
             except socket.error:
                 log_sapni.error("SAPNIProxyHandler: Client connection down")
                 self.stop_workers()
         if self.server in r:
             try:
                 log_sapni.debug("SAPNIProxyHandler: Client <-- Server connection")
-                self.recv_send(self.server, self.client, self.process_server)
+                recv_send(self.server, self.client, self.process_server)
             except socket.error:
                 log_sapni.error("SAPNIProxyHandler: Server connection down")
                 self.stop_workers()
@@ -361,7 +1869,10 @@ class SAPNIProxyHandler(object):
         """Stop the processor workers"""
         self.client.close()
         self.server.close()
-        self.processor.stop()
+        for forwarder in self.forwarders.values():
+            forwarder.close()
+        if self.processor:
+            self.processor.stop()
 
 
 class SAPNIClient(object):
@@ -428,6 +1939,222 @@ class SAPNIServerThreaded(ThreadingMixIn, SAPNIServer):
     """A SAP NI Server implementation using threading """
 
 
+class SAPNIServerPreforked(SAPNIServerThreaded):
+    """A SAP NI Server implementation using pre-forked worker processes.
+
+    Each worker binds its own listener socket on the same address using
+    `SO_REUSEPORT`, so the kernel balances the incoming connections between
+    them, and serves its clients using threads. Workers don't share any
+    state, each of them keeps its own `clients` dictionary.
+
+    The parent process only supervises the workers: it restarts workers that
+    exited unexpectedly, reloads them gracefully on `SIGHUP` (new workers are
+    started before the old ones stop accepting connections and finish the
+    ones being served) and stops them on `SIGTERM`/`SIGINT` or when calling
+    :class:`shutdown`. Workers failing right after being started are restarted
+    with an exponential backoff.
+
+    Example usage::
+        server = SAPNIServerPreforked((local_host, local_port), handler_class, workers=4)
+        server.clients_cls = client_class
+        server.serve_forever()
+    """
+
+    allow_reuse_address = True
+
+    respawn_delay = 0.1
+    """ :cvar: Time in seconds to wait before restarting a worker that failed
+        right after being started, doubled on each consecutive failure
+        :type: ``float`` """
+
+    max_respawn_delay = 30
+    """ :cvar: Maximum time in seconds to wait before restarting a worker
+        :type: ``float`` """
+
+    min_worker_uptime = 10
+    """ :cvar: Time in seconds a worker should run for its exit not to be
+        considered a failure on start
+        :type: ``float`` """
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 bind_and_activate=True, socket_cls=None, keep_alive=True,
+                 base_cls=None, workers=None):
+        """
+        :param workers: number of worker processes to fork, defaults to the
+            number of CPUs
+        :type workers: ``int``
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.worker_id = None
+        self.worker_pids = {}
+        self._retired_pids = set()
+        self._started = {}
+        self._respawn_delays = {}
+        self._respawns = {}
+        self._stopping = False
+        SAPNIServerThreaded.__init__(self, server_address, RequestHandlerClass,
+                                     bind_and_activate=bind_and_activate,
+                                     socket_cls=socket_cls,
+                                     keep_alive=keep_alive,
+                                     base_cls=base_cls)
+
+    def server_bind(self):
+        """Sets the `SO_REUSEPORT` option before binding the socket."""
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        SAPNIServerThreaded.server_bind(self)
+
+    def server_activate(self):
+        """Only workers listen for connections. The socket in the parent
+        process is kept bound to hold the address."""
+        if self.worker_id is not None:
+            SAPNIServerThreaded.server_activate(self)
+
+    def serve_forever(self, poll_interval=0.5):
+        """Fork the workers and supervise them until the server is stopped.
+
+        :param poll_interval: poll interval to use in the workers
+        :type poll_interval: ``float``
+        """
+        self._stopping = False
+        self._poll_interval = poll_interval
+        self._respawns = {}
+        handlers = {}
+        if current_thread() is main_thread():
+            handlers[signal.SIGHUP] = signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+            handlers[signal.SIGTERM] = signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown())
+            handlers[signal.SIGINT] = signal.signal(signal.SIGINT, lambda signum, frame: self.shutdown())
+
+        try:
+            for worker_id in range(self.workers):
+                self._spawn_worker(worker_id)
+            self._supervise()
+        finally:
+            for (signum, handler) in handlers.items():
+                signal.signal(signum, handler)
+        log_sapni.debug("SAPNIServerPreforked: All workers stopped")
+
+    def _supervise(self):
+        """Waits for the workers to exit, restarting the ones that exited
+        unexpectedly, until all of them are stopped."""
+        while self.worker_pids or self._retired_pids or self._respawns:
+            if self._stopping:
+                self._respawns.clear()
+            now = monotonic()
+            for (worker_id, deadline) in list(self._respawns.items()):
+                # Respawns might be cleared by a reload from a signal handler
+                if deadline <= now and self._respawns.pop(worker_id, None) is not None:
+                    self._spawn_worker(worker_id)
+
+            try:
+                if self._respawns:
+                    (pid, __) = os.waitpid(-1, os.WNOHANG)
+                else:
+                    (pid, __) = os.waitpid(-1, 0)
+            except ChildProcessError:
+                if not self._respawns:
+                    break
+                pid = 0
+            if not pid:
+                # Wait for the next worker to restart
+                timeout = min(self._respawns.values()) - monotonic() if self._respawns else 0
+                sleep(max(0, min(timeout, self._poll_interval)))
+                continue
+
+            if pid in self._retired_pids:
+                self._retired_pids.discard(pid)
+            elif pid in self.worker_pids:
+                worker_id = self.worker_pids.pop(pid)
+                if not self._stopping:
+                    self._schedule_respawn(worker_id, pid)
+
+    def _schedule_respawn(self, worker_id, pid):
+        """Schedules the restart of a worker that exited unexpectedly. Workers
+        failing right after being started are restarted after a delay that
+        doubles on each consecutive failure."""
+        if monotonic() - self._started.get(worker_id, 0) >= self.min_worker_uptime:
+            delay = 0
+        else:
+            delay = min(self.max_respawn_delay,
+                        max(self.respawn_delay, self._respawn_delays.get(worker_id, 0) * 2))
+        self._respawn_delays[worker_id] = delay
+        log_sapni.warning("SAPNIServerPreforked: Worker %d (pid %d) exited, restarting it in %.1f seconds",
+                          worker_id, pid, delay)
+        self._respawns[worker_id] = monotonic() + delay
+
+    def _spawn_worker(self, worker_id):
+        """Forks a new worker process."""
+        pid = os.fork()
+        if pid:
+            self.worker_pids[pid] = worker_id
+            self._started[worker_id] = monotonic()
+            log_sapni.debug("SAPNIServerPreforked: Started worker %d (pid %d)", worker_id, pid)
+            return
+
+        # Worker process
+        status = 0
+        try:
+            self.worker_id = worker_id
+            self.worker_pids = {}
+            self._retired_pids = set()
+            self.clients = {}
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown())
+
+            # Create the worker's own listener socket
+            self.socket.close()
+            self.socket = socket.socket(self.address_family, self.socket_type)
+            self.server_bind()
+            self.server_activate()
+
+            SAPNIServerThreaded.serve_forever(self, self._poll_interval)
+        except Exception:
+            log_sapni.exception("SAPNIServerPreforked: Worker %d error", worker_id)
+            status = 1
+        finally:
+            try:
+                self.server_close()
+            finally:
+                os._exit(status)
+
+    def reload(self):
+        """Gracefully replace the workers. New workers are started and then
+        the old ones are requested to stop after serving the current clients.
+        """
+        if self.worker_id is not None or self._stopping:
+            return
+        log_sapni.debug("SAPNIServerPreforked: Reloading workers")
+        old_workers = self.worker_pids
+        self.worker_pids = {}
+        self._respawns.clear()
+        for worker_id in range(self.workers):
+            self._spawn_worker(worker_id)
+        self._retired_pids.update(old_workers)
+        self._signal_workers(old_workers)
+
+    def shutdown(self):
+        """Stop the server. In the parent process, it stops all the workers.
+        In a worker, it stops accepting connections and serves the current
+        clients before exiting.
+        """
+        if self.worker_id is not None:
+            # Called from the worker's signal handler, so it can't wait for
+            # the serve loop in the same thread
+            Thread(target=SAPNIServerThreaded.shutdown, args=(self, )).start()
+            return
+        self._stopping = True
+        self._signal_workers(self.worker_pids)
+        self._signal_workers(self._retired_pids)
+
+    @staticmethod
+    def _signal_workers(pids, signum=signal.SIGTERM):
+        for pid in list(pids):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+
 class SAPNIServerHandler(BaseRequestHandler):
     """SAP NI Server Handler
 
@@ -472,8 +2199,8 @@ class SAPNIServerHandler(BaseRequestHandler):
                 self.handle_data()
 
             except socket.error as e:
-                log_sapni.debug("SAPNIServerHandler: Error handling data or client %s disconnected, %s (errno %d)",
-                                self.client_address, e.message, e.errno)
+                log_sapni.debug("SAPNIServerHandler: Error handling data or client %s disconnected, %s (errno %s)",
+                                self.client_address, e, e.errno)
                 break
 
     def handle_data(self):
@@ -17,9 +17,25 @@
 #
 
 # Standard imports
+import os
 import re
+import json
+import shlex
+import asyncio
 import logging
-from socket import error as SocketError
+from time import monotonic, time
+from datetime import datetime
+from fnmatch import fnmatchcase, translate
+from itertools import count
+from select import select
+from threading import Event, Lock, Thread
+from struct import Struct, pack, pack_into, unpack
+from collections import Counter, deque, namedtuple
+from socket import error as SocketError, MSG_DONTWAIT, MSG_PEEK
+from bisect import bisect_right
+from functools import lru_cache
+from ipaddress import IPv4Address, ip_network
+from contextlib import contextmanager, asynccontextmanager
 # External imports
 from scapy.layers.inet import TCP
 from scapy.packet import Packet, bind_layers, Raw
@@ -32,7 +48,8 @@ from scapy.fields import (ByteField, ShortField, ConditionalField, StrField,
 # Custom imports
 from pysap.SAPSNC import SAPSNCFrame
 from pysap.SAPNI import (SAPNI, SAPNIStreamSocket, SAPNIProxy,
-                         SAPNIProxyHandler)
+                         SAPNIProxyHandler, SAPNIClient, SAPNIServerHandler,
+                         SAPNIServerThreaded, SAPNIServerPreforked)
 from pysap.utils.fields import (PacketNoPadded, StrNullFixedLenField)
 
 
@@ -94,6 +111,10 @@ router_return_codes = {
 }
 """Router Return Code values"""
 
+router_version_return_codes = (-13, -93, -96)
+"""Router Return Code values of route requests rejected for using a wrong
+version or being invalid"""
+
 
 # Router Administration Command values
 router_adm_commands = {
@@ -165,12 +186,8 @@ class SAPRouterRouteHop(PacketNoPadded):
         :return: route hops in the route string
         :rtype: ``list`` of :class:`SAPRouterRouteHop`
         """
-        result = []
-        for route_hop in [x.groupdict() for x in cls.regex.finditer(route_string)]:
-            result.append(cls(hostname=route_hop["hostname"],
-                              port=route_hop["port"],
-                              password=route_hop["password"]))
-        return result
+        return [cls(hostname=hop.hostname, port=hop.port, password=hop.password)
+                for hop in parse_route_string(route_string)]
 
     @classmethod
     def from_hops(cls, route_hops):
@@ -182,15 +199,117 @@ class SAPRouterRouteHop(PacketNoPadded):
         :return: route string
         :rtype: C{string}
         """
-        route_string = ""
-        for hop in route_hops:
-            if hop.hostname:
-                route_string += f"/H/{hop.hostname}"
-            if hop.port:
-                route_string += f"/S/{hop.port}"
-            if hop.password:
-                route_string += f"/W/{hop.password}"
-        return route_string
+        return SAPRouterRoute.from_hops(route_hops).route_string
+
+
+SAPRouterHop = namedtuple("SAPRouterHop", ["hostname", "port", "password"])
+""" Immutable route hop, as held by :class:`SAPRouterRoute` """
+
+
+class SAPRouterRoute(tuple):
+    """Parsed route
+
+    Immutable tuple of :class:`SAPRouterHop` along with the route string and
+    the serialized hops as sent in route requests. Requests for the route are
+    rendered from the :class:`SAPRouterRouteTemplate` of its prefix, without
+    building :class:`SAPRouter` packets. Routes parsed from route strings are
+    obtained with :func:`parse_route_string`, which keeps the recently parsed
+    ones.
+    """
+
+    def __new__(cls, hops=()):
+        """Creates the route.
+
+        :param hops: route hops
+        :type hops: ``list`` of :class:`SAPRouterHop` or :class:`SAPRouterRouteHop`
+        """
+        route = tuple.__new__(cls, (SAPRouterHop(*(cls._decode(value) for value in
+                                                   (hop.hostname, hop.port, hop.password)))
+                                    for hop in hops))
+        hops_data = [b"".join(SAPRouterRouteTemplate._encode(value) + b"\x00"
+                              for value in hop)
+                     for hop in route]
+        route.route_data = b"".join(hops_data)
+        """ :ivar: serialized hops, as sent in route requests """
+        route.route_length = len(route.route_data)
+        """ :ivar: length of the serialized hops """
+        route.route_offset = len(hops_data[0]) if hops_data else 0
+        """ :ivar: offset of the second hop in the serialized hops """
+        route.route_string = "".join("".join(("/H/%s" % hop.hostname if hop.hostname else "",
+                                              "/S/%s" % hop.port if hop.port else "",
+                                              "/W/%s" % hop.password if hop.password else ""))
+                                     for hop in route)
+        """ :ivar: route string """
+        return route
+
+    @staticmethod
+    def _decode(value):
+        if isinstance(value, bytes):
+            return value.decode("ascii", "replace")
+        if value is not None and not isinstance(value, str):
+            return str(value)
+        return value
+
+    @classmethod
+    def from_hops(cls, hops):
+        """Builds a route from a list of hops.
+
+        :param hops: route hops
+        :type hops: ``list`` of :class:`SAPRouterRouteHop` or :class:`SAPRouterRoute`
+
+        :rtype: :class:`SAPRouterRoute`
+        """
+        if isinstance(hops, cls):
+            return hops
+        return cls(hops)
+
+    def append(self, hostname, port=None, password=None):
+        """Returns a new route with an additional hop at the end.
+
+        :param hostname: hostname of the new hop
+        :type hostname: C{string}
+
+        :param port: port or service of the new hop
+        :type port: ``int``
+
+        :param password: password of the new hop
+        :type password: C{string}
+
+        :rtype: :class:`SAPRouterRoute`
+        """
+        return SAPRouterRoute(self + (SAPRouterHop(hostname, port, password), ))
+
+    def render_request(self, talk_mode=None, router_version=None):
+        """Renders a route request for the route using the template returned
+        by :func:`get_route_template` for its prefix. It's equivalent to the
+        :class:`SAPRouter` packet returned by :class:`build_route_request`.
+
+        :param talk_mode: the talk mode to request
+        :type talk_mode: ``int``
+
+        :param router_version: the router version to use in the request
+        :type router_version: ``int``
+
+        :return: route request
+        :rtype: ``bytes``
+        """
+        template = get_route_template(self[:-1], talk_mode, router_version)
+        return template.render(*self[-1])
+
+
+@lru_cache(maxsize=1024)
+def parse_route_string(route_string):
+    """Parses a route string. Route strings are parsed once and the recently
+    used ones are kept, so long routes used repeatedly are not parsed again.
+
+    :param route_string: route string
+    :type route_string: C{string}
+
+    :return: parsed route
+    :rtype: :class:`SAPRouterRoute`
+    """
+    return SAPRouterRoute(SAPRouterHop(match.group("hostname"), match.group("port"), match.group("password"))
+                          for match in SAPRouterRouteHop.regex.finditer(route_string))
 
 
 class SAPRouterInfoClient(PacketNoPadded):
@@ -228,6 +347,72 @@ class SAPRouterInfoClients(PacketNoPadded):
     ]
 
 
+SAPRouterClientRecord = namedtuple("SAPRouterClientRecord",
+                                   ["id", "traced", "connected", "routed", "connected_on",
+                                    "address", "partner", "service"])
+""" Compact record of a client connected to a SAP Router, as decoded by
+    :class:`router_info_clients` without building :class:`SAPRouterInfoClient`
+    packets. """
+
+
+router_info_client_struct = Struct("!IBQ45s45s27s7x")
+""" Layout of the 137 bytes records of :class:`SAPRouterInfoClient` """
+
+
+def _decode_fixed_string(value):
+    return value.split(b"\x00", 1)[0].decode("ascii", "replace")
+
+
+def router_info_clients(data, predicate=None):
+    """Decodes the list of clients returned by a SAP Router in an information
+    request, yielding a compact record for each client. It's equivalent to
+    dissecting the data as :class:`SAPRouterInfoClients`, but records are
+    decoded on the fly from the fixed-length layout without building packets.
+
+    :param data: payload of the NI packet with the list of clients
+    :type data: ``bytes``
+
+    :param predicate: function to filter the records to return
+    :type predicate: ``callable``
+
+    :return: client records
+    :rtype: iterator of :class:`SAPRouterClientRecord`
+    """
+    with memoryview(data) as view:
+        # Trailing data not filling a whole record is ignored
+        length = len(view) - len(view) % router_info_client_struct.size
+        for (client_id, flags, connected_on, address, partner,
+             service) in router_info_client_struct.iter_unpack(view[:length]):
+            record = SAPRouterClientRecord(client_id, bool(flags & 0x04), bool(flags & 0x02),
+                                           bool(flags & 0x01), connected_on,
+                                           _decode_fixed_string(address),
+                                           _decode_fixed_string(partner),
+                                           _decode_fixed_string(service))
+            if predicate is None or predicate(record):
+                yield record
+
+
+def router_info_clients_count(data, field="address", predicate=None):
+    """Counts the clients returned by a SAP Router in an information request,
+    aggregated by one of the fields of the client records.
+
+    :param data: payload of the NI packet with the list of clients
+    :type data: ``bytes``
+
+    :param field: name of the :class:`SAPRouterClientRecord` field to
+        aggregate the clients by, e.g. `address` or `partner`
+    :type field: C{string}
+
+    :param predicate: function to filter the records to count
+    :type predicate: ``callable``
+
+    :return: number of clients for each value of the field
+    :rtype: ``collections.Counter``
+    """
+    index = SAPRouterClientRecord._fields.index(field)
+    return Counter(record[index] for record in router_info_clients(data, predicate))
+
+
 class SAPRouterInfoServer(PacketNoPadded):
     """SAP Router Protocol Information Request Server info
 
@@ -279,6 +464,158 @@ class SAPRouterError(PacketNoPadded):
     """
 
 
+router_fingerprint_fields = ["error", "return_code", "component", "release", "version", "module", "line",
+                             "errorno", "errorno_text", "system_call"]
+""" Fields of :class:`SAPRouterError` tracked when fingerprinting SAP Router versions """
+
+
+def _get_fingerprint_value(entry, field):
+    """Returns the normalized value of a field in a fingerprint entry or
+    error text, or None if the field is not present."""
+    if isinstance(entry, dict):
+        value = entry.get(field)
+    else:
+        value = getattr(entry, field, None)
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode("latin-1")
+    return str(value).strip()
+
+
+class SAPRouterFingerprintDB(object):
+    """SAP Router fingerprint database
+
+    Matches the error texts returned by a SAP Router against a database of
+    known fingerprints. The database is compiled into a hash index for each
+    target, keyed on the normalized values of the fingerprint fields, so each
+    match is a dictionary lookup instead of a comparison against every entry
+    and field. Values are compared once decoded as latin-1 and stripped of
+    surrounding whitespace.
+    """
+
+    def __init__(self, fingerprints=None, fields=None):
+        """Creates the fingerprint database.
+
+        :param fingerprints: fingerprint entries by target name
+        :type fingerprints: ``dict``
+
+        :param fields: fingerprint fields to index, defaults to
+            `router_fingerprint_fields`
+        :type fields: ``list`` of C{string}
+        """
+        self.fields = tuple(fields or router_fingerprint_fields)
+        self.fingerprints = {}
+        self.index = {}
+        for target, entries in (fingerprints or {}).items():
+            for entry in entries:
+                self.add(target, entry)
+
+    def make_key(self, entry, fields):
+        """Builds the index key of a fingerprint entry or error text.
+
+        :param entry: fingerprint entry or error text packet
+        :type entry: ``dict`` or :class:`SAPRouterError`
+
+        :param fields: fields to include in the key
+        :type fields: ``tuple`` of C{string}
+
+        :return: normalized values of the fields, or None if the entry
+            lacks any of them
+        :rtype: ``tuple``
+        """
+        key = tuple(_get_fingerprint_value(entry, field) for field in fields)
+        if None in key:
+            return None
+        return key
+
+    def add(self, target, entry):
+        """Adds a fingerprint entry for a target to the database.
+
+        :param target: name of the target packet
+        :type target: C{string}
+
+        :param entry: fingerprint entry
+        :type entry: ``dict``
+
+        :return: if the entry was added or it was already in the database
+        :rtype: ``bool``
+        """
+        entries = self.fingerprints.setdefault(target, [])
+        if entry in entries:
+            return False
+        entries.append(entry)
+
+        # Entries lacking some of the fields match any value of them, so
+        # they're indexed separately by the set of fields they include
+        values = [(field, _get_fingerprint_value(entry, field)) for field in self.fields]
+        values = [(field, value) for field, value in values if value is not None]
+        fields = tuple(field for field, _ in values)
+        key = tuple(value for _, value in values)
+        buckets = self.index.setdefault(target, {}).setdefault(fields, {})
+        buckets.setdefault(key, []).append(entry)
+        return True
+
+    def match(self, target, error_text):
+        """Matches an error text against the fingerprints of a target.
+
+        :param target: name of the target packet
+        :type target: C{string}
+
+        :param error_text: error text returned by the SAP Router
+        :type error_text: :class:`SAPRouterError` or ``dict``
+
+        :return: matched fingerprint entries
+        :rtype: ``list`` of ``dict``
+        """
+        matches = []
+        for fields, buckets in self.index.get(target, {}).items():
+            key = self.make_key(error_text, fields)
+            if key is not None:
+                matches.extend(buckets.get(key, []))
+                continue
+            # The error text lacks some of the fields, compare only the
+            # ones it has
+            values = [_get_fingerprint_value(error_text, field) for field in fields]
+            for bucket_key, entries in buckets.items():
+                if all(value is None or value == bucket_value
+                       for value, bucket_value in zip(values, bucket_key)):
+                    matches.extend(entries)
+        return matches
+
+    @classmethod
+    def from_json(cls, fingerprints_file, targets=None, fields=None):
+        """Loads a fingerprint database from a json file.
+
+        :param fingerprints_file: name of the json file
+        :type fingerprints_file: C{string}
+
+        :param targets: names of the targets to load, all of them if not
+            provided
+        :type targets: ``list`` of C{string}
+
+        :param fields: fingerprint fields to index
+        :type fields: ``list`` of C{string}
+
+        :rtype: :class:`SAPRouterFingerprintDB`
+        """
+        with open(fingerprints_file, 'r') as fd:
+            fingerprints = json.load(fd)
+        if targets is not None:
+            fingerprints = {target: entries for target, entries in fingerprints.items()
+                            if target in targets}
+        return cls(fingerprints, fields)
+
+    def save(self, fingerprints_file):
+        """Writes the fingerprint entries to a json file.
+
+        :param fingerprints_file: name of the json file
+        :type fingerprints_file: C{string}
+        """
+        with open(fingerprints_file, 'w') as fd:
+            json.dump(self.fingerprints, fd, sort_keys=True, indent=4, separators=(',', ': '))
+
+
 def router_is_route(pkt):
     """Returns if the packet is a Route packet.
 
@@ -513,10 +850,286 @@ def get_router_version(connection):
     return response.version
 
 
+def build_route_request(route, talk_mode=None, router_version=None):
+    """Helper function to build a route request packet for a given route.
+
+    :param route: route to request, including the SAP Router as first hop
+    :type route: ``list`` of :class:`SAPRouterRouteHop`
+
+    :param talk_mode: the talk mode to request
+    :type talk_mode: ``int``
+
+    :param router_version: the router version to use in the request
+    :type router_version: ``int``
+
+    :return: route request packet
+    :rtype: :class:`SAPRouter`
+    """
+    # Lengths are the ones of the hops as sent, including null terminators
+    hops_lens = [len(bytes(hop)) for hop in route]
+    return SAPRouter(type=SAPRouter.SAPROUTER_ROUTE,
+                     route_ni_version=router_version or SAPRouter.SAPROUTER_DEFAULT_VERSION,
+                     route_entries=len(route),
+                     route_talk_mode=talk_mode or ROUTER_TALK_MODE_NI_MSG_IO,
+                     route_rest_nodes=len(route) - 1,
+                     route_length=sum(hops_lens),
+                     route_offset=hops_lens[0],
+                     route_string=route)
+
+
+class SAPRouterRouteTemplate(object):
+    """Precompiled route request
+
+    Route requests sent through the same SAP Router and intermediate hops
+    only differ in the last hop of the route. The template holds the route
+    request already built for the route's prefix, along with the offsets of
+    the fields depending on the last hop, so each request is rendered by
+    copying the template and patching those fields instead of building the
+    whole :class:`SAPRouter` packet.
+
+    Example usage::
+
+        template = SAPRouterRouteTemplate([SAPRouterRouteHop(hostname=router_host,
+                                                             port=router_port)])
+        for port in ports:
+            request = template.render(target_host, port)
+    """
+
+    def __init__(self, route_prefix, talk_mode=None, router_version=None):
+        """Compiles the template.
+
+        :param route_prefix: route hops preceding the target, including the
+            SAP Router as first hop
+        :type route_prefix: ``list`` of :class:`SAPRouterRouteHop`
+
+        :param talk_mode: the talk mode to request
+        :type talk_mode: ``int``
+
+        :param router_version: the router version to use in the request
+        :type router_version: ``int``
+        """
+        # Build the request with an empty last hop, and locate the fields
+        # from the end of the packet
+        prefix_lens = [len(bytes(hop)) for hop in route_prefix]
+        empty_hop = SAPRouterRouteHop()
+        request = bytes(build_route_request(list(route_prefix) + [empty_hop],
+                                            talk_mode, router_version))
+        self.hops_offset = len(request) - sum(prefix_lens) - len(bytes(empty_hop))
+        """ :ivar: offset of the first hop in the request """
+        self.length_offset = self.hops_offset - 8
+        """ :ivar: offset of the route length field in the request """
+        self.offset_offset = self.hops_offset - 4
+        """ :ivar: offset of the route offset field in the request """
+        self.prefix_length = sum(prefix_lens)
+        self.template = request[:self.hops_offset + self.prefix_length]
+        self.first_hop_length = prefix_lens[0] if prefix_lens else None
+
+    @staticmethod
+    def _encode(value):
+        if value is None:
+            return b""
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode()
+
+    def render(self, hostname, port=None, password=None):
+        """Renders the route request for a target.
+
+        :param hostname: target host
+        :type hostname: C{string}
+
+        :param port: target port or service
+        :type port: ``int``
+
+        :param password: target password
+        :type password: C{string}
+
+        :return: route request
+        :rtype: ``bytes``
+        """
+        last_hop = b"\x00".join((self._encode(hostname), self._encode(port),
+                                 self._encode(password))) + b"\x00"
+        request = bytearray(self.template)
+        request += last_hop
+        pack_into("!I", request, self.length_offset, self.prefix_length + len(last_hop))
+        if self.first_hop_length is None:
+            pack_into("!I", request, self.offset_offset, len(last_hop))
+        return bytes(request)
+
+    def render_frame(self, hostname, port=None, password=None):
+        """Renders the route request for a target, including the NI length
+        field so it can be written directly to a socket.
+
+        :return: NI frame with the route request
+        :rtype: ``bytes``
+        """
+        request = self.render(hostname, port, password)
+        return pack("!I", len(request)) + request
+
+
+@lru_cache(maxsize=256)
+def _get_route_template(prefix, talk_mode, router_version):
+    route_prefix = [SAPRouterRouteHop(hostname=hostname, port=port, password=password)
+                    for (hostname, port, password) in prefix]
+    return SAPRouterRouteTemplate(route_prefix, talk_mode, router_version)
+
+
+def get_route_template(route_prefix, talk_mode=None, router_version=None):
+    """Helper function to obtain a :class:`SAPRouterRouteTemplate` for a
+    route prefix. Templates are compiled once and reused on later calls.
+
+    :param route_prefix: route hops preceding the target, including the SAP
+        Router as first hop
+    :type route_prefix: ``list`` of :class:`SAPRouterRouteHop`
+
+    :param talk_mode: the talk mode to request
+    :type talk_mode: ``int``
+
+    :param router_version: the router version to use in the request
+    :type router_version: ``int``
+
+    :return: route request template
+    :rtype: :class:`SAPRouterRouteTemplate`
+    """
+    prefix = tuple((hop.hostname, hop.port, hop.password) for hop in route_prefix)
+    return _get_route_template(prefix, talk_mode or ROUTER_TALK_MODE_NI_MSG_IO,
+                               router_version or SAPRouter.SAPROUTER_DEFAULT_VERSION)
+
+
+class SAPRouterCapabilities(object):
+    """Capabilities of a SAP Router stored in a :class:`SAPRouterCapabilityCache`.
+    """
+
+    __slots__ = ("version", "talk_modes", "expires")
+
+    def __init__(self, version=None, talk_modes=None, expires=None):
+        self.version = version
+        self.talk_modes = set(talk_modes or [])
+        self.expires = expires
+
+
+class SAPRouterCapabilityCache(object):
+    """Cache of SAP Router capabilities
+
+    Keeps the NI version and the talk modes accepted by the SAP Routers
+    already contacted, keyed by their address and port, so the version
+    doesn't need to be requested again on each new route. Entries expire
+    after a given time. A process-wide instance is available as
+    :data:`router_capabilities` and used by :class:`SAPRoutedStreamSocket`.
+    """
+
+    def __init__(self, ttl=300):
+        """Initializes the cache.
+
+        :param ttl: time in seconds an entry is kept, entries are not cached
+            if zero
+        :type ttl: ``float``
+        """
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def make_key(host, port):
+        """Builds the key of a SAP Router, as hops can hold either strings or
+        bytes and ports can be numbers or service names.
+
+        :rtype: ``tuple``
+        """
+        if isinstance(host, bytes):
+            host = host.decode()
+        if isinstance(port, bytes):
+            port = port.decode()
+        return host, str(port)
+
+    def get(self, host, port):
+        """Returns the capabilities of a SAP Router if cached and not expired.
+
+        :param host: SAP Router address
+        :type host: C{string}
+
+        :param port: SAP Router port
+        :type port: ``int``
+
+        :return: capabilities or None if not cached
+        :rtype: :class:`SAPRouterCapabilities`
+        """
+        key = self.make_key(host, port)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= monotonic():
+                del self._entries[key]
+                entry = None
+        return entry
+
+    def get_version(self, host, port):
+        """Returns the cached NI version of a SAP Router.
+
+        :return: version or None if not cached
+        :rtype: ``int``
+        """
+        entry = self.get(host, port)
+        return entry.version if entry else None
+
+    def update(self, host, port, version=None, talk_mode=None):
+        """Stores the version and/or a talk mode accepted by a SAP Router,
+        renewing the entry's expiration.
+
+        :param host: SAP Router address
+        :type host: C{string}
+
+        :param port: SAP Router port
+        :type port: ``int``
+
+        :param version: NI version of the SAP Router
+        :type version: ``int``
+
+        :param talk_mode: talk mode accepted by the SAP Router
+        :type talk_mode: ``int``
+        """
+        if not self.ttl:
+            return
+        key = self.make_key(host, port)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires <= monotonic():
+                entry = self._entries[key] = SAPRouterCapabilities()
+            if version is not None:
+                entry.version = version
+            if talk_mode is not None:
+                entry.talk_modes.add(talk_mode)
+            entry.expires = monotonic() + self.ttl
+
+    def invalidate(self, host=None, port=None):
+        """Removes the entry of a SAP Router, or all the entries if no SAP
+        Router is specified.
+
+        :param host: SAP Router address
+        :type host: C{string}
+
+        :param port: SAP Router port
+        :type port: ``int``
+        """
+        with self._lock:
+            if host is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self.make_key(host, port), None)
+
+
+router_capabilities = SAPRouterCapabilityCache()
+""" Process-wide cache of SAP Router capabilities """
+
+
 class SAPRouteException(Exception):
     """Exception for SAP Router routing errors"""
 
 
+class SAPRouteVersionException(Exception):
+    """Exception for route requests rejected by the SAP Router for using a
+    wrong version or being invalid"""
+
+
 class SAPRoutedStreamSocket(SAPNIStreamSocket):
     """Stream socket implementation for a connection routed through a SAP
     Router server. It works by wrapping a :class:`SAPNIStreamSocket` and connecting
@@ -537,14 +1150,15 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
         :type sock: C{socket}
 
         :param route: a route to specify to the SAP Router
-        :type route: ``list`` of :class:`SAPRouterRouteHop`
+        :type route: :class:`SAPRouterRoute` or ``list`` of :class:`SAPRouterRouteHop`
 
         :param talk_mode: the talk mode to use when routing
         :type talk_mode: ``int``
 
         :param router_version: the router version to use for requesting the
-            route. If no router version is provided, it will be obtained from
-            the SAP Router by means of a control packet.
+            route. If no router version is provided, it will be taken from
+            :data:`router_capabilities` or obtained from the SAP Router by
+            means of a control packet.
         :type router_version: ``int``
 
         :param keep_alive: if true, the socket will automatically respond to
@@ -564,16 +1178,34 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
         SAPNIStreamSocket.__init__(self, sock, keep_alive=keep_alive,
                                    base_cls=base_cls)
         # Now that we've a NIStreamSocket, retrieve the router version if
-        # was not specified
+        # was not specified, either from the cache or from the router
+        router = route[0] if route else None
+        cached = False
+        if self.router_version is None and router is not None:
+            self.router_version = router_capabilities.get_version(router.hostname, router.port)
+            cached = self.router_version is not None
         if self.router_version is None:
             self.router_version = get_router_version(self)
-        self.route_to(route, talk_mode)
+            if router is not None:
+                router_capabilities.update(router.hostname, router.port,
+                                           version=self.router_version)
+        try:
+            self.route_to(route, talk_mode)
+        except SAPRouteVersionException:
+            # The cached version might be outdated, so it's retrieved again
+            # on the next connection
+            if cached:
+                router_capabilities.invalidate(router.hostname, router.port)
+            raise
+        if router is not None:
+            router_capabilities.update(router.hostname, router.port,
+                                       talk_mode=talk_mode or ROUTER_TALK_MODE_NI_MSG_IO)
 
     def route_to(self, route, talk_mode):
         """Make the route request to the target host/service.
 
         :param route: a route to specify to the SAP Router
-        :type route: ``list`` of :class:`SAPRouterRouteHop`
+        :type route: :class:`SAPRouterRoute` or ``list`` of :class:`SAPRouterRouteHop`
 
         :param talk_mode: the talk mode to use when routing
         :type talk_mode: ``int``
@@ -581,38 +1213,22 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
         :raise SAPRouteException: if the route request to the target host/port
             was not accepted by the SAP Router
 
+        :raise SAPRouteVersionException: if the SAP Router rejected the route
+            request for using a wrong version or being invalid
+
         :raise socket.error: if the connection to the target host/port failed
             or the SAP Router returned an error
         """
         # Build the route request packet
         talk_mode = talk_mode or ROUTER_TALK_MODE_NI_MSG_IO
-        router_strings = list(map(str, route))
         target = "%s:%d" % (route[-1].hostname, int(route[-1].port))
-        router_strings_lens = list(map(len, router_strings))
-
-        # hex values are counted as 5 characters \\x00
-        hex_pattern = r'\\x[0-9a-fA-F]{2}'
-        hex_count = 0
-        for route_string in router_strings:
-            hex_values= re.findall(hex_pattern, route_string)
-            hex_count += len(hex_values)
-
-        route_len = sum(router_strings_lens) - (hex_count * 4)
-        route_off = router_strings_lens[0] - len(re.findall(hex_pattern, router_strings[0]))*4
-
-
-        route_request = SAPRouter(type=SAPRouter.SAPROUTER_ROUTE,
-                                  route_ni_version=self.router_version,
-                                  route_entries=len(route),
-                                  route_talk_mode=talk_mode,
-                                  route_rest_nodes=len(route) - 1,
-                                  route_length=route_len,
-                                  route_offset=route_off,
-                                  route_string=route)
+        template = get_route_template(route[:-1], talk_mode, self.router_version)
+        route_request = template.render(route[-1].hostname, route[-1].port,
+                                        route[-1].password)
         log_saprouter.debug("Requesting route to %s using mode %d (%s)",
                             target, talk_mode, router_ni_talk_mode_values[talk_mode])
         # Send the request and grab the response
-        response = self.sr(route_request)
+        response = self.sr(Raw(route_request))
         response.decode_payload_as(SAPRouter)
         if SAPRouter in response:
             response = response[SAPRouter]
@@ -622,12 +1238,15 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
             elif router_is_error(response) and response.return_code == -94:
                 log_saprouter.debug("Route to %s denied", target)
                 raise SAPRouteException("Route request not accepted")
+            elif router_is_error(response) and response.return_code in router_version_return_codes:
+                log_saprouter.warning("Error requesting route to %s, invalid version", target)
+                raise SAPRouteVersionException("Router error:", response.err_text_value)
             else:
                 log_saprouter.warning("Error requesting route to %s", target)
                 raise Exception("Router error:", response.err_text_value)
         else:
             log_saprouter.warning("Error requesting route to %s", target)
-            raise Exception("Wrong response received")
+            raise SAPRouteVersionException("Wrong response received")
 
     def recv(self):
         """Receive a packet from the target host. If the talk mode in use is
@@ -639,7 +1258,14 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
         # need the NI layer anymore. Just use the plain socket inside the
         # NIStreamSockets.
         if self.routed and self.talk_mode == ROUTER_TALK_MODE_NI_RAW_IO:
-            return StreamSocket.recv(self)
+            # Data received along with the route response is still buffered
+            data = self.drain_buffer()
+            if data:
+                return (self.basecls or Raw)(data)
+            packet = StreamSocket.recv(self)
+            if packet is not None:
+                self.metrics.bytes_received += len(packet)
+            return packet
         # If the route was not accepted yet or we're working on non-native talk
         # mode, we need the NI layer.
         return SAPNIStreamSocket.recv(self)
@@ -656,19 +1282,26 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
         # need the NI layer anymore. Just use the plain socket inside the
         # NIStreamSockets.
         if self.routed and self.talk_mode == ROUTER_TALK_MODE_NI_RAW_IO:
-            return StreamSocket.send(self, packet)
+            sent = StreamSocket.send(self, packet)
+            self.metrics.bytes_sent += sent
+            return sent
         # If the route was not accepted yet or we're working on non-native talk
         # mode, we need the NI layer.
         return SAPNIStreamSocket.send(self, packet)
 
     @classmethod
     def get_nisocket(cls, host=None, port=None, route=None, password=None,
-                     talk_mode=None, router_version=None, **kwargs):
+                     talk_mode=None, router_version=None, pool=None, **kwargs):
         """Helper function to obtain a :class:`SAPRoutedStreamSocket`. If no
         route is specified, it returns a plain `SAPNIStreamSocket`. If no
         route is specified and the talk mode is raw, it returns a plain
         `StreamSocket` as it's assumed that the NI layer is not desired.
 
+        If a connection pool is specified, an idle connection to the same
+        target is reused if available, saving the connection setup and the
+        route request. The connection should be checked in back into the
+        pool with :class:`SAPNIConnectionPool.put` once done.
+
         :param host: target host to connect to if not specified in the route
         :type host: C{string}
 
@@ -676,7 +1309,7 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
         :type port: ``int``
 
         :param route: route to use for determining the SAP Router to connect
-        :type route: C{string} or ``list`` of :class:`SAPRouterRouteHop`
+        :type route: C{string}, :class:`SAPRouterRoute` or ``list`` of :class:`SAPRouterRouteHop`
 
         :param password: target password if not specified in the route
         :type password: C{string}
@@ -688,6 +1321,9 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
             route
         :type router_version: ``int``
 
+        :param pool: connection pool to take the connection from
+        :type pool: :class:`SAPNIConnectionPool`
+
         :keyword kwargs: arguments to pass to :class:`SAPRoutedStreamSocket`
             constructor
 
@@ -700,6 +1336,10 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
         :raise socket.error: if the connection to the target host/port failed
             or the SAP Router returned an error
         """
+        if pool is not None:
+            return pool.get(host, port, route, talk_mode, password=password,
+                            router_version=router_version, **kwargs)
+
         # If no route was provided, check the talk mode
         if route is None:
             # If talk mode is raw, create a new StreamSocket and get rid of the
@@ -715,17 +1355,17 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
             else:
                 return SAPNIStreamSocket.get_nisocket(host, port, **kwargs)
 
-        # If the route was provided using a route string, convert it to a
-        # list of hops
+        # If the route was provided using a route string, use the parsed
+        # route, otherwise build one from the list of hops
         if isinstance(route, str):
-            route = SAPRouterRouteHop.from_string(route)
+            route = parse_route_string(route)
+        else:
+            route = SAPRouterRoute.from_hops(route)
 
         # If the host and port were specified, we need to add a new hop to
         # the route
         if host is not None and port is not None:
-            route.append(SAPRouterRouteHop(hostname=host,
-                                           port=str(port),
-                                           password=password))
+            route = route.append(host, str(port), password)
 
         # Connect to the first hop in the route (it should be the SAP Router)
         sock = socket.create_connection((route[0].hostname, int(route[0].port)))
@@ -734,6 +1374,629 @@ class SAPRoutedStreamSocket(SAPNIStreamSocket):
         return cls(sock, route, talk_mode, router_version, **kwargs)
 
 
+class SAPNIConnectionPool(object):
+    """Pool of established NI connections
+
+    Keeps the connections returned by the callers for later reuse, keyed by
+    target host, port, route and talk mode. Connecting through a SAP Router
+    with a connection from the pool saves both the TCP connection setup and
+    the route request. Idle connections are evicted after a timeout or when
+    the pool is full, and checked before being reused.
+
+    The pool is thread-safe and can be used from asyncio code as well, where
+    new connections are established on the loop's default executor.
+
+    Example usage::
+
+        pool = SAPNIConnectionPool(max_size=16, idle_timeout=60)
+        with pool.connection(host, port, route=route) as conn:
+            response = conn.sr(packet)
+    """
+
+    def __init__(self, max_size=16, idle_timeout=60, health_check=True,
+                 health_check_timeout=1.0):
+        """Initializes the pool.
+
+        :param max_size: maximum number of idle connections kept in the pool
+        :type max_size: ``int``
+
+        :param idle_timeout: time in seconds after which an idle connection is
+            closed and evicted from the pool
+        :type idle_timeout: ``float``
+
+        :param health_check: if true, idle NI connections are checked with a
+            keep-alive request (NI_PING) before being reused
+        :type health_check: ``bool``
+
+        :param health_check_timeout: time in seconds to wait for the keep-alive
+            response (NI_PONG)
+        :type health_check_timeout: ``float``
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.health_check_timeout = health_check_timeout
+        self._idle = {}
+        self._keys = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def make_key(host=None, port=None, route=None, talk_mode=None, password=None):
+        """Builds the key identifying connections to the same target.
+
+        :return: pool key
+        :rtype: ``tuple``
+        """
+        if route is not None and not isinstance(route, str):
+            route = SAPRouterRouteHop.from_hops(route)
+        return (host, None if port is None else int(port), route or None,
+                talk_mode or None, password or None)
+
+    def __len__(self):
+        """Returns the number of idle connections in the pool."""
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+    def _pop_idle(self, key):
+        """Takes the most recently used idle connection for a key, evicting the
+        expired ones.
+        """
+        now = monotonic()
+        expired = []
+        connection = None
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    connection = candidate
+                    break
+                expired.append(candidate)
+            # Older connections in the same key expired as well
+            while idle and now - idle[0][1] >= self.idle_timeout:
+                expired.append(idle.popleft()[0])
+            if idle is not None and not idle:
+                del self._idle[key]
+        for candidate in expired:
+            self._close(candidate)
+        return connection
+
+    def get(self, host=None, port=None, route=None, talk_mode=None, **kwargs):
+        """Checks out a connection to the target, reusing an idle one from the
+        pool if available or establishing a new one otherwise. The parameters
+        are the ones of :class:`SAPRoutedStreamSocket.get_nisocket`.
+
+        :return: connected socket
+        :rtype: :class:`SAPNIStreamSocket`
+
+        :raise SAPRouteException: if the route request to the target host/port
+            was not accepted by the SAP Router
+
+        :raise socket.error: if the connection to the target host/port failed
+        """
+        key = self.make_key(host, port, route, talk_mode, kwargs.get("password"))
+        while True:
+            connection = self._pop_idle(key)
+            if connection is None:
+                break
+            if self.check(connection):
+                log_saprouter.debug("SAPNIConnectionPool: Reusing connection to %s", key)
+                if "base_cls" in kwargs and isinstance(connection, SAPNIStreamSocket):
+                    connection.basecls = kwargs["base_cls"]
+                break
+            log_saprouter.debug("SAPNIConnectionPool: Discarding stale connection to %s", key)
+            self._close(connection)
+
+        if connection is None:
+            log_saprouter.debug("SAPNIConnectionPool: New connection to %s", key)
+            connection = SAPRoutedStreamSocket.get_nisocket(host, port, route,
+                                                            talk_mode=talk_mode, **kwargs)
+        with self._lock:
+            self._keys[connection] = key
+        return connection
+
+    def put(self, connection):
+        """Checks a connection in, keeping it in the pool for later reuse.
+
+        :param connection: connection previously obtained from the pool
+        :type connection: :class:`SAPNIStreamSocket`
+        """
+        evicted = []
+        with self._lock:
+            key = self._keys.pop(connection, None)
+            if key is None or connection.closed:
+                evicted.append(connection)
+            else:
+                self._idle.setdefault(key, deque()).append((connection, monotonic()))
+                # Evict the least recently used connections if the pool is full
+                while sum(len(idle) for idle in self._idle.values()) > self.max_size:
+                    oldest = min(self._idle, key=lambda k: self._idle[k][0][1])
+                    evicted.append(self._idle[oldest].popleft()[0])
+                    if not self._idle[oldest]:
+                        del self._idle[oldest]
+        for candidate in evicted:
+            self._close(candidate)
+
+    def discard(self, connection):
+        """Closes a connection obtained from the pool instead of returning it,
+        e.g. when it's left in an unknown state after an error.
+
+        :param connection: connection previously obtained from the pool
+        :type connection: :class:`SAPNIStreamSocket`
+        """
+        with self._lock:
+            self._keys.pop(connection, None)
+        self._close(connection)
+
+    def check(self, connection):
+        """Checks if an idle connection is still usable. Connections with data
+        pending or closed by the peer are discarded, and NI connections are
+        checked with a keep-alive request if health checks are enabled.
+
+        :param connection: connection to check
+        :type connection: :class:`SAPNIStreamSocket`
+
+        :return: if the connection can be reused
+        :rtype: ``bool``
+        """
+        try:
+            if connection.closed or select([connection.ins], [], [], 0)[0]:
+                return False
+            if isinstance(connection, SAPNIStreamSocket) and connection.has_pending_frame():
+                return False
+            if not self.health_check or not self._is_ni(connection):
+                return True
+
+            timeout = connection.ins.gettimeout()
+            connection.ins.settimeout(self.health_check_timeout)
+            try:
+                SAPNIStreamSocket.send(connection, Raw(SAPNI.SAPNI_PING))
+                response = connection.recv_frame()
+            finally:
+                connection.ins.settimeout(timeout)
+            return bytes(response[4:]) == SAPNI.SAPNI_PONG.encode()
+        except (SocketError, OSError, ValueError):
+            return False
+
+    @staticmethod
+    def _is_ni(connection):
+        """Returns if the connection talks the NI protocol with the target."""
+        if not isinstance(connection, SAPNIStreamSocket):
+            return False
+        return not (isinstance(connection, SAPRoutedStreamSocket) and
+                    connection.talk_mode == ROUTER_TALK_MODE_NI_RAW_IO)
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except (SocketError, OSError):
+            pass
+
+    def evict_idle(self):
+        """Closes and evicts the idle connections that reached the timeout.
+        """
+        now = monotonic()
+        expired = []
+        with self._lock:
+            for key in list(self._idle):
+                idle = self._idle[key]
+                while idle and now - idle[0][1] >= self.idle_timeout:
+                    expired.append(idle.popleft()[0])
+                if not idle:
+                    del self._idle[key]
+        for connection in expired:
+            self._close(connection)
+
+    def close(self):
+        """Closes all the idle connections in the pool.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                self._close(connection)
+
+    @contextmanager
+    def connection(self, host=None, port=None, route=None, talk_mode=None, **kwargs):
+        """Context manager checking out a connection from the pool and checking
+        it in when done. The connection is discarded if an exception is raised.
+        """
+        connection = self.get(host, port, route, talk_mode, **kwargs)
+        try:
+            yield connection
+        except BaseException:
+            self.discard(connection)
+            raise
+        self.put(connection)
+
+    async def get_async(self, host=None, port=None, route=None, talk_mode=None, **kwargs):
+        """Coroutine checking out a connection from the pool, without blocking
+        the event loop while the connection is established or checked.
+
+        :return: connected socket
+        :rtype: :class:`SAPNIStreamSocket`
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: self.get(host, port, route,
+                                                                 talk_mode, **kwargs))
+
+    @asynccontextmanager
+    async def connection_async(self, host=None, port=None, route=None, talk_mode=None, **kwargs):
+        """Asynchronous context manager counterpart of :class:`connection`.
+        """
+        connection = await self.get_async(host, port, route, talk_mode, **kwargs)
+        try:
+            yield connection
+        except BaseException:
+            self.discard(connection)
+            raise
+        self.put(connection)
+
+
+SAPRouterScanResult = namedtuple("SAPRouterScanResult", ["router", "host", "port", "status", "error"])
+""" Result of a route probe performed by :class:`SAPRouterScanner`. The status
+    is one of `open`, `denied` or `error`, and the error holds the exception or
+    router error message if any. """
+
+
+class SAPRouterRateLimiter(object):
+    """Limits the rate of asyncio operations, spacing them evenly in time."""
+
+    def __init__(self, rate):
+        """Initializes the rate limiter.
+
+        :param rate: maximum number of operations per second
+        :type rate: ``float``
+        """
+        self.interval = 1.0 / rate
+        self._next = 0
+
+    async def acquire(self):
+        """Waits until the next operation is allowed."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class SAPRouterScanner(object):
+    """Concurrent route scanner
+
+    Requests routes to a set of target hosts and ports through one or more SAP
+    Routers using asyncio, reporting for each target whether the route was
+    accepted (`open`), denied by the route permission table (`denied`) or
+    failed (`error`). Route requests are rendered from a template compiled
+    once for each SAP Router, in the same way :class:`SAPRoutedStreamSocket`
+    does.
+
+    The number of concurrent probes is bounded, and probes sent to each SAP
+    Router can be rate limited. Probes failing with transient errors like
+    timeouts or connection resets are retried.
+
+    Example usage::
+
+        scanner = SAPRouterScanner(concurrency=64, rate=20)
+        async for result in scanner.scan(targets, router=(router_host, router_port)):
+            print(result)
+    """
+
+    STATUS_OPEN = "open"
+    STATUS_DENIED = "denied"
+    STATUS_ERROR = "error"
+
+    def __init__(self, concurrency=64, rate=None, timeout=5.0, retries=2,
+                 retry_delay=0.5, talk_mode=ROUTER_TALK_MODE_NI_RAW_IO,
+                 router_version=None):
+        """Initializes the scanner.
+
+        :param concurrency: maximum number of probes in progress
+        :type concurrency: ``int``
+
+        :param rate: maximum number of probes per second sent to each SAP
+            Router, unlimited if not specified
+        :type rate: ``float``
+
+        :param timeout: time in seconds to wait for each probe
+        :type timeout: ``float``
+
+        :param retries: number of retries of probes failing with transient
+            errors
+        :type retries: ``int``
+
+        :param retry_delay: time in seconds to wait before the first retry,
+            doubled on each following one
+        :type retry_delay: ``float``
+
+        :param talk_mode: the talk mode to use when requesting the routes
+        :type talk_mode: ``int``
+
+        :param router_version: the router version to use when requesting the
+            routes, retrieved from each SAP Router if not specified
+        :type router_version: ``int``
+        """
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.talk_mode = talk_mode
+        self.router_version = router_version
+        self._limiters = {}
+        self._versions = {}
+
+    @staticmethod
+    async def _sr(router, request):
+        """Connects to a SAP Router, sends a request, either a packet or an
+        already built NI frame, and returns the response.
+        """
+        reader, writer = await asyncio.open_connection(*router)
+        try:
+            writer.write(request if isinstance(request, bytes) else bytes(SAPNI() / request))
+            await writer.drain()
+            (length, ) = unpack("!I", await reader.readexactly(4))
+            return SAPRouter(await reader.readexactly(length))
+        finally:
+            writer.close()
+
+    async def get_router_version(self, router):
+        """Retrieves the version of a SAP Router, caching it for the following
+        probes. See :class:`get_router_version`.
+
+        :param router: SAP Router address and port
+        :type router: ``tuple``
+
+        :return: version
+        :rtype: ``int``
+        """
+        if self.router_version:
+            return self.router_version
+        version = router_capabilities.get_version(*router)
+        if version is not None:
+            return version
+        if router not in self._versions:
+            request = SAPRouter(type=SAPRouter.SAPROUTER_CONTROL,
+                                version=SAPRouter.SAPROUTER_DEFAULT_VERSION,
+                                opcode=1)
+            self._versions[router] = asyncio.ensure_future(
+                asyncio.wait_for(self._sr(router, request), self.timeout))
+            self._versions[router].add_done_callback(lambda future: self._version_done(router, future))
+        # The request is shared by all the probes to the SAP Router, so it's
+        # shielded from the cancellation of the probe awaiting it
+        response = await asyncio.shield(self._versions[router])
+        router_capabilities.update(router[0], router[1], version=response.version)
+        return response.version
+
+    def _version_done(self, router, future):
+        """Discards a failed version request, so the next probe tries again.
+        The error is retrieved even if all the probes waiting for the request
+        were cancelled.
+        """
+        if (future.cancelled() or future.exception() is not None) and self._versions.get(router) is future:
+            del self._versions[router]
+
+    async def _probe(self, router, host, port):
+        """Requests a route to the target and interprets the response."""
+        template = get_route_template([SAPRouterRouteHop(hostname=str(router[0]),
+                                                         port=str(router[1]))],
+                                      self.talk_mode, await self.get_router_version(router))
+        response = await self._sr(router, template.render_frame(host, port))
+        if router_is_pong(response):
+            router_capabilities.update(router[0], router[1], talk_mode=self.talk_mode)
+            return self.STATUS_OPEN, None
+        if router_is_error(response):
+            if response.return_code == -94:
+                return self.STATUS_DENIED, None
+            error = None
+            if response.err_text_length:
+                error = response.err_text_value.error.decode("utf-8", "replace")
+            return self.STATUS_ERROR, error or router_return_codes.get(response.return_code)
+        return self.STATUS_ERROR, "Wrong response received"
+
+    async def probe(self, router, host, port):
+        """Requests a route to a target through a SAP Router, retrying on
+        transient errors.
+
+        :param router: SAP Router address and port
+        :type router: ``tuple``
+
+        :param host: target host
+        :type host: C{string}
+
+        :param port: target port
+        :type port: ``int``
+
+        :return: result of the probe
+        :rtype: :class:`SAPRouterScanResult`
+        """
+        limiter = None
+        if self.rate:
+            limiter = self._limiters.setdefault(router, SAPRouterRateLimiter(self.rate))
+
+        for attempt in range(self.retries + 1):
+            if limiter:
+                await limiter.acquire()
+            try:
+                status, error = await asyncio.wait_for(self._probe(router, host, port),
+                                                       self.timeout)
+                return SAPRouterScanResult(router, host, port, status, error)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError) as e:
+                log_saprouter.debug("SAPRouterScanner: Probe to %s:%s failed (%s), attempt %d",
+                                    host, port, e, attempt + 1)
+                error = e
+                if attempt < self.retries:
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+            except Exception as e:
+                log_saprouter.debug("SAPRouterScanner: Probe to %s:%s failed (%s)", host, port, e)
+                error = e
+                break
+        return SAPRouterScanResult(router, host, port, self.STATUS_ERROR, error)
+
+    async def scan(self, targets, router=None):
+        """Probes a set of targets, yielding the results as they arrive.
+
+        :param targets: targets to probe, as (host, port) tuples if the SAP
+            Router is specified, or (router, host, port) tuples otherwise
+        :type targets: iterable
+
+        :param router: SAP Router address and port to use for all targets
+        :type router: ``tuple``
+
+        :return: results of the probes, in no particular order
+        :rtype: async iterator of :class:`SAPRouterScanResult`
+        """
+        targets = iter(targets)
+        results = asyncio.Queue()
+        done = object()
+
+        async def worker():
+            # Targets are taken lazily, so large target sets are not expanded
+            for target in targets:
+                if router is not None:
+                    target = (router, ) + tuple(target)
+                await results.put(await self.probe(*target))
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        runner = asyncio.gather(*workers)
+        runner.add_done_callback(lambda _: results.put_nowait(done))
+        try:
+            while True:
+                result = await results.get()
+                if result is done:
+                    break
+                yield result
+            # Propagate errors raised by the workers, if any
+            await runner
+        finally:
+            for task in workers:
+                task.cancel()
+
+
+class SAPRouterRoutePool(object):
+    """Pool of warm routes
+
+    Keeps a number of routes already established through a SAP Router, so
+    new clients of a :class:`SAPRouterNativeProxy` don't need to wait for the
+    connection with the SAP Router and the route request. Routes are used
+    once, and the pool is refilled in a background thread. Routes idle for
+    too long or closed by the SAP Router are discarded.
+    """
+
+    def __init__(self, factory, size, idle_timeout=60, retry_delay=1.0):
+        """Initializes the pool.
+
+        :param factory: function establishing a new route
+        :type factory: ``callable``
+
+        :param size: number of routes to keep established
+        :type size: ``int``
+
+        :param idle_timeout: time in seconds after which an unused route is
+            discarded
+        :type idle_timeout: ``float``
+
+        :param retry_delay: time in seconds to wait before trying again if a
+            route can't be established
+        :type retry_delay: ``float``
+        """
+        self.factory = factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.retry_delay = retry_delay
+        self._routes = deque()
+        self._lock = Lock()
+        self._refill = Event()
+        self._stopped = Event()
+        self._thread = None
+
+    def __len__(self):
+        """Returns the number of routes ready to use."""
+        return len(self._routes)
+
+    @staticmethod
+    def _is_alive(router):
+        """Returns if the SAP Router didn't close a route. Data sent by the
+        target is left in the socket for the client."""
+        try:
+            return router.ins.recv(1, MSG_PEEK | MSG_DONTWAIT) != b""
+        except (BlockingIOError, InterruptedError):
+            return True
+        except (SocketError, OSError, ValueError):
+            return False
+
+    def put(self, router):
+        """Adds an established route to the pool.
+
+        :param router: routed socket
+        :type router: :class:`SAPNIStreamSocket`
+        """
+        with self._lock:
+            self._routes.append((router, monotonic()))
+
+    def get(self):
+        """Takes a route from the pool and triggers the refill.
+
+        :return: routed socket, or None if there are no routes ready
+        :rtype: :class:`SAPNIStreamSocket`
+        """
+        discarded = []
+        router = None
+        with self._lock:
+            while self._routes:
+                # The most recent routes are the least likely to be timed out
+                candidate, established = self._routes.pop()
+                if monotonic() - established < self.idle_timeout and self._is_alive(candidate):
+                    router = candidate
+                    break
+                discarded.append(candidate)
+        for candidate in discarded:
+            candidate.close()
+        self._refill.set()
+        return router
+
+    def _evict_expired(self):
+        expired = []
+        with self._lock:
+            while self._routes and monotonic() - self._routes[0][1] >= self.idle_timeout:
+                expired.append(self._routes.popleft()[0])
+        for router in expired:
+            router.close()
+
+    def run(self):
+        """Keeps the pool filled until stopped."""
+        while not self._stopped.is_set():
+            self._evict_expired()
+            while len(self._routes) < self.size and not self._stopped.is_set():
+                try:
+                    self.put(self.factory())
+                except Exception as e:
+                    log_saprouter.warning("SAPRouterRoutePool: Error establishing route (%s)", e)
+                    self._stopped.wait(self.retry_delay)
+            self._refill.wait(self.idle_timeout / 2.0 if self.idle_timeout else None)
+            self._refill.clear()
+
+    def start(self):
+        """Starts refilling the pool in a background thread."""
+        self._stopped.clear()
+        self._thread = Thread(target=self.run, name="SAPRouterRoutePool")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and closes the routes in the pool."""
+        self._stopped.set()
+        self._refill.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            routes, self._routes = self._routes, deque()
+        for router, _ in routes:
+            router.close()
+
+
 class SAPRouterNativeProxy(SAPNIProxy):
     """SAP Router Native Proxy
 
@@ -752,11 +2015,17 @@ class SAPRouterNativeProxy(SAPNIProxy):
                                      target_post=target_port,
                                      target_pass=target_pass)
         proxy.handle_connection()
+
+    Requesting a route blocks, so when serving clients on the event loop the
+    routes are requested from a pool of threads.
     """
 
+    blocking_connect = True
+
     def __init__(self, bind_address, bind_port, remote_address, remote_port,
                  handler, target_address, target_port, target_pass=None,
-                 talk_mode=ROUTER_TALK_MODE_NI_MSG_IO, backlog=5, keep_alive=True, options=None):
+                 talk_mode=ROUTER_TALK_MODE_NI_MSG_IO, backlog=5, keep_alive=True, options=None,
+                 passthrough=False, warm_routes=0, warm_routes_timeout=60):
         """Create the proxy binding a socket in the giving port, requesting the
         route to the target address/port and setting the handler for the
         incoming connections.
@@ -799,19 +2068,39 @@ class SAPRouterNativeProxy(SAPNIProxy):
         :param options: options to pass to the handler instance
         :type options: ``dict``
 
+        :param passthrough: if true and the handler doesn't process the
+            packets, data is forwarded using zero-copy transfers where
+            available
+        :type passthrough: ``bool``
+
+        :param warm_routes: number of routes to keep established in advance
+            for new clients, disabled if zero
+        :type warm_routes: ``int``
+
+        :param warm_routes_timeout: time in seconds after which an unused warm
+            route is discarded
+        :type warm_routes_timeout: ``float``
+
         :raise SAPRouteException: if the route request is denied
         :raise Exception: if an error occurred when requesting the route
         """
         super(SAPRouterNativeProxy, self).__init__(bind_address, bind_port,
                                                    remote_address, remote_port,
                                                    handler or SAPRouterNativeRouterHandler,
-                                                   backlog, keep_alive, options)
+                                                   backlog, keep_alive, options, passthrough)
         self.target_address = target_address
         self.target_port = target_port
         self.target_pass = target_pass
         self.talk_mode = talk_mode
         self.routed = False
-        self.route()
+        router = self.route()
+
+        self.route_pool = None
+        if warm_routes:
+            # The route used to check the target seeds the pool
+            self.route_pool = SAPRouterRoutePool(self.route, warm_routes, warm_routes_timeout)
+            self.route_pool.put(router)
+            self.route_pool.start()
 
     def handle_connection(self):
         """Block until a connection is received from the listener, request
@@ -825,14 +2114,69 @@ class SAPRouterNativeProxy(SAPNIProxy):
         (client, __) = self.listener.ins.accept()
 
         # Creates a remote socket
-        router = self.route()
+        router = self.get_route()
 
         # Create the NI Stream Socket and handle it
         proxy = self.handler(SAPNIStreamSocket(client, self.keep_alive),
                              router,
-                             self.options)
+                             self.options, passthrough=self.passthrough)
         return proxy
 
+    def _connect_remote(self):
+        """Requests the route through the remote SAP Router for a new client
+        served by the event loop. Called from the pool of threads of the event
+        loop, as it blocks until the route is established.
+
+        :return: routed socket
+        :rtype: :class:`SAPNIStreamSocket`
+        """
+        router = self.get_route()
+        router.ins.setblocking(False)
+        return router
+
+    def get_route(self):
+        """Returns a route for a new client, taken from the warm routes if
+        available or requested otherwise.
+
+        :return: routed socket
+        :rtype: :class:`SAPNIStreamSocket`
+
+        :raise SAPRouteException: if the route request is denied
+        :raise Exception: if an error occurred when requesting the route
+        """
+        if self.route_pool is not None:
+            router = self.route_pool.get()
+            if router is not None:
+                log_saprouter.debug("Using warm route to %s:%d", self.target_address, self.target_port)
+                return router
+        return self.route()
+
+    def stop(self):
+        """Stops the proxy and closes the warm routes.
+        """
+        if self.route_pool is not None:
+            self.route_pool.stop()
+        super(SAPRouterNativeProxy, self).stop()
+
+    def _read_packets(self, connection, local):
+        """Reads the native data available on the local socket, bypassing the
+        SAP NI layer.
+
+        :return: packets received
+        :rtype: ``list`` of :class:`Raw`
+        """
+        data = local.drain_buffer() or local.ins.recv(connection.handler.mtu)
+        if len(data) == 0:
+            raise SocketError((100, "Underlying stream socket tore down"))
+        return [Raw(data)]
+
+    def _build_packet(self, packet):
+        """Builds a native packet to send it to the peer.
+
+        :rtype: ``bytes``
+        """
+        return bytes(packet)
+
     def route(self):
         """Requests a route to forward the traffic through the remote SAP
         Router.
@@ -849,21 +2193,12 @@ class SAPRouterNativeProxy(SAPNIProxy):
 
         # Build the Route request packet
         if self.options.target_route_string is None:
-            router_string = [SAPRouterRouteHop(hostname=remote_address,
-                                               port=remote_port),
-                             SAPRouterRouteHop(hostname=self.target_address,
-                                               port=self.target_port,
-                                               password=self.target_pass)]
+            route = SAPRouterRoute([SAPRouterHop(remote_address, remote_port, None),
+                                    SAPRouterHop(self.target_address, self.target_port,
+                                                 self.target_pass)])
         else:
-            router_string = SAPRouterRouteHop.from_string(self.options.target_route_string)
-        router_string_lens = list(map(len, list(map(str, router_string))))
-        p = SAPRouter(type=SAPRouter.SAPROUTER_ROUTE,
-                      route_entries=len(router_string),
-                      route_talk_mode=self.talk_mode,
-                      route_rest_nodes=len(router_string) - 1,
-                      route_length=sum(router_string_lens),
-                      route_offset=router_string_lens[0],
-                      route_string=router_string)
+            route = parse_route_string(self.options.target_route_string)
+        p = Raw(route.render_request(self.talk_mode))
 
         # Send the request and grab the response
         response = router.sr(p)
@@ -897,10 +2232,20 @@ class SAPRouterNativeRouterHandler(SAPNIProxyHandler):
     the SAP NI layer in order to allow native traffic.
     """
 
-    def __init__(self, client, server, options=None):
+    def __init__(self, client, server, options=None, threaded=True, passthrough=False):
         self.options = options
         self.mtu = 2048
-        super(SAPRouterNativeRouterHandler, self).__init__(client, server, options)
+        super(SAPRouterNativeRouterHandler, self).__init__(client, server, options, threaded, passthrough)
+
+    @classmethod
+    def can_passthrough(cls):
+        """Native data is never processed, so it can be forwarded as is unless
+        the way it's received and sent was changed.
+
+        :return: if the native data is forwarded without modifying it
+        :rtype: ``bool``
+        """
+        return cls.recv_send is SAPRouterNativeRouterHandler.recv_send
 
     def recv_send(self, local, remote, process):
         """Receives data from one socket connection, process it and send to the
@@ -915,8 +2260,9 @@ class SAPRouterNativeRouterHandler(SAPNIProxyHandler):
         :param process: the function that process the incoming data
         :type process: function
         """
-        # Receive a native packet (not SAP NI)
-        packet = local.ins.recv(self.mtu)
+        # Receive a native packet (not SAP NI), starting with any data left in
+        # the NI receive buffer after the route was accepted
+        packet = local.drain_buffer() or local.ins.recv(self.mtu)
         log_saprouter.debug("Received %d native bytes", len(packet))
 
         # Handle close connection
@@ -929,5 +2275,889 @@ class SAPRouterNativeRouterHandler(SAPNIProxyHandler):
         log_saprouter.debug("Sent %d native bytes", len(packet))
 
 
+SAPRouterRouteTableEntry = namedtuple("SAPRouterRouteTableEntry",
+                                      ["action", "source", "host", "service", "password", "snc_name"],
+                                      defaults=(None, None))
+""" Entry of a :class:`SAPRouterRouteTable` """
+
+
+SAPRouterRouteCheck = namedtuple("SAPRouterRouteCheck", ["host", "port", "permitted", "entry"])
+""" Result of evaluating a route against a :class:`SAPRouterRouteTable` """
+
+
+def router_host_intervals(pattern):
+    """Parses an IPv4 host pattern into a list of address intervals. Patterns
+    can be single addresses, networks in CIDR notation (e.g. `10.0.0.0/24`),
+    ranges of addresses (e.g. `10.0.0.1-10.0.0.20`), or addresses with octet
+    wildcards or ranges (e.g. `10.0.*.*` or `10.0.1-5.1`).
+
+    :param pattern: host pattern
+    :type pattern: C{string}
+
+    :return: sorted list of (first, last) addresses as integers, or None if
+        the pattern is not an IPv4 pattern (e.g. a hostname)
+    :rtype: ``list`` of ``tuple``
+    """
+    try:
+        if "/" in pattern:
+            network = ip_network(pattern, strict=False)
+            return [(int(network.network_address), int(network.broadcast_address))]
+        if pattern.count(".") == 6 and "-" in pattern:
+            (first, last) = pattern.split("-", 1)
+            return [(int(IPv4Address(first)), int(IPv4Address(last)))]
+    except ValueError:
+        return None
+
+    octets = []
+    for octet in pattern.split("."):
+        if octet == "*":
+            octets.append((0, 255))
+        elif octet.isdigit():
+            octets.append((int(octet), int(octet)))
+        elif octet.count("-") == 1 and octet.replace("-", "").isdigit() and not octet.startswith("-"):
+            (low, high) = octet.split("-")
+            octets.append((int(low), int(high)))
+        else:
+            return None
+    if len(octets) != 4 or any(low > high or high > 255 for (low, high) in octets):
+        return None
+
+    # Octets after the last octet which is not a wildcard are collapsed in a
+    # single interval, the previous ones are expanded
+    full = 4
+    while full and octets[full - 1] == (0, 255):
+        full -= 1
+    intervals = [(0, 0)]
+    for index, (low, high) in enumerate(octets):
+        shift = 8 * (3 - index)
+        if index < full - 1:
+            intervals = [(base + (value << shift), base + (value << shift))
+                         for (base, __) in intervals for value in range(low, high + 1)]
+        else:
+            intervals = [(first + (low << shift), last + (high << shift)) for (first, last) in intervals]
+    return sorted(intervals)
+
+
+def iter_router_hosts(pattern):
+    """Iterates over the hosts of a pattern, expanding IPv4 ranges and
+    networks as accepted by :class:`router_host_intervals`.
+
+    :param pattern: host pattern or hostname
+    :type pattern: C{string}
+
+    :return: hosts
+    :rtype: iterator of C{string}
+    """
+    intervals = router_host_intervals(pattern)
+    if intervals is None:
+        yield pattern
+        return
+    for (first, last) in intervals:
+        for address in range(first, last + 1):
+            yield str(IPv4Address(address))
+
+
+def _parse_ipv4(host):
+    try:
+        return int(IPv4Address(host))
+    except ValueError:
+        return None
+
+
+class SAPRouterHostPattern(object):
+    """Host pattern of a :class:`SAPRouterRouteTable` entry. Patterns can be
+    `*`, IPv4 patterns as accepted by :class:`router_host_intervals`, or
+    hostnames including `*` and `?` wildcards.
+    """
+
+    __slots__ = ("pattern", "intervals", "starts", "any")
+
+    def __init__(self, pattern):
+        self.pattern = pattern.lower()
+        self.any = self.pattern == "*"
+        self.intervals = None if self.any else router_host_intervals(self.pattern)
+        self.starts = [first for (first, __) in self.intervals] if self.intervals else None
+
+    def match(self, host, address=None):
+        """Checks if a host matches the pattern.
+
+        :param host: host to check
+        :type host: C{string}
+
+        :param address: IPv4 address of the host as integer, if it's an
+            address
+        :type address: ``int``
+
+        :rtype: ``bool``
+        """
+        if self.any:
+            return True
+        if self.intervals is not None:
+            if address is None:
+                return False
+            index = bisect_right(self.starts, address) - 1
+            return index >= 0 and address <= self.intervals[index][1]
+        return fnmatchcase(host.lower(), self.pattern)
+
+
+class SAPRouterRouteTable(object):
+    """SAP Router route permission table
+
+    Keeps saprouttab-style entries permitting or denying routes from source
+    hosts to destination hosts and services. Entries are evaluated in order
+    and the first one matching the route is applied. Routes not matching any
+    entry are denied. Supported entry types are:
+
+        - `P`: permit the route, optionally requiring a password
+        - `S`: permit the route only for SAP protocol (NI talk mode) routes
+        - `D`: deny the route
+        - `KP`, `KS` and `KD`: same as `P`, `S` and `D` for SNC-protected
+          clients with a matching SNC name
+        - `KT`: permit the route, establishing an SNC-protected connection
+          with the next hop identified by the SNC name
+
+    Hosts can be `*`, IPv4 patterns as accepted by :class:`router_host_intervals`
+    or hostnames with wildcards. Services can be `*`, a port number or service
+    name, a range of ports (e.g. `3200-3299`) or a port or service name with
+    wildcards (e.g. `32*`).
+
+    Entries are compiled into an index keyed on the destination host, with
+    the IPv4 patterns as sorted address intervals and the hostnames in a
+    dictionary, so only the few entries that might apply to a host are
+    checked on each lookup.
+
+    Example usage::
+
+        table = SAPRouterRouteTable.from_string("P * 10.0.0.* 3200-3299\\nD * * *")
+        table.check("192.168.1.1", "10.0.0.1", 3200)
+        for result in table.evaluate([("10.0.0.1", 3200), "/H/10.0.1.1/S/3300"]):
+            print(result.host, result.port, result.permitted)
+    """
+
+    ROUTE_PERMIT = "P"
+    ROUTE_PERMIT_SAP = "S"
+    ROUTE_DENY = "D"
+    ROUTE_SNC_PERMIT = "KP"
+    ROUTE_SNC_PERMIT_SAP = "KS"
+    ROUTE_SNC_DENY = "KD"
+    ROUTE_SNC_TARGET = "KT"
+
+    route_actions = [ROUTE_PERMIT, ROUTE_PERMIT_SAP, ROUTE_DENY, ROUTE_SNC_PERMIT,
+                     ROUTE_SNC_PERMIT_SAP, ROUTE_SNC_DENY, ROUTE_SNC_TARGET]
+    """ :cvar: List of supported entry types
+        :type: ``list`` of C{string} """
+
+    def __init__(self, entries=None):
+        """Creates the route table.
+
+        :param entries: entries of the route table
+        :type entries: ``list`` of :class:`SAPRouterRouteTableEntry`
+        """
+        self.entries = []
+        self._index = None
+        for entry in entries or []:
+            self.add(*entry)
+
+    def add(self, action, source="*", host="*", service="*", password=None, snc_name=None):
+        """Adds an entry at the end of the route table.
+
+        :param action: type of the entry
+        :type action: C{string}
+
+        :param source: source host
+        :type source: C{string}
+
+        :param host: destination host
+        :type host: C{string}
+
+        :param service: destination service
+        :type service: C{string}
+
+        :param password: password required for the route
+        :type password: C{string}
+
+        :param snc_name: SNC name of the client for `KP`, `KS` and `KD`
+            entries, or of the next hop for `KT` entries
+        :type snc_name: C{string}
+
+        :raise ValueError: if the entry type is not supported
+        """
+        action = action.upper()
+        if action not in self.route_actions:
+            raise ValueError("Unsupported route table entry type %s" % action)
+        if action.startswith("K") and not snc_name:
+            raise ValueError("SNC name required for route table entry type %s" % action)
+        self.entries.append(SAPRouterRouteTableEntry(action, source, host, str(service), password, snc_name))
+        self._index = None
+
+    @classmethod
+    def from_string(cls, text):
+        """Parses a route table in saprouttab format. Empty lines and comments
+        starting with `#` are skipped. SNC names containing spaces should be
+        quoted. Entries have the following formats::
+
+            P/S/D <source host> <destination host> <service> [<password>]
+            KP/KS/KD <SNC name> <destination host> <service>
+            KT <SNC name> <source host> <destination host> <service>
+
+        :param text: route table content
+        :type text: C{string}
+
+        :return: route table
+        :rtype: :class:`SAPRouterRouteTable`
+
+        :raise ValueError: if an entry is not valid
+        """
+        table = cls()
+        for line in text.splitlines():
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            action = fields[0].upper()
+            if action == cls.ROUTE_SNC_TARGET and len(fields) == 5:
+                table.add(action, fields[2], fields[3], fields[4], snc_name=fields[1])
+            elif action.startswith("K") and len(fields) == 4:
+                table.add(action, "*", fields[2], fields[3], snc_name=fields[1])
+            elif not action.startswith("K") and 4 <= len(fields) <= 5:
+                table.add(*fields)
+            else:
+                raise ValueError("Invalid route table entry %s" % line.strip())
+        return table
+
+    @classmethod
+    def from_file(cls, filename):
+        """Parses a route table from a file in saprouttab format.
+
+        :param filename: name of the saprouttab file
+        :type filename: C{string}
+
+        :return: route table
+        :rtype: :class:`SAPRouterRouteTable`
+        """
+        with open(filename, 'r') as fd:
+            return cls.from_string(fd.read())
+
+    @staticmethod
+    def compile_service(pattern):
+        """Compiles the service of an entry into a (low, high) port range,
+        or a (match, None) tuple for service names and services with
+        wildcards (e.g. `32*`), where match is a function checking the
+        service.
+
+        :param pattern: service of the entry
+        :type pattern: C{string}
+
+        :rtype: ``tuple``
+        """
+        if pattern == "*":
+            return (0, 0xffff)
+        if pattern.isdigit():
+            return (int(pattern), int(pattern))
+        (low, __, high) = pattern.partition("-")
+        if low.isdigit() and high.isdigit():
+            return (int(low), int(high))
+        if "*" in pattern or "?" in pattern or "[" in pattern:
+            return (re.compile(translate(pattern)).match, None)
+        return (pattern.__eq__, None)
+
+    def compile(self):
+        """Compiles the index of the entries by destination host. It's done
+        automatically on the first lookup after the table is modified.
+        """
+        compiled = []
+        any_host, names, globs = [], {}, {}
+        events = {}
+        for index, entry in enumerate(self.entries):
+            host = SAPRouterHostPattern(entry.host)
+            compiled.append((SAPRouterHostPattern(entry.source),
+                             self.compile_service(entry.service),
+                             entry.action in (self.ROUTE_PERMIT_SAP, self.ROUTE_SNC_PERMIT_SAP),
+                             entry.action in (self.ROUTE_SNC_PERMIT, self.ROUTE_SNC_PERMIT_SAP,
+                                              self.ROUTE_SNC_DENY)))
+            if host.any:
+                any_host.append(index)
+            elif host.intervals is not None:
+                for (first, last) in host.intervals:
+                    events.setdefault(first, []).append((1, index))
+                    events.setdefault(last + 1, []).append((-1, index))
+            elif "*" in host.pattern or "?" in host.pattern or "[" in host.pattern:
+                globs.setdefault(host.pattern, []).append(index)
+            else:
+                names.setdefault(host.pattern, []).append(index)
+
+        # Split the address space in segments, each of them with the sorted
+        # list of entries whose intervals cover it
+        starts, candidates = [], []
+        active = {}
+        for address in sorted(events):
+            for (delta, index) in events[address]:
+                active[index] = active.get(index, 0) + delta
+                if not active[index]:
+                    del active[index]
+            starts.append(address)
+            candidates.append(tuple(sorted(set(active) | set(any_host))))
+
+        globs = [(re.compile(translate(pattern)).match, indexes) for (pattern, indexes) in globs.items()]
+        self._index = (compiled, tuple(any_host), names, globs, starts, candidates)
+
+    def candidates(self, host):
+        """Returns the entries that might apply to a destination host, in
+        order.
+
+        :param host: destination host
+        :type host: C{string}
+
+        :return: indexes of the entries
+        :rtype: ``list`` of ``int``
+        """
+        if self._index is None:
+            self.compile()
+        (__, any_host, names, globs, starts, candidates) = self._index
+        host = host.lower()
+        address = _parse_ipv4(host)
+        if address is not None:
+            segment = bisect_right(starts, address) - 1
+            found = candidates[segment] if segment >= 0 else any_host
+        else:
+            found = any_host + tuple(names.get(host, ()))
+        matching_globs = [index for (match, indexes) in globs if match(host) for index in indexes]
+        if matching_globs or address is None:
+            return sorted(set(found).union(matching_globs))
+        return found
+
+    def lookup(self, source, host, service, talk_mode=ROUTER_TALK_MODE_NI_MSG_IO, snc_name=None,
+               candidates=None):
+        """Returns the first entry matching a route.
+
+        :param source: source host of the route, or None to match only
+            entries for any source host
+        :type source: C{string}
+
+        :param host: destination host of the route
+        :type host: C{string}
+
+        :param service: destination service of the route
+        :type service: C{string}
+
+        :param talk_mode: talk mode of the route
+        :type talk_mode: ``int``
+
+        :param snc_name: SNC name of the client, if SNC-protected
+        :type snc_name: C{string}
+
+        :param candidates: entries that might apply to the destination host,
+            as returned by :class:`candidates`
+        :type candidates: ``list`` of ``int``
+
+        :return: matching entry, or None if no entry matches
+        :rtype: :class:`SAPRouterRouteTableEntry`
+        """
+        if candidates is None:
+            candidates = self.candidates(host)
+        compiled = self._index[0]
+        service = str(service)
+        port = int(service) if service.isdigit() else None
+        source_address = _parse_ipv4(source) if source is not None else None
+        for index in candidates:
+            (source_pattern, (low, high), sap_only, snc) = compiled[index]
+            if sap_only and talk_mode != ROUTER_TALK_MODE_NI_MSG_IO:
+                continue
+            if high is None:
+                if not low(service):
+                    continue
+            elif port is None or not low <= port <= high:
+                if (low, high) != (0, 0xffff):
+                    continue
+            entry = self.entries[index]
+            if snc:
+                if snc_name is None or not fnmatchcase(snc_name, entry.snc_name):
+                    continue
+            elif source is None:
+                if not source_pattern.any:
+                    continue
+            elif not source_pattern.match(source, source_address):
+                continue
+            return entry
+        return None
+
+    def is_permitted(self, entry, password=None):
+        """Returns if a route matching an entry is permitted.
+
+        :param entry: matching entry, or None if no entry matched
+        :type entry: :class:`SAPRouterRouteTableEntry`
+
+        :param password: password provided for the route
+        :type password: C{string}
+
+        :rtype: ``bool``
+        """
+        if entry is None or entry.action in (self.ROUTE_DENY, self.ROUTE_SNC_DENY):
+            return False
+        return not entry.password or entry.password == password
+
+    def check(self, source, host, service, password=None, talk_mode=ROUTER_TALK_MODE_NI_MSG_IO, snc_name=None):
+        """Checks if a route is permitted by the route table.
+
+        :param source: source host of the route
+        :type source: C{string}
+
+        :param host: destination host of the route
+        :type host: C{string}
+
+        :param service: destination service of the route
+        :type service: C{string}
+
+        :param password: password provided for the route
+        :type password: C{string}
+
+        :param talk_mode: talk mode of the route
+        :type talk_mode: ``int``
+
+        :param snc_name: SNC name of the client, if SNC-protected
+        :type snc_name: C{string}
+
+        :return: if the route is permitted
+        :rtype: ``bool``
+        """
+        return self.is_permitted(self.lookup(source, host, service, talk_mode, snc_name), password)
+
+    def evaluate(self, targets, source=None, password=None, talk_mode=ROUTER_TALK_MODE_NI_MSG_IO,
+                 snc_name=None):
+        """Evaluates a list of routes against the route table. The entries
+        that might apply to each destination host are looked up only once.
+
+        :param targets: targets to evaluate, either as (host, port) tuples,
+            where hosts can be IPv4 ranges as accepted by :class:`router_host_intervals`,
+            or as route strings whose last hop is the target
+        :type targets: iterable
+
+        :param source: source host of the routes, or None to match only
+            entries for any source host
+        :type source: C{string}
+
+        :param password: password provided for the routes
+        :type password: C{string}
+
+        :param talk_mode: talk mode of the routes
+        :type talk_mode: ``int``
+
+        :param snc_name: SNC name of the client, if SNC-protected
+        :type snc_name: C{string}
+
+        :return: results of the evaluation
+        :rtype: iterator of :class:`SAPRouterRouteCheck`
+        """
+        cache = {}
+        for target in targets:
+            if isinstance(target, str):
+                route = parse_route_string(target)
+                if not route:
+                    raise ValueError("Invalid route string %s" % target)
+                (host, port, route_password) = route[-1]
+                (hosts, target_password) = ([host], route_password or password)
+            else:
+                (hosts, port, target_password) = (iter_router_hosts(str(target[0])), target[1], password)
+            if str(port).isdigit():
+                port = int(port)
+            for host in hosts:
+                candidates = cache.get(host)
+                if candidates is None:
+                    if len(cache) > 65536:
+                        cache.clear()
+                    candidates = cache[host] = self.candidates(host)
+                entry = self.lookup(source, host, port, talk_mode, snc_name, candidates)
+                yield SAPRouterRouteCheck(host, port, self.is_permitted(entry, target_password), entry)
+
+
+class SAPRouterServerClient(SAPNIClient):
+    """Client connected to a :class:`SAPRouterServer` """
+
+    def __init__(self):
+        self.id = 0
+        self.address = ""
+        self.partner = ""
+        self.service = ""
+        self.connected_on = time()
+        self.routed = False
+        self.traced = False
+
+
+class SAPRouterServer(SAPNIServerThreaded):
+    """SAP Router server emulator
+
+    Accepts route requests from clients, checks them against a route table
+    and forwards the traffic between the client and the target once the route
+    is established, in both NI and raw talk modes. Routes through additional
+    SAP Routers are requested to the next hop. It also answers version
+    requests and information admin requests, and returns :class:`SAPRouterError`
+    error packets in the same way a SAP Router does.
+
+    Each client is served on its own thread. :class:`SAPRouterServerPreforked`
+    spreads the clients between several worker processes for load testing
+    with a large number of concurrent routes.
+
+    Example usage::
+
+        table = SAPRouterRouteTable.from_file("saprouttab")
+        server = SAPRouterServer(("127.0.0.1", 3299), route_table=table)
+        server.serve_forever()
+    """
+
+    clients_cls = SAPRouterServerClient
+
+    base_server_cls = SAPNIServerThreaded
+    """ :cvar: Base NI server class
+        :type: :class:`SAPNIServer` class """
+
+    error_texts = {
+        -90: "host unknown",
+        -91: "service unknown",
+        -92: "connection refused",
+        -93: "internal error",
+        -94: "route permission denied",
+        -99: "information request refused",
+        -101: "talk mode not allowed",
+    }
+    """ :cvar: Error texts for the return codes
+        :type: ``dict`` """
+
+    release = "721"
+    """ :cvar: Release reported in the error packets
+        :type: C{string} """
+
+    def __init__(self, server_address, RequestHandlerClass=None,
+                 bind_and_activate=True, route_table=None, router_version=None,
+                 talk_modes=None, info_password=None, connect_timeout=5.0, **kwargs):
+        """Creates the SAP Router server.
+
+        :param route_table: route table to check the routes against, all
+            routes are permitted if not provided
+        :type route_table: :class:`SAPRouterRouteTable`
+
+        :param router_version: router version to report
+        :type router_version: ``int``
+
+        :param talk_modes: talk modes allowed for the routes, defaults to NI
+            and raw talk modes
+        :type talk_modes: ``list`` of ``int``
+
+        :param info_password: password required for information requests
+        :type info_password: C{string}
+
+        :param connect_timeout: timeout in seconds for connecting to the
+            targets
+        :type connect_timeout: ``float``
+
+        :keyword kwargs: arguments to pass to the base NI server constructor
+        """
+        self.route_table = route_table
+        self.router_version = router_version or SAPRouter.SAPROUTER_DEFAULT_VERSION
+        if talk_modes is None:
+            talk_modes = [ROUTER_TALK_MODE_NI_MSG_IO, ROUTER_TALK_MODE_NI_RAW_IO]
+        self.talk_modes = talk_modes
+        self.info_password = info_password
+        self.connect_timeout = connect_timeout
+        self.started_on = time()
+        self.client_ids = count(1)
+        self.routes = set()
+        self.routes_closed = False
+        self._routes_lock = Lock()
+        self.base_server_cls.__init__(self, server_address, RequestHandlerClass or SAPRouterServerHandler,
+                                      bind_and_activate=bind_and_activate, **kwargs)
+
+    def add_route(self, client, target):
+        """Registers the sockets of an established route, so they're closed
+        when the server is shut down.
+
+        :return: if the route can be forwarded, or the server is being shut down
+        :rtype: ``bool``
+        """
+        with self._routes_lock:
+            if self.routes_closed:
+                return False
+            self.routes.add((client, target))
+            return True
+
+    def remove_route(self, client, target):
+        """Unregisters the sockets of a route that was closed."""
+        with self._routes_lock:
+            self.routes.discard((client, target))
+
+    def close_routes(self):
+        """Shuts down the sockets of the established routes, so the threads
+        forwarding their traffic finish.
+        """
+        with self._routes_lock:
+            self.routes_closed = True
+            routes = list(self.routes)
+        for route in routes:
+            for sock in route:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except (OSError, socket.error):
+                    pass
+
+    def shutdown(self):
+        """Stops the server and closes the established routes."""
+        self.base_server_cls.shutdown(self)
+        self.close_routes()
+
+    def check_route(self, source, host, service, password, talk_mode):
+        """Checks if a route is permitted.
+
+        :rtype: ``bool``
+        """
+        if self.route_table is None:
+            return True
+        return self.route_table.check(source, host, service, password, talk_mode)
+
+    def build_error(self, return_code, detail=""):
+        """Builds an error packet.
+
+        :param return_code: return code of the error
+        :type return_code: ``int``
+
+        :param detail: detail of the error
+        :type detail: C{string}
+
+        :return: error packet
+        :rtype: :class:`SAPRouter`
+        """
+        error_text = SAPRouterError(error=self.error_texts.get(return_code, "internal error"),
+                                    return_code=str(return_code),
+                                    release=self.release,
+                                    version=str(self.router_version),
+                                    detail=detail,
+                                    error_time=datetime.now().strftime(SAPRouterError.time_format),
+                                    error_count="1")
+        return SAPRouter(type=SAPRouter.SAPROUTER_ERROR,
+                         version=2,
+                         opcode=0,
+                         return_code=return_code,
+                         err_text_length=len(error_text),
+                         err_text_value=error_text)
+
+
+class SAPRouterServerPreforked(SAPRouterServer, SAPNIServerPreforked):
+    """SAP Router server emulator using pre-forked worker processes. Each
+    worker keeps its own list of clients, so information requests only report
+    the clients of the worker serving them.
+
+    Example usage::
+
+        server = SAPRouterServerPreforked(("127.0.0.1", 3299), workers=4)
+        server.serve_forever()
+    """
+
+    base_server_cls = SAPNIServerPreforked
+
+    def shutdown(self):
+        """Stops the server. Workers keep forwarding the routes already
+        established before exiting.
+        """
+        self.base_server_cls.shutdown(self)
+
+
+class SAPRouterServerHandler(SAPNIServerHandler):
+    """SAP Router server emulator handler
+
+    Handles the requests of a client of a :class:`SAPRouterServer`.
+    """
+
+    buffer_size = 65536
+    """ :cvar: Size of the buffer used when forwarding routed data
+        :type: ``int`` """
+
+    def setup(self):
+        """Registers the client on the server."""
+        SAPNIServerHandler.setup(self)
+        self.client = self.server.clients[self.client_address]
+        self.client.id = next(self.server.client_ids)
+        self.client.address = self.client_address[0]
+
+    def handle_data(self):
+        """Dispatches the requests received from the client."""
+        self.packet.decode_payload_as(SAPRouter)
+        if SAPRouter not in self.packet:
+            self.send_error(-93, "invalid request")
+            return
+        request = self.packet[SAPRouter]
+
+        if router_is_route(request):
+            self.handle_route(request)
+        elif router_is_admin(request):
+            self.handle_admin(request)
+        elif router_is_control(request) and request.opcode == 1:
+            log_saprouter.debug("SAPRouterServer: Version request from %s", self.client_address)
+            self.request.send(SAPRouter(type=SAPRouter.SAPROUTER_CONTROL,
+                                        version=self.server.router_version,
+                                        opcode=2, control_text_length=0,
+                                        control_text_value=b""))
+        else:
+            self.send_error(-93, "invalid request")
+
+    def send_error(self, return_code, detail=""):
+        """Sends an error packet to the client and closes the connection.
+
+        :param return_code: return code of the error
+        :type return_code: ``int``
+
+        :param detail: detail of the error
+        :type detail: C{string}
+        """
+        log_saprouter.debug("SAPRouterServer: Error %d for %s: %s", return_code, self.client_address, detail)
+        self.request.send(self.server.build_error(return_code, detail))
+        self.close()
+
+    def handle_route(self, request):
+        """Handles a route request, connecting to the next hop and forwarding
+        the traffic if the route is permitted.
+
+        :param request: route request
+        :type request: :class:`SAPRouter`
+        """
+        # Look for the next hop using the offset of the route
+        hops = request.route_string or []
+        offset, index = 0, 0
+        while index < len(hops) and offset < request.route_offset:
+            offset += len(hops[index].hostname) + len(hops[index].port) + len(hops[index].password) + 3
+            index += 1
+        if index >= len(hops) or offset != request.route_offset:
+            self.send_error(-93, "invalid route")
+            return
+
+        hop = hops[index]
+        hostname = hop.hostname.decode("ascii", "replace")
+        service = hop.port.decode("ascii", "replace")
+        password = hop.password.decode("ascii", "replace")
+        talk_mode = request.route_talk_mode
+
+        if talk_mode not in self.server.talk_modes:
+            self.send_error(-101, "talk mode %d not allowed" % talk_mode)
+            return
+        if not self.server.check_route(self.client_address[0], hostname, service, password, talk_mode):
+            self.send_error(-94, "route permission denied (%s to %s, %s)" % (self.client_address[0],
+                                                                           hostname, service))
+            return
+
+        try:
+            port = int(service) if service.isdigit() else socket.getservbyname(service)
+        except (OSError, socket.error):
+            self.send_error(-91, "service unknown (%s)" % service)
+            return
+        try:
+            target = socket.create_connection((hostname, port), self.server.connect_timeout)
+        except socket.gaierror:
+            self.send_error(-90, "host unknown (%s)" % hostname)
+            return
+        except socket.error as e:
+            self.send_error(-92, "connection to %s:%d refused (%s)" % (hostname, port, e))
+            return
+        target.settimeout(None)
+
+        try:
+            # Request the rest of the route to the next SAP Router
+            if index < len(hops) - 1:
+                request.route_offset = offset + len(bytes(hop))
+                request.route_rest_nodes -= 1
+                router = SAPNIStreamSocket(target, keep_alive=False)
+                response = router.sr(request)
+                payload = response.payload
+                response.decode_payload_as(SAPRouter)
+                if SAPRouter not in response or not router_is_pong(response[SAPRouter]):
+                    self.request.send(payload)
+                    return
+                pending = router.drain_buffer()
+            else:
+                payload = SAPRouter(type=SAPRouter.SAPROUTER_PONG)
+                pending = b""
+
+            # The route is registered before answering, so it's already reported once the client gets the answer
+            log_saprouter.debug("SAPRouterServer: Route from %s to %s:%d established",
+                                self.client_address, hostname, port)
+            self.client.partner = hostname
+            self.client.service = service
+            self.client.routed = True
+            self.request.send(payload)
+            self.forward(target, pending)
+        finally:
+            target.close()
+            self.close()
+
+    def forward(self, target, pending=b""):
+        """Forwards the traffic between the client and the target until one of
+        them closes the connection.
+
+        :param target: socket connected to the target
+        :type target: C{socket}
+
+        :param pending: data already received from the target
+        :type pending: ``bytes``
+        """
+        client = self.request.ins
+        if not self.server.add_route(client, target):
+            return
+        try:
+            # Data received along with the route request is still buffered
+            data = self.request.drain_buffer()
+            if data:
+                target.sendall(data)
+            if pending:
+                client.sendall(pending)
+
+            peers = {client: target, target: client}
+            with memoryview(bytearray(self.buffer_size)) as buffer:
+                while True:
+                    (readable, __, __) = select(list(peers), [], [])
+                    for sock in readable:
+                        try:
+                            received = sock.recv_into(buffer)
+                        except socket.error:
+                            received = 0
+                        if not received:
+                            return
+                        try:
+                            peers[sock].sendall(buffer[:received])
+                        except socket.error:
+                            return
+        finally:
+            self.server.remove_route(client, target)
+
+    def handle_admin(self, request):
+        """Handles an admin request. Only information requests are supported.
+
+        :param request: admin request
+        :type request: :class:`SAPRouter`
+        """
+        if request.adm_command != 2:
+            self.send_error(-93, "admin command %d not supported" % request.adm_command)
+            return
+        password = request.adm_password
+        if isinstance(password, bytes):
+            password = password.decode("ascii", "replace")
+        if self.server.info_password and password != self.server.info_password:
+            self.send_error(-99, "information request refused")
+            return
+
+        log_saprouter.debug("SAPRouterServer: Information request from %s", self.client_address)
+        clients = [SAPRouterInfoClient(id=client.id,
+                                       flag_traced=client.traced,
+                                       flag_connected=1,
+                                       flag_routed=client.routed,
+                                       # SAP timestamps are relative to 2001-09-09
+                                       connected_on=int(client.connected_on) - 1000000000,
+                                       address=client.address,
+                                       partner=client.partner,
+                                       service=client.service)
+                   for client in list(self.server.clients.values())]
+        self.request.send(Raw(bytes(SAPRouterInfoClients(clients=clients))))
+        port = self.server.server_address[1]
+        self.request.send(SAPRouterInfoServer(pid=os.getpid(),
+                                              ppid=os.getppid(),
+                                              started_on=int(self.server.started_on) - 1000000000,
+                                              port=port, pport=port))
+        self.close()
+
+
 # Bind SAP NI with the SAP Router port
 bind_layers(TCP, SAPNI, dport=3299)
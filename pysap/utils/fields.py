@@ -259,7 +259,7 @@ class PacketListStopField(PacketListField):
             c = self.count_from(pkt)
 
         lst = []
-        ret = ""
+        ret = b""
         remain = s
         if l is not None:
             remain, ret = s[:l], s[l:]
@@ -274,14 +274,14 @@ class PacketListStopField(PacketListField):
                 if conf.debug_dissector:
                     raise
                 p = conf.raw_layer(load=remain)
-                remain = ""
+                remain = b""
             else:
                 if conf.padding_layer in p:
                     pad = p[conf.padding_layer]
                     remain = pad.load
                     del (pad.underlayer.payload)
                 else:
-                    remain = ""
+                    remain = b""
             lst.append(p)
             # Evaluate the stop condition
             if self.stop and self.stop(p):
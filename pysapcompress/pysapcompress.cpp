@@ -22,12 +22,15 @@
 #define PY_SSIZE_T_CLEAN
 
 #include <Python.h>
+#include <structmember.h>
+#include <pythread.h>
 
 #include <stdio.h>
 #include <stdlib.h>
 #include <assert.h>
 #include <string.h>
 #include <limits.h>
+#include <new>
 
 #include "hpa101saptype.h"
 #include "hpa104CsObject.h"
@@ -377,6 +380,7 @@ pysapcompress_compress(PyObject *self, PyObject *args, PyObject *keywds)
     unsigned char *out = NULL;
     int status = 0, in_length = 0, out_length = 0, algorithm = ALG_LZC;
     Py_ssize_t in_length_arg = 0;
+    PyObject *result = NULL;
 
     /* Define the keyword list */
     static char kwin[] = "in";
@@ -395,8 +399,16 @@ pysapcompress_compress(PyObject *self, PyObject *args, PyObject *keywds)
 	
 	in_length = Py_SAFE_DOWNCAST(in_length_arg, Py_ssize_t, int);
 
-    /* Call the compression function */
-    status = compress_packet(in, in_length, &out, &out_length, algorithm);
+    /* Call the compression function. LZH compression keeps all its state in the compression object, so the GIL
+     * is released and several buffers can be compressed concurrently from different threads.
+     */
+    if (algorithm == ALG_LZH) {
+        Py_BEGIN_ALLOW_THREADS
+        status = compress_packet(in, in_length, &out, &out_length, algorithm);
+        Py_END_ALLOW_THREADS
+    } else {
+        status = compress_packet(in, in_length, &out, &out_length, algorithm);
+    }
 
     /* Perform some exception handling */
     if (status < 0){
@@ -410,7 +422,9 @@ pysapcompress_compress(PyObject *self, PyObject *args, PyObject *keywds)
     }
 
     /* It no error was raised, return the compressed buffer and the length */
-	return (Py_BuildValue("iiy#", status, out_length, out, out_length));
+	result = Py_BuildValue("iiy#", status, out_length, out, out_length);
+	free(out);
+	return (result);
 }
 
 
@@ -464,6 +478,565 @@ pysapcompress_decompress(PyObject *self, PyObject *args)
 }
 
 
+/* Decompressor object, used to decompress a stream incrementally */
+typedef struct {
+	PyObject_HEAD
+	CsObjectInt *cs_object;
+	PyThread_type_lock lock;
+	SAP_BYTE *in;
+	Py_ssize_t in_length;
+	Py_ssize_t in_offset;
+	SAP_INT length;
+	int algorithm;
+	int initialized;
+	int flushing;
+	char eof;
+	char needs_input;
+} DecompressorObject;
+
+
+static char pysapcompress_decompressor_doc[] = "Decompressor()\n\n"
+                                               "Decompressor object, used to decompress a stream incrementally. The\n"
+                                               "input can be provided in several chunks, and the output obtained in\n"
+                                               "chunks of a given maximum length.\n\n"
+                                               "LZC streams can't be decoded up to their end until it's known that no\n"
+                                               "more input follows, so flush() should be called after the last chunk.\n";
+
+
+static PyObject *
+Decompressor_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+	DecompressorObject *self = NULL;
+
+	if (!PyArg_ParseTuple(args, ":Decompressor")) {
+		return (NULL);
+	}
+
+	self = (DecompressorObject *)type->tp_alloc(type, 0);
+	if (self == NULL) {
+		return (NULL);
+	}
+
+	self->cs_object = new (std::nothrow) CsObjectInt();
+	self->lock = PyThread_allocate_lock();
+	if (self->cs_object == NULL || self->lock == NULL) {
+		Py_DECREF(self);
+		return (PyErr_NoMemory());
+	}
+	self->length = -1;
+	self->needs_input = 1;
+
+	return ((PyObject *)self);
+}
+
+
+static void
+Decompressor_dealloc(DecompressorObject *self)
+{
+	delete self->cs_object;
+	if (self->lock != NULL) {
+		PyThread_free_lock(self->lock);
+	}
+	PyMem_Free(self->in);
+	Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+
+/* Appends data to the pending input buffer, discarding the input already consumed */
+static int
+Decompressor_append_input(DecompressorObject *self, const unsigned char *data, Py_ssize_t data_length)
+{
+	Py_ssize_t rest = self->in_length - self->in_offset;
+	SAP_BYTE *in = NULL;
+
+	if (data_length == 0) {
+		return (0);
+	}
+	if (rest + data_length > INT_MAX) {
+		PyErr_Format(decompression_exception, "Decompression error (Input length is larger than INT_MAX)");
+		return (-1);
+	}
+
+	in = (SAP_BYTE *)PyMem_Malloc(rest + data_length);
+	if (in == NULL) {
+		PyErr_NoMemory();
+		return (-1);
+	}
+	if (rest > 0) {
+		memcpy(in, self->in + self->in_offset, rest);
+	}
+	memcpy(in + rest, data, data_length);
+
+	PyMem_Free(self->in);
+	self->in = in;
+	self->in_length = rest + data_length;
+	self->in_offset = 0;
+	return (0);
+}
+
+
+/* Decompresses the pending input, returning up to max_length bytes of output */
+static PyObject *
+Decompressor_run(DecompressorObject *self, Py_ssize_t max_length)
+{
+	Py_ssize_t out_length = 0, out_size = 0, in_rest = 0;
+	PyObject *out = NULL;
+	SAP_INT bytes_read = 0, bytes_decompressed = 0;
+	int rt = 0, lzc = 0;
+
+	if (self->eof) {
+		PyErr_SetString(PyExc_EOFError, "End of stream already reached");
+		return (NULL);
+	}
+
+	/* Initialize once the header is available */
+	if (!self->initialized) {
+		if (self->in_length - self->in_offset < CS_HEAD_SIZE) {
+			self->needs_input = 1;
+			return (PyBytes_FromStringAndSize(NULL, 0));
+		}
+		rt = self->cs_object->CsInitDecompr(self->in + self->in_offset);
+		if (rt < 0) {
+			return (PyErr_Format(decompression_exception, "Decompression error (%s)", error_string(rt)));
+		}
+		self->length = self->cs_object->CsGetLen(self->in + self->in_offset);
+		if (self->length < 0) {
+			return (PyErr_Format(decompression_exception, "Decompression error (%s)", error_string(CS_E_FILENOTCOMPRESSED)));
+		}
+		self->algorithm = self->cs_object->CsGetAlgorithm(self->in + self->in_offset);
+		self->in_offset += CS_HEAD_SIZE;
+		self->initialized = 1;
+	}
+	lzc = self->algorithm == CS_ALGORITHM_LZC;
+
+	/* Allocate the output buffer, using the reported length as a hint */
+	out_size = max_length >= 0 ? max_length : (self->length > 0 && self->length < 0x10000 ? self->length : 0x10000);
+	out = PyBytes_FromStringAndSize(NULL, out_size);
+	if (out == NULL) {
+		return (NULL);
+	}
+	if (out_size == 0) {
+		return (out);
+	}
+
+	while (1) {
+		/* Grow the output buffer if it's full and the output is not limited */
+		if (out_length == out_size) {
+			if (max_length >= 0) {
+				break;
+			}
+			if (out_size > PY_SSIZE_T_MAX / 2 || _PyBytes_Resize(&out, out_size * 2) < 0) {
+				if (out != NULL) {
+					PyErr_NoMemory();
+				}
+				goto error;
+			}
+			out_size *= 2;
+		}
+
+		in_rest = self->in_length - self->in_offset;
+		if (lzc) {
+			/* The LZC decoder reads codes in groups of up to MAX_CS_BITS bytes, and a group split across calls is
+			 * completed with the input of the next call. Calls with less input than a group are only made once
+			 * the end of the input is known, as they complete the last group of the stream.
+			 */
+			if (!self->flushing && in_rest < MAX_CS_BITS) {
+				self->needs_input = 1;
+				break;
+			}
+		} else if (self->needs_input && in_rest == 0) {
+			/* The decompressor can't be called without input unless there's output pending */
+			break;
+		}
+
+		/* LZH keeps all its state in the decompression object, so the GIL is released */
+		if (!lzc) {
+			Py_BEGIN_ALLOW_THREADS
+			rt = self->cs_object->CsDecompr(self->in + self->in_offset, (SAP_INT)in_rest,
+			                                (SAP_BYTE *)PyBytes_AS_STRING(out) + out_length,
+			                                (SAP_INT)(out_size - out_length > INT_MAX ? INT_MAX : out_size - out_length),
+			                                0, &bytes_read, &bytes_decompressed);
+			Py_END_ALLOW_THREADS
+		} else {
+			rt = self->cs_object->CsDecompr(self->in + self->in_offset, (SAP_INT)in_rest,
+			                                (SAP_BYTE *)PyBytes_AS_STRING(out) + out_length,
+			                                (SAP_INT)(out_size - out_length > INT_MAX ? INT_MAX : out_size - out_length),
+			                                0, &bytes_read, &bytes_decompressed);
+		}
+
+		if (rt < 0) {
+			PyErr_Format(decompression_exception, "Decompression error (%s)", error_string(rt));
+			goto error;
+		}
+
+		out_length += bytes_decompressed;
+		self->in_offset += bytes_read;
+		if (self->in_offset > self->in_length) {
+			self->in_offset = self->in_length;
+		}
+
+		if (rt == CS_END_OF_STREAM) {
+			self->eof = 1;
+			self->needs_input = 0;
+			break;
+		}
+		if (rt == CS_END_INBUFFER) {
+			self->needs_input = 1;
+			/* Keep completing the last group of an LZC stream while it makes progress */
+			if (!(lzc && self->flushing && (bytes_read > 0 || bytes_decompressed > 0))) {
+				break;
+			}
+			continue;
+		}
+		self->needs_input = 0;
+	}
+
+	if (_PyBytes_Resize(&out, out_length) < 0) {
+		return (NULL);
+	}
+	return (out);
+
+error:
+	Py_XDECREF(out);
+	return (NULL);
+}
+
+
+static char pysapcompress_decompressor_decompress_doc[] = "decompress(data, max_length=-1)\n\n"
+                                                          "Decompress data, returning the uncompressed data available.\n\n"
+                                                          ":param bytes data: compressed data\n"
+                                                          ":param int max_length: maximum length of the data returned, if\n"
+                                                          "    negative the output is not limited. Input not consumed is kept\n"
+                                                          "    for later calls.\n"
+                                                          ":return: uncompressed data\n"
+                                                          ":rtype: bytes\n\n"
+                                                          ":raises DecompressError: if an error occurred during decompression\n"
+                                                          ":raises EOFError: if the end of the stream was already reached\n";
+
+static PyObject *
+Decompressor_decompress(DecompressorObject *self, PyObject *args, PyObject *keywds)
+{
+	Py_buffer data;
+	Py_ssize_t max_length = -1;
+	PyObject *out = NULL;
+
+	static char kwdata[] = "data";
+	static char kwmax_length[] = "max_length";
+	static char* kwlist[] = {kwdata, kwmax_length, NULL};
+
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "y*|n:decompress", kwlist, &data, &max_length)) {
+		return (NULL);
+	}
+
+	if (!PyThread_acquire_lock(self->lock, 0)) {
+		Py_BEGIN_ALLOW_THREADS
+		PyThread_acquire_lock(self->lock, 1);
+		Py_END_ALLOW_THREADS
+	}
+
+	if (self->eof) {
+		PyErr_SetString(PyExc_EOFError, "End of stream already reached");
+	} else if (Decompressor_append_input(self, (const unsigned char *)data.buf, data.len) == 0) {
+		out = Decompressor_run(self, max_length);
+	}
+
+	PyThread_release_lock(self->lock);
+	PyBuffer_Release(&data);
+	return (out);
+}
+
+
+static char pysapcompress_decompressor_flush_doc[] = "flush(max_length=-1)\n\n"
+                                                     "Signal the end of the input, returning the uncompressed data\n"
+                                                     "available. Further output can be obtained calling decompress()\n"
+                                                     "with empty data until the end of the stream is reached.\n\n"
+                                                     ":param int max_length: maximum length of the data returned, if\n"
+                                                     "    negative the output is not limited.\n"
+                                                     ":return: uncompressed data\n"
+                                                     ":rtype: bytes\n\n"
+                                                     ":raises DecompressError: if an error occurred during decompression\n"
+                                                     ":raises EOFError: if the end of the stream was already reached\n";
+
+static PyObject *
+Decompressor_flush(DecompressorObject *self, PyObject *args, PyObject *keywds)
+{
+	Py_ssize_t max_length = -1;
+	PyObject *out = NULL;
+
+	static char kwmax_length[] = "max_length";
+	static char* kwlist[] = {kwmax_length, NULL};
+
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "|n:flush", kwlist, &max_length)) {
+		return (NULL);
+	}
+
+	if (!PyThread_acquire_lock(self->lock, 0)) {
+		Py_BEGIN_ALLOW_THREADS
+		PyThread_acquire_lock(self->lock, 1);
+		Py_END_ALLOW_THREADS
+	}
+
+	self->flushing = 1;
+	out = Decompressor_run(self, max_length);
+
+	PyThread_release_lock(self->lock);
+	return (out);
+}
+
+
+static PyMethodDef Decompressor_methods[] = {
+	{"decompress", (PyCFunction)Decompressor_decompress, METH_VARARGS | METH_KEYWORDS, pysapcompress_decompressor_decompress_doc},
+	{"flush", (PyCFunction)Decompressor_flush, METH_VARARGS | METH_KEYWORDS, pysapcompress_decompressor_flush_doc},
+	{NULL, NULL, 0, NULL}
+};
+
+
+static PyMemberDef Decompressor_members[] = {
+	{(char *)"eof", T_BOOL, offsetof(DecompressorObject, eof), READONLY,
+	 (char *)"True if the end of the stream has been reached."},
+	{(char *)"needs_input", T_BOOL, offsetof(DecompressorObject, needs_input), READONLY,
+	 (char *)"True if more input is needed before more output can be produced."},
+	{(char *)"length", T_INT, offsetof(DecompressorObject, length), READONLY,
+	 (char *)"Uncompressed length reported in the stream header, or -1 if not known yet."},
+	{NULL}
+};
+
+
+static PyTypeObject DecompressorType = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"pysapcompress.Decompressor",           /* tp_name */
+	sizeof(DecompressorObject),             /* tp_basicsize */
+	0,                                      /* tp_itemsize */
+	(destructor)Decompressor_dealloc,       /* tp_dealloc */
+};
+
+
+/* Compressor object, used to compress a stream incrementally */
+typedef struct {
+	PyObject_HEAD
+	CsObjectInt *cs_object;
+	PyThread_type_lock lock;
+	SAP_INT length;
+	SAP_INT total_in;
+	int algorithm;
+	int initialized;
+	char eof;
+} CompressorObject;
+
+
+static char pysapcompress_compressor_doc[] = "Compressor(length, algorithm=ALG_LZH)\n\n"
+                                             "Compressor object, used to compress a stream incrementally. The\n"
+                                             "length of the stream is stored in its header, so it must be known in\n"
+                                             "advance. The input can be provided in several chunks, and the\n"
+                                             "stream is finished once the given length is compressed.\n\n"
+                                             ":param int length: length of the data to compress\n"
+                                             ":param int algorithm: algorithm to use\n";
+
+
+static PyObject *
+Compressor_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+	CompressorObject *self = NULL;
+	Py_ssize_t length = 0;
+	int algorithm = ALG_LZH;
+
+	static char kwlength[] = "length";
+	static char kwalgorithm[] = "algorithm";
+	static char* kwlist[] = {kwlength, kwalgorithm, NULL};
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "n|i:Compressor", kwlist, &length, &algorithm)) {
+		return (NULL);
+	}
+	if (length <= 0 || length > INT_MAX) {
+		return (PyErr_Format(compression_exception, "Compression error (%s)", error_string(CS_E_INVALID_SUMLEN)));
+	}
+	if (algorithm != ALG_LZC && algorithm != ALG_LZH) {
+		return (PyErr_Format(compression_exception, "Compression error (%s)", error_string(CS_E_UNKNOWN_ALG)));
+	}
+
+	self = (CompressorObject *)type->tp_alloc(type, 0);
+	if (self == NULL) {
+		return (NULL);
+	}
+
+	self->cs_object = new (std::nothrow) CsObjectInt();
+	self->lock = PyThread_allocate_lock();
+	if (self->cs_object == NULL || self->lock == NULL) {
+		Py_DECREF(self);
+		return (PyErr_NoMemory());
+	}
+	self->length = (SAP_INT)length;
+	self->algorithm = algorithm;
+
+	return ((PyObject *)self);
+}
+
+
+static void
+Compressor_dealloc(CompressorObject *self)
+{
+	delete self->cs_object;
+	if (self->lock != NULL) {
+		PyThread_free_lock(self->lock);
+	}
+	Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+
+/* Compresses the input, returning the compressed data available */
+static PyObject *
+Compressor_run(CompressorObject *self, const unsigned char *in, Py_ssize_t in_length)
+{
+	Py_ssize_t out_length = 0, out_size = 0, in_offset = 0;
+	PyObject *out = NULL;
+	SAP_INT bytes_read = 0, bytes_compressed = 0;
+	int rt = 0;
+
+	if (in_length > self->length - self->total_in) {
+		return (PyErr_Format(compression_exception, "Compression error (Input length is larger than the stream length)"));
+	}
+
+	/* Allocate the output buffer. Compressed blocks might be flushed along with the output of the input given
+	 * in previous calls, so some room is left for them. The buffer is grown if it's not enough.
+	 */
+	out_size = in_length * 2 + 0x1000;
+	out = PyBytes_FromStringAndSize(NULL, out_size);
+	if (out == NULL) {
+		return (NULL);
+	}
+
+	/* Initialize and write the header */
+	if (!self->initialized) {
+		rt = self->cs_object->CsInitCompr((SAP_BYTE *)PyBytes_AS_STRING(out), self->length, self->algorithm);
+		if (rt < 0) {
+			PyErr_Format(compression_exception, "Compression error (%s)", error_string(rt));
+			goto error;
+		}
+		out_length = CS_HEAD_SIZE;
+		self->initialized = 1;
+	}
+
+	while (in_offset < in_length || rt == CS_END_OUTBUFFER) {
+		/* Grow the output buffer if it's full, or the compressor ran out of room for its pending output */
+		if (out_length == out_size || rt == CS_END_OUTBUFFER) {
+			if (out_size > PY_SSIZE_T_MAX / 2 || _PyBytes_Resize(&out, out_size * 2) < 0) {
+				if (out != NULL) {
+					PyErr_NoMemory();
+				}
+				goto error;
+			}
+			out_size *= 2;
+		}
+
+		/* LZH keeps all its state in the compression object, so the GIL is released */
+		if (self->algorithm == ALG_LZH) {
+			Py_BEGIN_ALLOW_THREADS
+			rt = self->cs_object->CsCompr(self->length, (SAP_BYTE *)in + in_offset, (SAP_INT)(in_length - in_offset),
+			                              (SAP_BYTE *)PyBytes_AS_STRING(out) + out_length,
+			                              (SAP_INT)(out_size - out_length > INT_MAX ? INT_MAX : out_size - out_length),
+			                              self->algorithm, &bytes_read, &bytes_compressed);
+			Py_END_ALLOW_THREADS
+		} else {
+			rt = self->cs_object->CsCompr(self->length, (SAP_BYTE *)in + in_offset, (SAP_INT)(in_length - in_offset),
+			                              (SAP_BYTE *)PyBytes_AS_STRING(out) + out_length,
+			                              (SAP_INT)(out_size - out_length > INT_MAX ? INT_MAX : out_size - out_length),
+			                              self->algorithm, &bytes_read, &bytes_compressed);
+		}
+
+		if (rt < 0) {
+			PyErr_Format(compression_exception, "Compression error (%s)", error_string(rt));
+			goto error;
+		}
+
+		in_offset += bytes_read;
+		self->total_in += bytes_read;
+		out_length += bytes_compressed;
+
+		if (rt == CS_END_OF_STREAM) {
+			self->eof = 1;
+			break;
+		}
+		if (rt == CS_END_INBUFFER) {
+			break;
+		}
+	}
+
+	if (_PyBytes_Resize(&out, out_length) < 0) {
+		return (NULL);
+	}
+	return (out);
+
+error:
+	Py_XDECREF(out);
+	return (NULL);
+}
+
+
+static char pysapcompress_compressor_compress_doc[] = "compress(data)\n\n"
+                                                      "Compress data, returning the compressed data available. The\n"
+                                                      "output of the first call starts with the stream header.\n\n"
+                                                      ":param bytes data: data to compress\n"
+                                                      ":return: compressed data\n"
+                                                      ":rtype: bytes\n\n"
+                                                      ":raises CompressError: if an error occurred during compression,\n"
+                                                      "    or the data exceeds the length of the stream\n"
+                                                      ":raises EOFError: if the end of the stream was already reached\n";
+
+static PyObject *
+Compressor_compress(CompressorObject *self, PyObject *args, PyObject *keywds)
+{
+	Py_buffer data;
+	PyObject *out = NULL;
+
+	static char kwdata[] = "data";
+	static char* kwlist[] = {kwdata, NULL};
+
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "y*:compress", kwlist, &data)) {
+		return (NULL);
+	}
+
+	if (!PyThread_acquire_lock(self->lock, 0)) {
+		Py_BEGIN_ALLOW_THREADS
+		PyThread_acquire_lock(self->lock, 1);
+		Py_END_ALLOW_THREADS
+	}
+
+	if (self->eof) {
+		PyErr_SetString(PyExc_EOFError, "End of stream already reached");
+	} else {
+		out = Compressor_run(self, (const unsigned char *)data.buf, data.len);
+	}
+
+	PyThread_release_lock(self->lock);
+	PyBuffer_Release(&data);
+	return (out);
+}
+
+
+static PyMethodDef Compressor_methods[] = {
+	{"compress", (PyCFunction)Compressor_compress, METH_VARARGS | METH_KEYWORDS, pysapcompress_compressor_compress_doc},
+	{NULL, NULL, 0, NULL}
+};
+
+
+static PyMemberDef Compressor_members[] = {
+	{(char *)"eof", T_BOOL, offsetof(CompressorObject, eof), READONLY,
+	 (char *)"True if the whole stream has been compressed."},
+	{(char *)"length", T_INT, offsetof(CompressorObject, length), READONLY,
+	 (char *)"Length of the data to compress, as stored in the stream header."},
+	{NULL}
+};
+
+
+static PyTypeObject CompressorType = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"pysapcompress.Compressor",             /* tp_name */
+	sizeof(CompressorObject),               /* tp_basicsize */
+	0,                                      /* tp_itemsize */
+	(destructor)Compressor_dealloc,         /* tp_dealloc */
+};
+
+
 /* Method definitions */
 static PyMethodDef pysapcompressMethods[] = {
     {"compress", (PyCFunction)pysapcompress_compress, METH_VARARGS | METH_KEYWORDS, pysapcompress_compress_doc},
@@ -497,6 +1070,32 @@ PyMODINIT_FUNC PyInit_pysapcompress(void) {
 
     decompression_exception = PyErr_NewException(decompression_exception_name, NULL, NULL);
     PyModule_AddObject(module, decompression_exception_short, decompression_exception);
+
+    /* Add the compressor type */
+    CompressorType.tp_flags = Py_TPFLAGS_DEFAULT;
+    CompressorType.tp_doc = pysapcompress_compressor_doc;
+    CompressorType.tp_methods = Compressor_methods;
+    CompressorType.tp_members = Compressor_members;
+    CompressorType.tp_new = Compressor_new;
+    if (PyType_Ready(&CompressorType) < 0) {
+        Py_DECREF(module);
+        return NULL;
+    }
+    Py_INCREF(&CompressorType);
+    PyModule_AddObject(module, "Compressor", (PyObject *)&CompressorType);
+
+    /* Add the decompressor type */
+    DecompressorType.tp_flags = Py_TPFLAGS_DEFAULT;
+    DecompressorType.tp_doc = pysapcompress_decompressor_doc;
+    DecompressorType.tp_methods = Decompressor_methods;
+    DecompressorType.tp_members = Decompressor_members;
+    DecompressorType.tp_new = Decompressor_new;
+    if (PyType_Ready(&DecompressorType) < 0) {
+        Py_DECREF(module);
+        return NULL;
+    }
+    Py_INCREF(&DecompressorType);
+    PyModule_AddObject(module, "Decompressor", (PyObject *)&DecompressorType);
 	
 	return module;
 }
@@ -96,6 +96,108 @@ class PySAPCompressTest(unittest.TestCase):
         self.assertEqual(out_length_decompressed, len(self.test_string_plain))
         self.assertEqual(out_decompressed, self.test_string_plain)
 
+    def test_lzh_decompressor(self):
+        """Test incremental decompression using LZH algorithm"""
+        from pysapcompress import compress, Decompressor, DecompressError, ALG_LZH
+        login_screen_decompressed = read_data_file('nw_703_login_screen_decompressed.data')
+        status, out_length, compressed = compress(login_screen_decompressed * 4, ALG_LZH)
+
+        for chunk_size in [1, 7, 1000, len(compressed)]:
+            for max_length in [-1, 1, 100]:
+                decompressor = Decompressor()
+                decompressed = []
+                for i in range(0, len(compressed), chunk_size):
+                    decompressed.append(decompressor.decompress(compressed[i:i + chunk_size], max_length))
+                    while not decompressor.needs_input and not decompressor.eof:
+                        decompressed.append(decompressor.decompress(b"", max_length))
+                    if decompressor.eof:
+                        break
+                self.assertTrue(decompressor.eof)
+                self.assertEqual(decompressor.length, len(login_screen_decompressed) * 4)
+                self.assertEqual(b"".join(decompressed), login_screen_decompressed * 4)
+                self.assertRaises(EOFError, decompressor.decompress, b"")
+
+        decompressor = Decompressor()
+        self.assertEqual(decompressor.decompress(self.test_string_compr_lzh[:4]), b"")
+        self.assertTrue(decompressor.needs_input)
+        self.assertEqual(decompressor.length, -1)
+        self.assertEqual(decompressor.decompress(self.test_string_compr_lzh[4:]), self.test_string_plain)
+
+        self.assertRaisesRegex(DecompressError, "input not compressed", Decompressor().decompress, b"AAAAAAAA")
+
+    def test_lzc_decompressor(self):
+        """Test incremental decompression using LZC algorithm"""
+        from pysapcompress import compress, Decompressor, ALG_LZC
+        login_screen_decompressed = read_data_file('nw_703_login_screen_decompressed.data')
+        status, out_length, compressed = compress(login_screen_decompressed * 4, ALG_LZC)
+
+        for chunk_size in [1, 7, 1000, len(compressed)]:
+            for max_length in [-1, 1, 100]:
+                decompressor = Decompressor()
+                decompressed = []
+                for i in range(0, len(compressed), chunk_size):
+                    decompressed.append(decompressor.decompress(compressed[i:i + chunk_size], max_length))
+                    while not decompressor.needs_input:
+                        decompressed.append(decompressor.decompress(b"", max_length))
+                # The last codes of the stream are only decoded once the end of the input is known
+                self.assertFalse(decompressor.eof)
+                decompressed.append(decompressor.flush(max_length))
+                while not decompressor.eof:
+                    decompressed.append(decompressor.decompress(b"", max_length))
+                self.assertEqual(decompressor.length, len(login_screen_decompressed) * 4)
+                self.assertEqual(b"".join(decompressed), login_screen_decompressed * 4)
+                self.assertRaises(EOFError, decompressor.flush)
+
+        decompressor = Decompressor()
+        decompressed = decompressor.decompress(self.test_string_compr_lzc)
+        self.assertFalse(decompressor.eof)
+        self.assertEqual(decompressed + decompressor.flush(), self.test_string_plain)
+        self.assertTrue(decompressor.eof)
+
+    def test_compressor(self):
+        """Test incremental compression using LZC and LZH algorithms"""
+        from pysapcompress import compress, decompress, Compressor, CompressError, ALG_LZC, ALG_LZH
+        login_screen_decompressed = read_data_file('nw_703_login_screen_decompressed.data') * 4
+
+        for algorithm in [ALG_LZC, ALG_LZH]:
+            for chunk_size in [1, 7, 1000, len(login_screen_decompressed)]:
+                compressor = Compressor(len(login_screen_decompressed), algorithm)
+                compressed = []
+                for i in range(0, len(login_screen_decompressed), chunk_size):
+                    self.assertFalse(compressor.eof)
+                    compressed.append(compressor.compress(login_screen_decompressed[i:i + chunk_size]))
+                self.assertTrue(compressor.eof)
+                self.assertRaises(EOFError, compressor.compress, b"")
+                compressed = b"".join(compressed)
+                # LZC output is deterministic, so it's expected to match the output of a single call
+                if algorithm == ALG_LZC:
+                    self.assertEqual(compressed, compress(login_screen_decompressed, ALG_LZC)[2])
+                else:
+                    self.assertEqual(decompress(compressed, len(login_screen_decompressed))[2],
+                                     login_screen_decompressed)
+
+        compressor = Compressor(len(self.test_string_plain), ALG_LZC)
+        self.assertEqual(compressor.length, len(self.test_string_plain))
+        self.assertEqual(compressor.compress(self.test_string_plain), self.test_string_compr_lzc)
+
+        self.assertRaisesRegex(CompressError, "larger than the stream length", Compressor(1).compress, b"AA")
+        self.assertRaisesRegex(CompressError, "invalid len of stream", Compressor, 0)
+        self.assertRaisesRegex(CompressError, "unknown algorithm", Compressor, 1, 7)
+
+    def test_lzh_threads(self):
+        """Test compression using LZH algorithm from several threads"""
+        from concurrent.futures import ThreadPoolExecutor
+        from pysapcompress import compress, decompress, ALG_LZH
+        login_screen_decompressed = read_data_file('nw_703_login_screen_decompressed.data')
+        inputs = [login_screen_decompressed[i:] * 2 for i in range(0, 3200, 100)]
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda data: compress(data, ALG_LZH), inputs))
+
+        for data, (status, out_length, compressed) in zip(inputs, results):
+            self.assertEqual(out_length, len(compressed))
+            self.assertEqual(decompress(compressed, len(data))[2], data)
+
     def test_login_screen(self):
         """Test (de)compression of a login screen packet. The result is
         compared with data obtained from SAP GUI."""
@@ -19,12 +19,20 @@
 # Standard imports
 import sys
 import unittest
+from io import BytesIO
+from struct import pack
 from os import unlink, rmdir, path
+from concurrent.futures import ThreadPoolExecutor
 # External imports
+from pysapcompress import compress, decompress, ALG_LZC, ALG_LZH
 # Custom imports
 from tests.utils import data_filename
 from pysap.SAPCAR import (SAPCARArchive, SAPCARArchiveFile, SAPCARArchiveFilev200Format, SAPCARArchiveFilev201Format,
-                          SAPCAR_VERSION_200, SAPCAR_VERSION_201, SIZE_FOUR_GB)
+                          SAPCARArchiveIndex, SAPCARArchiveFileEntry, SAPCAR_VERSION_200, SAPCAR_VERSION_201,
+                          SAPCAR_BLOCK_TYPE_COMPRESSED, SAPCAR_BLOCK_TYPE_COMPRESSED_LAST, SIZE_FOUR_GB,
+                          SAPCAR_BLOCK_TYPE_UNCOMPRESSED, SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST,
+                          SAPCARInvalidChecksumException, SAPCARInvalidFileException, SAPCARArchiveWriter,
+                          SAPCAR_BLOB_HEADER_SIZE, sapcar_compress_blocks, sapcar_extract_blocks)
 
 
 class PySAPCARTest(unittest.TestCase):
@@ -223,6 +231,299 @@ class PySAPCARTest(unittest.TestCase):
             self.assertEqual(self.test_string, af.read())
             af.close()
 
+    def test_sapcar_archive_index(self):
+        """Test SAP CAR archive index built from the file headers"""
+
+        for filename, version in [("car200_test_string.sar", SAPCAR_VERSION_200),
+                                  ("car201_test_string.sar", SAPCAR_VERSION_201)]:
+            with open(data_filename(filename), "rb") as fd:
+                index = SAPCARArchiveIndex(fd)
+                self.assertEqual(version, index.version)
+                self.assertEqual(1, len(index))
+
+                entry = index.entries[0]
+                self.assertEqual(self.test_filename.encode(), entry.filename)
+                self.assertEqual(len(self.test_string), entry.file_length)
+                self.assertEqual(self.test_timestamp_raw, entry.timestamp)
+                self.assertEqual(self.test_perm_mode, entry.perm_mode)
+                self.assertEqual(8, entry.offset)
+                self.assertEqual(path.getsize(data_filename(filename)), entry.offset + entry.length)
+                self.assertEqual(1, len(entry.blocks))
+                self.assertEqual(SAPCAR_BLOCK_TYPE_COMPRESSED_LAST, entry.blocks[0].type)
+
+                af = SAPCARArchiveFile.from_offset(fd, entry.offset, version)
+                self.assertEqual(entry.offset, af.offset)
+                self.assertEqual(self.test_filename, af.filename)
+                self.assertEqual(self.test_string, af.open(enforce_checksum=True).read())
+
+                ff = entry.load()
+                self.assertEqual(ff.filename, entry.filename)
+                self.assertEqual(ff.blocks[0].checksum, entry.blocks[0].checksum)
+                self.assertEqual(len(ff.blocks[0].compressed) - 4, entry.blocks[0].length)
+
+        # Archives opened for reading are only dissected when needed
+        ar = SAPCARArchive(self.test_archive_file, "w")
+        ar.add_file(self.test_filename)
+        ar.add_file(self.test_filename, archive_filename=self.test_filename + "two")
+        ar.write()
+        ar.close()
+
+        ar = SAPCARArchive(self.test_archive_file, "r")
+        self.assertListEqual([self.test_filename, self.test_filename + "two"], ar.files_names)
+        for filename in ar.files_names:
+            ff = ar.files[filename]
+            self.assertIsInstance(ff._file_format, SAPCARArchiveFileEntry)
+            self.assertTrue(ff.check_checksum())
+            self.assertEqual(self.test_string, ar.open(filename).read())
+        self.assertIsNone(ar._sapcar_format)
+        self.assertEqual(2, len(ar._files))
+        self.assertIsNotNone(ar._sapcar_format)
+        ar.close()
+
+        # Indexed archives are rewritten in place
+        with open(self.test_archive_file, "rb") as fd:
+            data = fd.read()
+        ar = SAPCARArchive(self.test_archive_file)
+        ar.write()
+        ar.close()
+        with open(self.test_archive_file, "rb") as fd:
+            self.assertEqual(data, fd.read())
+        ar = SAPCARArchive(self.test_archive_file, "r")
+        self.assertListEqual([self.test_filename, self.test_filename + "two"], ar.files_names)
+        self.assertEqual(self.test_string, ar.open(self.test_filename).read())
+        ar.close()
+
+    def test_sapcar_archive_extract_stream(self):
+        """Test SAP CAR archive file extraction from several blocks in chunks"""
+
+        class ChunksFile(BytesIO):
+            def write(self, data):
+                self.chunks.append(len(data))
+                return BytesIO.write(self, data)
+
+        data = self.test_string * 2000
+        checksum = SAPCARArchiveFile.calculate_checksum(data)
+        (_, _, compressed) = compress(data, ALG_LZH)
+
+        def build_archive(checksum):
+            blocks = b""
+            for i in range(0, len(compressed), 100):
+                block_type = SAPCAR_BLOCK_TYPE_COMPRESSED if i + 100 < len(compressed) else SAPCAR_BLOCK_TYPE_COMPRESSED_LAST
+                blocks += block_type + pack("<I", len(compressed[i:i + 100])) + compressed[i:i + 100]
+            return b"CAR 2.01" + pack("<2sIQIQIHH", b"RG", self.test_perm_mode, len(data), 0, self.test_timestamp_raw,
+                                      0, 0, len(self.test_filename) + 1) + \
+                self.test_filename.encode() + b"\x00" + blocks + pack("<i", checksum)
+
+        ar = SAPCARArchive(BytesIO(build_archive(checksum)), "r")
+        ff = ar.files[self.test_filename]
+        self.assertEqual((len(compressed) + 99) // 100, len(ff._file_format.blocks))
+        self.assertEqual(checksum, ff.checksum)
+
+        out_file = ChunksFile()
+        out_file.chunks = []
+        self.assertTrue(ff.extract(out_file, enforce_checksum=True, chunk_size=1000))
+        self.assertEqual(data, out_file.getvalue())
+        self.assertLessEqual(max(out_file.chunks), 1000)
+        self.assertEqual(data, ff.open().read())
+        self.assertTrue(ff.check_checksum())
+
+        # Opened files are decompressed as they are read
+        af = ff.open(enforce_checksum=True, chunk_size=1000)
+        self.assertEqual(data[:10], af.read(10))
+        self.assertEqual(data[10:5000], af.read(4990))
+        self.assertIsNone(af.raw.valid_checksum)
+        self.assertEqual(data[5000:], af.read())
+        self.assertTrue(af.raw.valid_checksum)
+        af.close()
+
+        # Dissected archive files are extracted in the same way
+        self.assertEqual((checksum, checksum), ar._files[0].extract_checksums(None))
+
+        # Invalid checksums are detected while extracting
+        ar = SAPCARArchive(BytesIO(build_archive(checksum ^ 1)), "r")
+        ff = ar.files[self.test_filename]
+        self.assertFalse(ff.extract(BytesIO()))
+        self.assertFalse(ff.check_checksum())
+        af = ff.open(enforce_checksum=True)
+        self.assertRaises(SAPCARInvalidChecksumException, af.read)
+        af.close()
+        self.assertEqual(data, ff.open().read())
+
+    def test_sapcar_archive_extract_lzc(self):
+        """Test SAP CAR archive file extraction of files compressed using LZC algorithm"""
+
+        data = self.test_string * 500
+        checksum = SAPCARArchiveFile.calculate_checksum(data)
+        (_, _, compressed) = compress(data, ALG_LZC)
+
+        for block_length in [len(compressed), 100]:
+            blocks = b""
+            for i in range(0, len(compressed), block_length):
+                block = compressed[i:i + block_length]
+                if i + block_length < len(compressed):
+                    blocks += SAPCAR_BLOCK_TYPE_COMPRESSED + pack("<I", len(block)) + block
+                else:
+                    blocks += SAPCAR_BLOCK_TYPE_COMPRESSED_LAST + pack("<I", len(block)) + block
+            archive = b"CAR 2.01" + pack("<2sIQIQIHH", b"RG", self.test_perm_mode, len(data), 0,
+                                         self.test_timestamp_raw, 0, 0, len(self.test_filename) + 1) + \
+                self.test_filename.encode() + b"\x00" + blocks + pack("<i", checksum)
+
+            ar = SAPCARArchive(BytesIO(archive), "r")
+            ff = ar.files[self.test_filename]
+            for chunk_size in [7, 1000]:
+                out_file = BytesIO()
+                self.assertTrue(ff.extract(out_file, enforce_checksum=True, chunk_size=chunk_size))
+                self.assertEqual(data, out_file.getvalue())
+            self.assertEqual(data, ar.open(self.test_filename).read())
+
+    def test_sapcar_archive_extract_uncompressed(self):
+        """Test SAP CAR archive file extraction of files stored in uncompressed blocks"""
+
+        data = self.test_string * 10
+        checksum = SAPCARArchiveFile.calculate_checksum(data)
+        blocks = SAPCAR_BLOCK_TYPE_UNCOMPRESSED + pack("<I", 100) + data[:100] + \
+            SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST + pack("<I", len(data) - 100) + data[100:] + pack("<i", checksum)
+        archive = b"CAR 2.01" + pack("<2sIQIQIHH", b"RG", self.test_perm_mode, len(data), 0,
+                                     self.test_timestamp_raw, 0, 0, len(self.test_filename) + 1) + \
+            self.test_filename.encode() + b"\x00" + blocks
+
+        # The dissector and the index agree on the layout of the blocks
+        ff = SAPCARArchiveFilev201Format(archive[8:])
+        self.assertEqual([block.type for block in ff.blocks],
+                         [SAPCAR_BLOCK_TYPE_UNCOMPRESSED, SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST])
+        self.assertEqual(bytes(ff), archive[8:])
+        entry = SAPCARArchiveFileEntry(BytesIO(archive), SAPCAR_VERSION_201, 8)
+        self.assertEqual(entry.length, len(archive) - 8)
+        self.assertEqual([(block.type, block.length) for block in entry.blocks],
+                         [(SAPCAR_BLOCK_TYPE_UNCOMPRESSED, 100),
+                          (SAPCAR_BLOCK_TYPE_UNCOMPRESSED_LAST, len(data) - 100)])
+
+        for file_format in [ff, entry]:
+            af = SAPCARArchiveFile(file_format)
+            self.assertEqual(af.checksum, checksum)
+            out_file = BytesIO()
+            self.assertTrue(af.extract(out_file, enforce_checksum=True, chunk_size=7))
+            self.assertEqual(data, out_file.getvalue())
+
+        ar = SAPCARArchive(BytesIO(archive), "r")
+        self.assertEqual(data, ar.files[self.test_filename].open(enforce_checksum=True).read())
+
+    def test_sapcar_archive_writer(self):
+        """Test SAP CAR archive writer splitting files in several compressed blocks"""
+
+        data = self.test_string * 2000
+
+        for version in [SAPCAR_VERSION_200, SAPCAR_VERSION_201]:
+            fd = BytesIO()
+            writer = SAPCARArchiveWriter(fd, version=version, block_size=10000)
+            writer.add_file(self.test_filename)
+            writer.add_fileobj(BytesIO(data), self.test_filename + "two", len(data), self.test_perm_mode,
+                               self.test_timestamp_raw)
+            writer.add_fileobj(BytesIO(), "empty", 0)
+
+            ar = SAPCARArchive(fd, "r")
+            self.assertEqual(version, ar.version)
+            self.assertListEqual([self.test_filename, self.test_filename + "two", "empty"], ar.files_names)
+            self.assertEqual(self.test_string, ar.open(self.test_filename).read())
+
+            ff = ar.files[self.test_filename + "two"]
+            self.assertEqual(len(data), ff.size)
+            self.assertEqual(self.test_timestamp, ff.timestamp)
+            self.assertEqual(self.test_permissions, ff.permissions)
+            self.assertEqual(ff.calculate_checksum(data), ff.checksum)
+            self.assertTrue(ff.check_checksum())
+            self.assertEqual(data, ff.open(enforce_checksum=True).read())
+            self.assertEqual(0, ar.files["empty"].size)
+
+            # Appending keeps the version of the archive and the files already written
+            writer = SAPCARArchiveWriter(fd, append=True)
+            self.assertEqual(version, writer.version)
+            writer.add_fileobj(BytesIO(self.test_string), "three", len(self.test_string))
+
+            # Files whose length changed are not written
+            length = len(fd.getvalue())
+            self.assertRaises(SAPCARInvalidFileException, writer.add_fileobj, BytesIO(self.test_string), "four",
+                              len(self.test_string) + 1)
+            self.assertEqual(length, len(fd.getvalue()))
+
+            ar = SAPCARArchive(fd, "r")
+            self.assertListEqual([self.test_filename, self.test_filename + "two", "empty", "three"], ar.files_names)
+            self.assertEqual(self.test_string, ar.open("three").read())
+
+        self.assertRaises(SAPCARInvalidFileException, SAPCARArchiveWriter, BytesIO(b"CAR 2.02"), append=True)
+
+    def test_sapcar_archive_writer_blocks(self):
+        """Test SAP CAR archive writer compressing files in a single stream split in blocks"""
+
+        data = b"".join(self.test_string[i:] * (i + 1) * 100 for i in range(len(self.test_string)))
+
+        fd = BytesIO()
+        writer = SAPCARArchiveWriter(fd, block_size=1000)
+        writer.add_fileobj(BytesIO(data), self.test_filename, len(data))
+        writer.add_fileobj(BytesIO(self.test_string), self.test_filename + "two", len(self.test_string))
+
+        ar = SAPCARArchive(fd, "r")
+        self.assertListEqual([self.test_filename, self.test_filename + "two"], ar.files_names)
+        self.assertEqual(data, ar.files[self.test_filename].open(enforce_checksum=True).read())
+        self.assertEqual(self.test_string, ar.open(self.test_filename + "two").read())
+
+        # The blocks hold a single stream, that can be decompressed at once
+        ff = SAPCARArchiveFilev201Format(fd.getvalue()[8:])
+        blocks = [bytes(block.compressed)[4:] for block in ff.blocks]
+        self.assertGreater(len(blocks), 1)
+        self.assertTrue(all(len(block) == 1000 for block in blocks[:-1]))
+        (_, out_length, out_buffer) = decompress(b"".join(blocks), len(data))
+        self.assertEqual(data, out_buffer[:out_length])
+
+        # Files larger than the stream size are compressed in several streams, the last block of each one being
+        # longer than the compression header
+        blocks = list(sapcar_compress_blocks(BytesIO(data), len(data), block_size=1000, stream_size=len(data) // 3))
+        self.assertEqual(SAPCAR_BLOCK_TYPE_COMPRESSED_LAST, blocks[-1][0])
+        self.assertTrue(all(block_type == SAPCAR_BLOCK_TYPE_COMPRESSED for (block_type, _, _) in blocks[:-1]))
+        self.assertTrue(all(SAPCAR_BLOB_HEADER_SIZE < len(block) <= 1000 for (_, block, _) in blocks))
+
+        extracted = BytesIO()
+        (checksum, extracted_checksum) = sapcar_extract_blocks(((block_type, [block], checksum)
+                                                                for (block_type, block, checksum) in blocks),
+                                                               extracted)
+        self.assertEqual(data, extracted.getvalue())
+        self.assertEqual(checksum, extracted_checksum)
+
+    def test_sapcar_archive_writer_executor(self):
+        """Test SAP CAR archive writer compressing several files concurrently"""
+
+        filenames = [(self.test_filename, "%s%d" % (self.test_filename, i)) for i in range(5)]
+        filenames.insert(2, ("nonexistent.txt", "nonexistent.txt"))
+
+        fd = BytesIO()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            writer = SAPCARArchiveWriter(fd, block_size=1000, executor=executor, max_pending=2)
+            results = list(writer.add_files(filenames))
+
+        self.assertListEqual(filenames, [(filename, archive_filename) for (filename, archive_filename, _) in results])
+        self.assertIsInstance(results[2][2], (IOError, OSError))
+        self.assertTrue(all(e is None for (_, _, e) in results[:2] + results[3:]))
+
+        ar = SAPCARArchive(fd, "r")
+        del filenames[2]
+        self.assertListEqual([archive_filename for (_, archive_filename) in filenames], ar.files_names)
+        for archive_filename in ar.files_names:
+            self.assertEqual(self.test_string, ar.files[archive_filename].open(enforce_checksum=True).read())
+
+    def test_sapcar_archive_writer_file_length(self):
+        """Test SAP CAR archive writer file length for files over 4GB"""
+
+        fd = BytesIO()
+        writer = SAPCARArchiveWriter(fd)
+        writer._write_header(b"RG", self.test_perm_mode, (SIZE_FOUR_GB * 2) + 99999, self.test_timestamp_raw,
+                             self.test_filename)
+
+        ff = SAPCARArchiveFilev201Format(fd.getvalue()[8:])
+        self.assertEqual(99999, ff.file_length_low)
+        self.assertEqual(2, ff.file_length_high)
+        self.assertEqual((SIZE_FOUR_GB * 2) + 99999, ff.file_length)
+        self.assertEqual(self.test_filename.encode(), ff.filename)
+
     def test_sapcar_archive_file_length(self):
 
         for cls in [SAPCARArchiveFilev200Format, SAPCARArchiveFilev201Format]:
@@ -17,18 +17,25 @@
 #
 
 # Standard imports
+import os
 import sys
+import copy
+import pickle
+import signal
 import socket
+import asyncio
 import unittest
-from threading import Thread
+from threading import Event, Thread, Timer
 from struct import pack, unpack
 from socketserver import BaseRequestHandler, ThreadingTCPServer
 # External imports
 from scapy.fields import StrField
 from scapy.packet import Packet, Raw
 # Custom imports
-from pysap.SAPNI import (SAPNI, SAPNIStreamSocket, SAPNIServerThreaded,
-                         SAPNIServerHandler, SAPNIProxy, SAPNIProxyHandler)
+from pysap.SAPNI import (SAPNI, SAPNIStreamSocket, SAPNIServerThreaded, SAPNIServerPreforked,
+                         SAPNIServerHandler, SAPNIProxy, SAPNIProxyHandler,
+                         SAPNIForwarder, SAPNIKeepAliveScheduler, SAPNIFrame,
+                         SAPNIHistogram, open_ni_connection)
 
 
 class PySAPBaseServerTest(unittest.TestCase):
@@ -85,6 +92,58 @@ class PySAPNITest(unittest.TestCase):
         self.assertEqual(sapni.length, len(test_string_bytes))
         self.assertEqual(sapni.payload.load, test_string_bytes)
 
+    def test_sapni_histogram(self):
+        """Test SAPNIHistogram buckets and percentiles"""
+        histogram = SAPNIHistogram()
+        for value in range(1, 1001):
+            histogram.record(value / 1000000.0)
+
+        self.assertEqual(histogram.count, 1000)
+        self.assertEqual(histogram.min, 0.000001)
+        self.assertEqual(histogram.max, 0.001)
+        for percentile in (50, 90, 99):
+            self.assertAlmostEqual(histogram.percentile(percentile),
+                                   percentile / 100000.0, delta=percentile / 1600000.0)
+        self.assertEqual(histogram.percentile(100), 0.001)
+
+        buckets = histogram.buckets()
+        self.assertEqual(buckets[-1][1], 1000)
+        self.assertEqual([count for _, count in buckets], sorted(count for _, count in buckets))
+
+    def test_sapni_frame(self):
+        """Test SAPNIFrame lazy dissection"""
+        test_string_bytes = self.test_string.encode()
+        data = pack("!I", len(test_string_bytes)) + test_string_bytes
+        frame = SAPNIFrame(data, Raw)
+
+        self.assertEqual(frame.length, len(test_string_bytes))
+        self.assertEqual(frame.load, test_string_bytes)
+        self.assertEqual(bytes(frame), data)
+        self.assertEqual(len(frame), len(data))
+        self.assertFalse(frame.dissected)
+
+        self.assertIn(Raw, frame)
+        self.assertTrue(frame.dissected)
+        self.assertEqual(frame[SAPNI].length, len(test_string_bytes))
+        self.assertEqual(frame[Raw].load, test_string_bytes)
+
+        # Modifications are reflected when building the frame again
+        frame[Raw].load = b"LALA"
+        self.assertEqual(bytes(frame), pack("!I", 4) + b"LALA")
+
+    def test_sapni_frame_copy(self):
+        """Test copying and pickling SAPNIFrame"""
+        data = pack("!I", 4) + b"LALA"
+        frame = SAPNIFrame(data, Raw)
+        for copied in [copy.copy(frame), copy.deepcopy(frame), pickle.loads(pickle.dumps(frame))]:
+            self.assertFalse(copied.dissected)
+            self.assertEqual(bytes(copied), data)
+            self.assertEqual(copied[Raw].load, b"LALA")
+        self.assertFalse(frame.dissected)
+
+        with self.assertRaises(AttributeError):
+            frame.__missing__
+
 
 class SAPNITestHandler(BaseRequestHandler):
     """Basic SAP NI echo server implemented using TCPServer"""
@@ -113,6 +172,19 @@ class SAPNITestHandlerClose(SAPNITestHandler):
         self.request.send(b"")
 
 
+class SAPNITestHandlerPipelined(SAPNITestHandler):
+    """Basic SAP NI server that echoes the request back twice in a single
+    write"""
+
+    def handle(self):
+        data = self.request.recv(4)
+        (length, ) = unpack("!I", data)
+        data = self.request.recv(length)
+
+        response = pack("!I", len(data)) + data
+        self.request.sendall(response + response)
+
+
 class PySAPNIStreamSocketTest(PySAPBaseServerTest):
 
     test_port = 8005
@@ -137,6 +209,136 @@ class PySAPNIStreamSocketTest(PySAPBaseServerTest):
 
         self.stop_server()
 
+    def test_sapnistreamsocket_pipelined(self):
+        """Test SAPNIStreamSocket receiving several frames in a single read"""
+        self.start_server(self.test_address, self.test_port, SAPNITestHandlerPipelined)
+
+        sock = socket.socket()
+        sock.connect((self.test_address, self.test_port))
+
+        self.client = SAPNIStreamSocket(sock)
+        self.client.send(Raw(self.test_string))
+
+        for _ in range(2):
+            packet = self.client.recv()
+            packet.decode_payload_as(Raw)
+            self.assertEqual(packet[SAPNI].length, len(self.test_string))
+            self.assertEqual(packet.payload.load, self.test_string.encode())
+        self.assertFalse(self.client.has_pending_frame())
+        self.client.close()
+
+        self.stop_server()
+
+    def test_sapnistreamsocket_lazy(self):
+        """Test SAPNIStreamSocket receiving lazy frames"""
+        peer, sock = socket.socketpair()
+        self.client = SAPNIStreamSocket(sock, base_cls=Raw, lazy=True)
+        data = pack("!I", len(self.test_string)) + self.test_string.encode()
+        peer.sendall(data)
+
+        frame = self.client.recv()
+        self.assertIsInstance(frame, SAPNIFrame)
+        self.assertEqual(bytes(frame), data)
+        self.assertFalse(frame.dissected)
+        self.assertEqual(frame.payload.load, self.test_string.encode())
+
+        # Frames are sent as they were received
+        self.client.send(frame)
+        self.assertEqual(peer.recv(len(data)), data)
+
+        self.client.close()
+        peer.close()
+
+    def test_sapnistreamsocket_metrics(self):
+        """Test SAPNIStreamSocket traffic and latency metrics"""
+        peer, sock = socket.socketpair()
+        self.client = SAPNIStreamSocket(sock, base_cls=Raw)
+        data = pack("!I", len(self.test_string)) + self.test_string.encode()
+        ping = pack("!I", 8) + SAPNI.SAPNI_PING.encode()
+        peer.sendall(ping + data)
+
+        self.client.sr(Raw(self.test_string))
+        self.assertEqual(peer.recv(len(data) + 12), data + pack("!I", 8) + SAPNI.SAPNI_PONG.encode())
+
+        metrics = self.client.metrics.snapshot()
+        self.assertEqual(metrics["frames_sent"], 2)
+        self.assertEqual(metrics["frames_received"], 2)
+        self.assertEqual(metrics["bytes_sent"], len(data) + 12)
+        self.assertEqual(metrics["bytes_received"], len(data) + 12)
+        self.assertEqual(metrics["pings_received"], 1)
+        self.assertEqual(metrics["pongs_sent"], 1)
+        self.assertEqual(metrics["sr_latency"]["count"], 1)
+
+        prometheus = self.client.metrics.to_prometheus(labels={"peer": "test"})
+        self.assertIn('pysap_ni_frames_sent_total{peer="test"} 2\n', prometheus)
+        self.assertIn('pysap_ni_sr_latency_seconds_count{peer="test"} 1\n', prometheus)
+        self.assertIn('pysap_ni_sr_latency_seconds_bucket{peer="test",le="+Inf"} 1\n', prometheus)
+
+        self.client.close()
+        peer.close()
+
+    def test_sapnistreamsocket_send_many(self):
+        """Test SAPNIStreamSocket sending several frames in a batch"""
+        peer, sock = socket.socketpair()
+        self.client = SAPNIStreamSocket(sock)
+        self.client.sendmsg_max_buffers = 3
+
+        payloads = [Raw(self.test_string), self.test_string.encode(), b"",
+                    memoryview(self.test_string.encode())[4:]]
+        expected = b"".join(pack("!I", len(bytes(payload))) + bytes(payload)
+                            for payload in payloads)
+        self.assertEqual(self.client.send_many(payloads), len(expected))
+
+        peer.settimeout(1)
+        received = b""
+        while len(received) < len(expected):
+            received += peer.recv(len(expected))
+        self.assertEqual(received, expected)
+
+        self.client.close()
+        peer.close()
+
+    def test_sapnistreamsocket_send_many_partial(self):
+        """Test SAPNIStreamSocket sending a batch larger than the socket buffers"""
+        peer, sock = socket.socketpair()
+        self.client = SAPNIStreamSocket(sock)
+        peer_client = SAPNIStreamSocket(peer)
+
+        payloads = [os.urandom(64 * 1024) for _ in range(32)]
+        sender = Thread(target=self.client.send_many, args=(payloads, ))
+        sender.daemon = True
+        sender.start()
+
+        for payload in payloads:
+            self.assertEqual(bytes(peer_client.recv_frame()[4:]), payload)
+        sender.join(1)
+
+        self.client.close()
+        peer_client.close()
+
+    def test_sapnistreamsocket_large_frame(self):
+        """Test SAPNIStreamSocket receiving frames larger than the receive buffer"""
+        self.start_server(self.test_address, self.test_port, SAPNITestHandlerPipelined)
+
+        sock = socket.socket()
+        sock.connect((self.test_address, self.test_port))
+
+        class SAPNISmallBufferStreamSocket(SAPNIStreamSocket):
+            recv_buffer_size = 16
+
+        test_string = self.test_string * 10
+        self.client = SAPNISmallBufferStreamSocket(sock)
+        self.client.send(Raw(test_string))
+
+        frame = self.client.recv_frame()
+        self.assertEqual(bytes(frame), pack("!I", len(test_string)) + test_string.encode())
+        packet = self.client.recv()
+        packet.decode_payload_as(Raw)
+        self.assertEqual(packet.payload.load, test_string.encode())
+        self.client.close()
+
+        self.stop_server()
+
     def test_sapnistreamsocket_base_cls(self):
         """Test SAPNIStreamSocket handling of custom base packet classes"""
         self.start_server(self.test_address, self.test_port, SAPNITestHandler)
@@ -245,6 +447,157 @@ class PySAPNIStreamSocketTest(PySAPBaseServerTest):
         self.stop_server()
 
 
+class PySAPNIKeepAliveSchedulerTest(unittest.TestCase):
+
+    ping = pack("!I", 8) + SAPNI.SAPNI_PING.encode()
+    pong = pack("!I", 8) + SAPNI.SAPNI_PONG.encode()
+
+    def setUp(self):
+        self.peer, sock = socket.socketpair()
+        self.peer.settimeout(2)
+        self.client = SAPNIStreamSocket(sock, keep_alive=False)
+        self.dead = Event()
+        self.scheduler = SAPNIKeepAliveScheduler(interval=0.05, timeout=0.1, tick=0.01,
+                                                 wheel_size=8, callback=lambda s: self.dead.set())
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.client.close()
+        self.peer.close()
+
+    def test_keepalive_scheduler_ping(self):
+        """Test SAPNIKeepAliveScheduler sending keep-alive requests on idle sockets"""
+        self.scheduler.register(self.client)
+        self.scheduler.start()
+
+        self.assertEqual(self.peer.recv(len(self.ping)), self.ping)
+        self.peer.sendall(self.pong + pack("!I", 4) + b"LALA")
+
+        # The response is handled by the scheduler and not returned
+        packet = self.client.recv()
+        self.assertEqual(packet.payload.load, b"LALA")
+        self.assertIsNotNone(self.scheduler.get_rtt(self.client))
+        self.assertFalse(self.dead.is_set())
+        self.assertEqual(self.client.metrics.pings_sent, 1)
+        self.assertEqual(self.client.metrics.keepalive_rtt.count, 1)
+
+        # The response is returned if the scheduler didn't expect it
+        self.scheduler.unregister(self.client)
+        self.peer.sendall(self.pong)
+        self.assertEqual(self.client.recv().payload.load, SAPNI.SAPNI_PONG.encode())
+
+    def test_keepalive_scheduler_dead_peer(self):
+        """Test SAPNIKeepAliveScheduler detecting dead peers"""
+        self.scheduler.register(self.client)
+        self.scheduler.start()
+
+        self.assertEqual(self.peer.recv(len(self.ping)), self.ping)
+        self.assertTrue(self.dead.wait(2))
+        self.assertNotIn(self.client, self.scheduler.entries)
+        self.assertIsNone(self.client.keep_alive_scheduler)
+
+    def test_keepalive_scheduler_wheel(self):
+        """Test SAPNIKeepAliveScheduler deadlines beyond the size of the wheel"""
+        entry = self.scheduler.register(self.client, interval=0.25)
+        for _ in range(24):
+            self.scheduler.run_tick(self.client.last_activity)
+        self.assertIsNone(entry.ping_sent)
+
+        for _ in range(8):
+            self.scheduler.run_tick(self.client.last_activity + 0.3)
+        self.assertIsNotNone(entry.ping_sent)
+        self.assertEqual(self.peer.recv(len(self.ping)), self.ping)
+
+    def test_keepalive_scheduler_send_locked(self):
+        """Test SAPNIKeepAliveScheduler not waiting for sockets that are sending data"""
+        entry = self.scheduler.register(self.client)
+        now = self.client.last_activity + 0.1
+
+        # The request is delayed while the socket is sending data, without
+        # blocking the scheduler
+        with self.client._send_lock:
+            for _ in range(8):
+                self.scheduler.run_tick(now)
+            self.assertIsNone(entry.ping_sent)
+            self.assertIn(self.client, self.scheduler.entries)
+
+        for _ in range(8):
+            self.scheduler.run_tick(now)
+        self.assertIsNotNone(entry.ping_sent)
+        self.assertEqual(self.peer.recv(len(self.ping)), self.ping)
+
+
+class PySAPNIStreamTest(PySAPBaseServerTest):
+
+    test_port = 8005
+    test_address = "127.0.0.1"
+    test_string = "TEST" * 10
+
+    def test_sapnistream(self):
+        """Test SAPNIStream"""
+        self.start_server(self.test_address, self.test_port, SAPNITestHandlerPipelined)
+
+        async def client():
+            stream = await open_ni_connection(self.test_address, self.test_port)
+            first = await stream.sr(Raw(self.test_string))
+            second = await stream.recv()
+            stream.close()
+            await stream.wait_closed()
+            return first, second
+
+        for packet in asyncio.run(client()):
+            packet.decode_payload_as(Raw)
+            self.assertIn(SAPNI, packet)
+            self.assertEqual(packet[SAPNI].length, len(self.test_string))
+            self.assertEqual(packet.payload.load, self.test_string.encode())
+
+        self.stop_server()
+
+    def test_sapnistream_base_cls(self):
+        """Test SAPNIStream handling of custom base packet classes"""
+        self.start_server(self.test_address, self.test_port, SAPNITestHandler)
+
+        class SomeClass(Packet):
+            fields_desc = [StrField("text", None)]
+
+        async def client():
+            stream = await open_ni_connection(self.test_address, self.test_port,
+                                              base_cls=SomeClass)
+            packet = await stream.sr(Raw(self.test_string))
+            stream.close()
+            return packet
+
+        packet = asyncio.run(client())
+        self.assertIn(SomeClass, packet)
+        self.assertEqual(packet[SomeClass].text, self.test_string.encode())
+
+        self.stop_server()
+
+    def test_sapnistream_keep_alive(self):
+        """Test SAPNIStream with and without keep alive"""
+        self.start_server(self.test_address, self.test_port, SAPNITestHandlerKeepAlive)
+
+        async def client(keep_alive):
+            stream = await open_ni_connection(self.test_address, self.test_port,
+                                              keep_alive=keep_alive)
+            packets = [await stream.sr(Raw(self.test_string))]
+            try:
+                packets.append(await stream.recv())
+            except socket.error:
+                pass
+            stream.close()
+            return packets
+
+        packets = asyncio.run(client(False))
+        self.assertEqual(len(packets), 2)
+        self.assertEqual(packets[1].payload.load, SAPNI.SAPNI_PING.encode())
+
+        packets = asyncio.run(client(True))
+        self.assertEqual(len(packets), 1)
+
+        self.stop_server()
+
+
 class SAPNIServerTestHandler(SAPNIServerHandler):
     """Basic SAP NI echo server implemented using SAPNIServer"""
 
@@ -290,6 +643,103 @@ class PySAPNIServerTest(PySAPBaseServerTest):
         self.stop_server()
 
 
+class SAPNIServerPidTestHandler(SAPNIServerHandler):
+    """Basic SAP NI server that replies with the pid of the process serving
+    the client"""
+
+    def handle_data(self):
+        self.request.send(Raw(str(os.getpid()).encode()))
+
+
+class PySAPNIServerPreforkedTest(PySAPBaseServerTest):
+
+    test_port = 8005
+    test_address = "127.0.0.1"
+
+    def test_sapniserver_preforked(self):
+        """Test SAPNIServerPreforked"""
+        self.server = SAPNIServerPreforked((self.test_address, self.test_port),
+                                           SAPNIServerPidTestHandler, workers=2)
+        self.server_thread = Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        pids = set()
+        for _ in range(10):
+            client = None
+            for _ in range(50):
+                try:
+                    client = SAPNIStreamSocket.get_nisocket(self.test_address, self.test_port)
+                    break
+                except socket.error:
+                    # Workers might not be listening yet
+                    self.server_thread.join(0.1)
+            packet = client.sr(Raw("PING"))
+            packet.decode_payload_as(Raw)
+            pids.add(int(packet.load))
+            client.close()
+
+        self.assertTrue(pids.issubset(set(self.server.worker_pids)))
+        self.assertNotIn(os.getpid(), pids)
+
+        # Reload the workers and check the new ones serve the clients
+        old_worker_pids = set(self.server.worker_pids)
+        self.server.reload()
+        self.assertEqual(len(self.server.worker_pids), 2)
+        self.assertTrue(old_worker_pids.isdisjoint(self.server.worker_pids))
+        for _ in range(50):
+            if not self.server._retired_pids:
+                break
+            self.server_thread.join(0.1)
+        self.assertFalse(self.server._retired_pids)
+
+        client = SAPNIStreamSocket.get_nisocket(self.test_address, self.test_port)
+        packet = client.sr(Raw("PING"))
+        packet.decode_payload_as(Raw)
+        self.assertIn(int(packet.load), self.server.worker_pids)
+        client.close()
+
+        worker_pids = list(self.server.worker_pids)
+        self.server.shutdown()
+        self.server_thread.join(5)
+        self.assertFalse(self.server_thread.is_alive())
+        for pid in worker_pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+        self.server.server_close()
+
+    def test_sapniserver_preforked_respawn(self):
+        """Test SAPNIServerPreforked restarting failing workers with backoff"""
+
+        class SAPNIServerPreforkedFailing(SAPNIServerPreforked):
+            respawn_delay = 0.1
+            spawned = 0
+
+            def _spawn_worker(self, worker_id):
+                self.spawned += 1
+                SAPNIServerPreforked._spawn_worker(self, worker_id)
+
+            def server_activate(self):
+                if self.worker_id is not None:
+                    raise Exception("Worker failure")
+
+        self.server = SAPNIServerPreforkedFailing((self.test_address, self.test_port),
+                                                  SAPNIServerPidTestHandler, workers=1)
+        # Signal handlers are installed only when serving on the main thread,
+        # and restored once the server stops
+        handlers = [signal.getsignal(signum) for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)]
+        timer = Timer(1, self.server.shutdown)
+        timer.start()
+        self.server.serve_forever()
+        timer.join()
+        self.server.server_close()
+
+        # Restarts are delayed 0.1, 0.2 and 0.4 seconds
+        self.assertLessEqual(self.server.spawned, 5)
+        self.assertEqual(handlers, [signal.getsignal(signum)
+                                    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)])
+
+
 class PySAPNIProxyTest(PySAPBaseServerTest):
 
     test_proxyport = 8005
@@ -298,11 +748,15 @@ class PySAPNIProxyTest(PySAPBaseServerTest):
     test_string = "TEST" * 10
     proxyhandler_cls = SAPNIProxyHandler
     serverhandler_cls = SAPNIServerTestHandler
+    passthrough = False
+    lazy = False
+    proxy_cls = SAPNIProxy
 
     def start_sapniproxy(self, handler_cls):
-        self.proxy = SAPNIProxy(self.test_address, self.test_proxyport,
-                                self.test_address, self.test_serverport,
-                                handler=handler_cls)
+        self.proxy = self.proxy_cls(self.test_address, self.test_proxyport,
+                                    self.test_address, self.test_serverport,
+                                    handler=handler_cls, passthrough=self.passthrough,
+                                    lazy=self.lazy)
         self.proxy_thread = Thread(target=self.handle_sapniproxy)
         self.proxy_thread.daemon = True
         self.proxy_thread.start()
@@ -377,5 +831,97 @@ class PySAPNIProxyTest(PySAPBaseServerTest):
         self.stop_sapniproxy()
         self.stop_server()
 
+
+class PySAPNIProxyEventLoopTest(PySAPNIProxyTest):
+
+    def handle_sapniproxy(self):
+        self.proxy.serve_forever()
+
+    def stop_sapniproxy(self):
+        self.proxy.stop()
+        self.proxy_thread.join(1)
+        self.assertFalse(self.proxy_thread.is_alive())
+
+    def test_sapniproxy_multiple_clients(self):
+        self.start_server(self.test_address, self.test_serverport,
+                          self.serverhandler_cls, SAPNIServerThreaded)
+        self.start_sapniproxy(self.proxyhandler_cls)
+
+        socks = []
+        for i in range(10):
+            sock = socket.socket()
+            sock.connect((self.test_address, self.test_proxyport))
+            socks.append(sock)
+
+        for i, sock in enumerate(socks):
+            test_string = (self.test_string * (i + 1)).encode()
+            sock.sendall(pack("!I", len(test_string)) + test_string)
+
+        for i, sock in enumerate(socks):
+            test_string = (self.test_string * (i + 1)).encode()
+            expected = pack("!I", len(test_string) + 4) + pack("!I", len(test_string)) + test_string
+            response = b""
+            while len(response) < len(expected):
+                response += sock.recv(len(expected) - len(response))
+            self.assertEqual(response, expected)
+            sock.close()
+
+        self.stop_sapniproxy()
+        self.stop_server()
+
+
+class PySAPNIProxyPassthroughTest(PySAPNIProxyTest):
+
+    passthrough = True
+
+    def test_sapniproxy_can_passthrough(self):
+        class SAPNIProxyHandlerTest(SAPNIProxyHandler):
+            def process_client(self, packet):
+                return packet
+
+        self.assertTrue(SAPNIProxyHandler.can_passthrough())
+        self.assertFalse(SAPNIProxyHandlerTest.can_passthrough())
+
+
+class PySAPNIProxyPassthroughCopyTest(PySAPNIProxyPassthroughTest):
+
+    def setUp(self):
+        SAPNIForwarder.use_splice = False
+
+    def tearDown(self):
+        SAPNIForwarder.use_splice = hasattr(os, "splice")
+
+
+class PySAPNIProxyEventLoopPassthroughTest(PySAPNIProxyEventLoopTest):
+
+    passthrough = True
+
+
+class PySAPNIProxyLazyTest(PySAPNIProxyTest):
+
+    lazy = True
+
+
+class PySAPNIProxyEventLoopLazyTest(PySAPNIProxyEventLoopTest):
+
+    lazy = True
+
+
+class SAPNIProxyBlockingConnect(SAPNIProxy):
+    """Proxy connecting to the remote host in a blocking way, as routed proxies do"""
+
+    blocking_connect = True
+
+    def _connect_remote(self):
+        remote = socket.create_connection(self.remote_host)
+        remote.setblocking(False)
+        return SAPNIStreamSocket(remote, self.keep_alive, lazy=self.lazy)
+
+
+class PySAPNIProxyEventLoopBlockingConnectTest(PySAPNIProxyEventLoopTest):
+
+    proxy_cls = SAPNIProxyBlockingConnect
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=1)
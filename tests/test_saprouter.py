@@ -18,16 +18,34 @@
 
 # Standard imports
 import sys
+import json
 import socket
+import asyncio
 import unittest
-from struct import unpack
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from struct import pack, unpack
+from select import select
 from threading import Thread
 # External imports
+from scapy.packet import Raw
 
 # Custom imports
-from pysap.SAPNI import SAPNIServerHandler, SAPNIServerThreaded, SAPNI
+from pysap.SAPNI import SAPNIServerHandler, SAPNIServerThreaded, SAPNI, SAPNIStreamSocket
 from pysap.SAPRouter import (SAPRouter, SAPRouterRouteHop, router_is_route,
-                             SAPRoutedStreamSocket, SAPRouteException)
+                             SAPRoutedStreamSocket, SAPRouteException, SAPRouteVersionException,
+                             SAPNIConnectionPool, SAPRouterScanner,
+                             SAPRouterCapabilityCache, router_capabilities,
+                             SAPRouterRouteTemplate, get_route_template,
+                             build_route_request, SAPRouterRoutePool,
+                             SAPRouterInfoClient, SAPRouterInfoClients,
+                             router_info_clients, router_info_clients_count,
+                             SAPRouterError, SAPRouterFingerprintDB,
+                             router_fingerprint_fields, SAPRouterRouteTable,
+                             router_host_intervals, SAPRouterRoute,
+                             parse_route_string, SAPRouterServer, SAPRouterInfoServer,
+                             ROUTER_TALK_MODE_NI_RAW_IO, ROUTER_TALK_MODE_NI_MSG_IO)
 
 
 class PySAPRouterTest(unittest.TestCase):
@@ -41,6 +59,85 @@ class PySAPRouterTest(unittest.TestCase):
         route_string = route_string.replace("/h/", "/H/").replace("/s/", "/S/").replace("/p/", "/P/").replace("/w/", "/W/")
         self.assertEqual(string, route_string)
 
+    def test_saprouter_route_template(self):
+        """Test route requests rendered from SAPRouterRouteTemplate"""
+        routes = ["/H/host1/S/3299/H/host2/S/3200/W/pass2",
+                  "/H/host1/H/host2/S/service2/W/pass2/H/host3",
+                  "/H/some.valid.domain.com/S/3299"]
+        for route_string in routes:
+            route = SAPRouterRouteHop.from_string(route_string)
+            for talk_mode in (0, 1):
+                request = bytes(build_route_request(route, talk_mode, 39))
+                template = SAPRouterRouteTemplate(route[:-1], talk_mode, 39)
+                self.assertEqual(template.render(route[-1].hostname, route[-1].port,
+                                                 route[-1].password), request)
+                self.assertEqual(template.render_frame(route[-1].hostname, route[-1].port,
+                                                       route[-1].password)[4:], request)
+
+        # Templates are compiled once for each route prefix
+        route = SAPRouterRouteHop.from_string("/H/host1/S/3299")
+        template = get_route_template(route, ROUTER_TALK_MODE_NI_RAW_IO, 40)
+        self.assertIs(get_route_template(SAPRouterRouteHop.from_string("/H/host1/S/3299"),
+                                         ROUTER_TALK_MODE_NI_RAW_IO, 40), template)
+        self.assertIsNot(get_route_template(route, ROUTER_TALK_MODE_NI_RAW_IO, 39), template)
+
+    def test_saprouter_route_parse(self):
+        """Test routes parsed with parse_route_string"""
+        routes = ["/H/host1/S/3299/H/host2/S/3200/W/pass2",
+                  "/H/host1/H/host2/S/service2/W/pass2/H/host3",
+                  "/h/some.valid.domain.com/s/3299"]
+        for route_string in routes:
+            route = parse_route_string(route_string)
+            hops = SAPRouterRouteHop.from_string(route_string)
+            self.assertIs(parse_route_string(route_string), route)
+            self.assertIsInstance(route, tuple)
+            self.assertEqual(route.route_string, SAPRouterRouteHop.from_hops(hops))
+            self.assertEqual(route.route_length, sum(len(bytes(hop)) for hop in hops))
+            self.assertEqual(route.route_offset, len(bytes(hops[0])))
+            for talk_mode in (0, 1):
+                self.assertEqual(route.render_request(talk_mode, 39),
+                                 bytes(build_route_request(hops, talk_mode, 39)))
+
+        # Appending hops returns a new route
+        route = parse_route_string("/H/host1/S/3299")
+        extended = route.append("host2", 3200, "pass")
+        self.assertEqual(len(route), 1)
+        self.assertEqual(extended.route_string, "/H/host1/S/3299/H/host2/S/3200/W/pass")
+        self.assertIs(SAPRouterRoute.from_hops(extended), extended)
+        self.assertEqual(SAPRouterRoute.from_hops(SAPRouterRouteHop.from_string(extended.route_string)),
+                         extended)
+
+    def test_saprouter_info_clients(self):
+        """Test streaming decoding of SAP Router info client lists"""
+        clients = [SAPRouterInfoClient(id=i, flag_traced=i % 3 == 0, flag_connected=1,
+                                       flag_routed=i % 2, connected_on=1000 + i,
+                                       address="10.0.0.%d" % (i % 3), partner="partner%d" % (i % 2),
+                                       service="sapdp0%d" % i)
+                   for i in range(6)]
+        data = bytes(SAPRouterInfoClients(clients=clients))
+
+        # Records match the fields dissected by scapy, trailing data is ignored
+        parsed = SAPRouterInfoClients(data).clients
+        records = list(router_info_clients(data + b"\x00" * 10))
+        self.assertEqual(len(records), len(parsed))
+        for record, client in zip(records, parsed):
+            self.assertEqual(record.id, client.id)
+            self.assertEqual(record.traced, bool(client.flag_traced))
+            self.assertEqual(record.connected, bool(client.flag_connected))
+            self.assertEqual(record.routed, bool(client.flag_routed))
+            self.assertEqual(record.connected_on, client.connected_on)
+            self.assertEqual(record.address, client.address.rstrip(b"\x00").decode())
+            self.assertEqual(record.partner, client.partner.rstrip(b"\x00").decode())
+            self.assertEqual(record.service, client.service.rstrip(b"\x00").decode())
+
+        # Filtering and aggregation
+        routed = list(router_info_clients(data, lambda record: record.routed))
+        self.assertListEqual([record.id for record in routed], [1, 3, 5])
+        self.assertEqual(router_info_clients_count(data),
+                         {"10.0.0.0": 2, "10.0.0.1": 2, "10.0.0.2": 2})
+        self.assertEqual(router_info_clients_count(data, "partner", lambda record: record.routed),
+                         {"partner1": 3})
+
     def test_saprouter_route_string(self):
         """Test construction of SAPRouterRouteHop items"""
 
@@ -245,5 +342,627 @@ class PySAPRoutedStreamSocketTest(unittest.TestCase):
         self.stop_server()
 
 
+class SAPNIEchoTestHandler(SAPNIServerHandler):
+    """Basic SAP NI echo server that closes the connection when requested"""
+
+    def handle_data(self):
+        if self.packet.payload.load == b"CLOSE":
+            self.closed.set()
+            self.request.close()
+            return
+        self.request.send(self.packet.payload)
+
+
+class PySAPNIConnectionPoolTest(unittest.TestCase):
+
+    test_port = 8008
+    test_address = "127.0.0.1"
+    test_string = "TEST" * 10
+
+    def setUp(self):
+        self.server = SAPNIServerThreaded((self.test_address, self.test_port),
+                                          SAPNIEchoTestHandler,
+                                          bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server_thread = Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.pool = SAPNIConnectionPool(max_size=2, idle_timeout=60)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join(1)
+
+    def test_connection_pool_reuse(self):
+        """Test SAPNIConnectionPool reusing connections to the same target"""
+        with self.pool.connection(self.test_address, self.test_port) as conn:
+            packet = conn.sr(Raw(self.test_string))
+            self.assertEqual(packet[SAPNI].payload.load, self.test_string.encode())
+        self.assertEqual(len(self.pool), 1)
+
+        with self.pool.connection(self.test_address, str(self.test_port)) as reused:
+            self.assertIs(reused, conn)
+            packet = reused.sr(Raw(self.test_string))
+            self.assertEqual(packet[SAPNI].payload.load, self.test_string.encode())
+
+        # Connections are discarded on errors
+        with self.assertRaises(ValueError):
+            with self.pool.connection(self.test_address, self.test_port) as reused:
+                raise ValueError()
+        self.assertTrue(reused.closed)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_connection_pool_get_nisocket(self):
+        """Test get_nisocket taking connections from a SAPNIConnectionPool"""
+        conn = SAPRoutedStreamSocket.get_nisocket(self.test_address, self.test_port,
+                                                  pool=self.pool)
+        packet = conn.sr(Raw(self.test_string))
+        self.assertEqual(packet[SAPNI].payload.load, self.test_string.encode())
+        self.pool.put(conn)
+
+        reused = SAPRoutedStreamSocket.get_nisocket(self.test_address, self.test_port,
+                                                    pool=self.pool)
+        self.assertIs(reused, conn)
+        self.pool.put(reused)
+
+        # Connections using a different password are not shared
+        other = SAPRoutedStreamSocket.get_nisocket(self.test_address, self.test_port,
+                                                   password="secret", pool=self.pool)
+        self.assertIsNot(other, conn)
+        other.close()
+
+    def test_connection_pool_eviction(self):
+        """Test SAPNIConnectionPool evicting connections"""
+        conns = [self.pool.get(self.test_address, self.test_port) for _ in range(3)]
+        for conn in conns:
+            self.pool.put(conn)
+        self.assertEqual(len(self.pool), 2)
+        self.assertTrue(conns[0].closed)
+
+        self.pool.idle_timeout = 0
+        self.pool.evict_idle()
+        self.assertEqual(len(self.pool), 0)
+        self.assertTrue(all(conn.closed for conn in conns))
+
+    def test_connection_pool_health_check(self):
+        """Test SAPNIConnectionPool checking and discarding stale connections"""
+        conn = self.pool.get(self.test_address, self.test_port)
+        self.assertTrue(self.pool.check(conn))
+        self.assertFalse(conn.has_pending_frame())
+
+        conn.send(Raw(b"CLOSE"))
+        self.pool.put(conn)
+        select([conn.ins], [], [], 1)
+
+        other = self.pool.get(self.test_address, self.test_port)
+        self.assertIsNot(other, conn)
+        self.assertTrue(conn.closed)
+        self.pool.put(other)
+
+    def test_connection_pool_async(self):
+        """Test SAPNIConnectionPool from asyncio code"""
+        async def run():
+            async with self.pool.connection_async(self.test_address, self.test_port) as conn:
+                return conn, conn.sr(Raw(self.test_string))
+
+        conn, packet = asyncio.run(run())
+        self.assertEqual(packet[SAPNI].payload.load, self.test_string.encode())
+        reused = self.pool.get(self.test_address, self.test_port)
+        self.assertIs(reused, conn)
+        self.pool.put(reused)
+
+class PySAPRouterScannerTest(unittest.TestCase):
+
+    test_address = "127.0.0.1"
+    silent = False
+
+    async def handle_router(self, reader, writer):
+        """Basic SAP Router that accepts routes to port 3200, closes the
+        connection for port 3201, doesn't answer for port 3202 and denies
+        any other route. If silent, it doesn't answer any request."""
+        if self.silent:
+            await reader.read()
+            writer.close()
+            return
+        (length, ) = unpack("!I", await reader.readexactly(4))
+        request = SAPRouter(await reader.readexactly(length))
+        if router_is_route(request):
+            port = request.route_string[1].port
+            self.requests.append(port)
+            if port == b"3200":
+                response = SAPRouter(type=SAPRouter.SAPROUTER_PONG)
+            elif port == b"3201":
+                writer.close()
+                return
+            elif port == b"3202":
+                await asyncio.sleep(1)
+                response = SAPRouter(type=SAPRouter.SAPROUTER_PONG)
+            else:
+                response = SAPRouter(type=SAPRouter.SAPROUTER_ERROR,
+                                     return_code=-94, err_text_length=0)
+        else:
+            response = SAPRouter(type=SAPRouter.SAPROUTER_CONTROL, version=39,
+                                 opcode=1, err_text_length=0)
+        response = bytes(response)
+        writer.write(pack("!I", len(response)) + response)
+        await writer.drain()
+        writer.close()
+
+    async def run_scan(self, scanner, targets):
+        self.requests = []
+        server = await asyncio.start_server(self.handle_router, self.test_address, 0)
+        router = server.sockets[0].getsockname()[:2]
+        try:
+            return [result async for result in scanner.scan(targets, router=router)]
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def test_saprouter_scanner(self):
+        """Test SAPRouterScanner concurrent route probes"""
+        scanner = SAPRouterScanner(concurrency=4, timeout=0.2, retries=1, retry_delay=0)
+        targets = [("10.0.0.1", port) for port in range(3200, 3206)]
+        results = asyncio.run(self.run_scan(scanner, targets))
+
+        status = {result.port: result.status for result in results}
+        self.assertEqual(status, {3200: "open", 3201: "error", 3202: "error",
+                                  3203: "denied", 3204: "denied", 3205: "denied"})
+        # Transient errors were retried
+        self.assertEqual(self.requests.count(b"3201"), 2)
+        self.assertEqual(self.requests.count(b"3202"), 2)
+
+    def test_saprouter_scanner_version_timeout(self):
+        """Test SAPRouterScanner probes sharing a router version request that times out"""
+        self.silent = True
+        scanner = SAPRouterScanner(concurrency=4, timeout=0.3, retries=1, retry_delay=0)
+        targets = [("10.0.0.1", port) for port in range(3200, 3208)]
+        results = asyncio.run(self.run_scan(scanner, targets))
+
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result.status == "error" for result in results))
+        self.assertFalse(scanner._versions)
+
+    def test_saprouter_scanner_rate(self):
+        """Test SAPRouterScanner rate limit"""
+        scanner = SAPRouterScanner(concurrency=8, rate=50, router_version=40)
+        targets = [("10.0.0.1", 3200)] * 10
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            results = await self.run_scan(scanner, targets)
+            return results, loop.time() - start
+
+        results, elapsed = asyncio.run(run())
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(result.status == "open" for result in results))
+        self.assertGreaterEqual(elapsed, 0.18)
+
+
+class PySAPRouterCapabilityCacheTest(unittest.TestCase):
+
+    def tearDown(self):
+        router_capabilities.invalidate()
+
+    def test_saprouter_capability_cache(self):
+        """Test SAPRouterCapabilityCache entries"""
+        cache = SAPRouterCapabilityCache(ttl=60)
+        self.assertIsNone(cache.get("127.0.0.1", 3299))
+
+        cache.update("127.0.0.1", 3299, version=40)
+        cache.update(b"127.0.0.1", "3299", talk_mode=ROUTER_TALK_MODE_NI_RAW_IO)
+        entry = cache.get("127.0.0.1", b"3299")
+        self.assertEqual(entry.version, 40)
+        self.assertEqual(entry.talk_modes, {ROUTER_TALK_MODE_NI_RAW_IO})
+        self.assertIsNone(cache.get_version("127.0.0.1", 3298))
+
+        cache.invalidate("127.0.0.1", 3299)
+        self.assertIsNone(cache.get_version("127.0.0.1", 3299))
+
+        cache.update("127.0.0.1", 3299, version=40)
+        cache.update("127.0.0.2", 3299, version=39)
+        cache.invalidate()
+        self.assertIsNone(cache.get("127.0.0.2", 3299))
+
+        cache.ttl = 0
+        cache.update("127.0.0.1", 3299, version=40)
+        self.assertIsNone(cache.get("127.0.0.1", 3299))
+
+    def test_saproutedstreamsocket_cached_version(self):
+        """Test SAPRoutedStreamSocket using the cached router version"""
+        router_capabilities.update("127.0.0.1", 3299, version=39)
+        peer, sock = socket.socketpair()
+        route = [SAPRouterRouteHop(hostname="127.0.0.1", port="3299"),
+                 SAPRouterRouteHop(hostname="10.0.0.1", port="3200")]
+
+        def router():
+            # The first request received is the route request
+            (length, ) = unpack("!I", peer.recv(4))
+            request = SAPRouter(peer.recv(length))
+            self.assertTrue(router_is_route(request))
+            self.assertEqual(request.route_ni_version, 39)
+            response = bytes(SAPRouter(type=SAPRouter.SAPROUTER_PONG))
+            peer.sendall(pack("!I", len(response)) + response)
+
+        router_thread = Thread(target=router)
+        router_thread.start()
+        client = SAPRoutedStreamSocket(sock, route, ROUTER_TALK_MODE_NI_RAW_IO)
+        router_thread.join(1)
+
+        self.assertTrue(client.routed)
+        self.assertEqual(client.router_version, 39)
+        self.assertIn(ROUTER_TALK_MODE_NI_RAW_IO,
+                      router_capabilities.get("127.0.0.1", 3299).talk_modes)
+        client.close()
+        peer.close()
+
+    def test_saproutedstreamsocket_cached_version_error(self):
+        """Test SAPRoutedStreamSocket invalidating the cached router version
+        only on version errors"""
+        route = [SAPRouterRouteHop(hostname="127.0.0.1", port="3299"),
+                 SAPRouterRouteHop(hostname="10.0.0.1", port="3200")]
+
+        def route_error(return_code):
+            router_capabilities.update("127.0.0.1", 3299, version=39)
+            peer, sock = socket.socketpair()
+            error_text = SAPRouterError(error="error", return_code=str(return_code))
+            response = bytes(SAPRouter(type=SAPRouter.SAPROUTER_ERROR, version=2, opcode=0,
+                                       return_code=return_code, err_text_length=len(error_text),
+                                       err_text_value=error_text))
+            peer.sendall(pack("!I", len(response)) + response)
+            try:
+                SAPRoutedStreamSocket(sock, route, ROUTER_TALK_MODE_NI_RAW_IO)
+            except Exception as e:
+                return e
+            finally:
+                sock.close()
+                peer.close()
+
+        # Denied routes and other errors keep the cached version
+        self.assertIsInstance(route_error(-94), SAPRouteException)
+        self.assertEqual(router_capabilities.get_version("127.0.0.1", 3299), 39)
+        self.assertNotIsInstance(route_error(-92), SAPRouteVersionException)
+        self.assertEqual(router_capabilities.get_version("127.0.0.1", 3299), 39)
+
+        self.assertIsInstance(route_error(-96), SAPRouteVersionException)
+        self.assertIsNone(router_capabilities.get_version("127.0.0.1", 3299))
+
+
+class PySAPRouterRoutePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.peers = []
+        self.pool = SAPRouterRoutePool(self.route, 2, idle_timeout=60)
+
+    def tearDown(self):
+        self.pool.stop()
+        for peer in self.peers:
+            peer.close()
+
+    def route(self):
+        peer, sock = socket.socketpair()
+        self.peers.append(peer)
+        return SAPNIStreamSocket(sock)
+
+    def wait_filled(self, size):
+        for _ in range(100):
+            if len(self.pool) >= size:
+                return
+            select([], [], [], 0.01)
+        self.fail("Route pool not filled")
+
+    def test_route_pool(self):
+        """Test SAPRouterRoutePool warm routes"""
+        self.pool.start()
+        self.wait_filled(2)
+        self.assertEqual(len(self.peers), 2)
+
+        # Routes are refilled after being used
+        router = self.pool.get()
+        self.assertFalse(router.closed)
+        self.wait_filled(2)
+        self.assertEqual(len(self.peers), 3)
+
+    def test_route_pool_closed(self):
+        """Test SAPRouterRoutePool discarding routes closed by the router"""
+        banner, closed = self.route(), self.route()
+        self.peers[0].sendall(b"banner")
+        self.peers[1].close()
+        self.pool.put(banner)
+        self.pool.put(closed)
+
+        # Data sent by the target is kept for the client
+        self.assertIs(self.pool.get(), banner)
+        self.assertTrue(closed.closed)
+        self.assertEqual(banner.ins.recv(6), b"banner")
+        self.assertIsNone(self.pool.get())
+
+    def test_route_pool_idle_timeout(self):
+        """Test SAPRouterRoutePool discarding idle routes"""
+        router = self.route()
+        self.pool.idle_timeout = 0
+        self.pool.put(router)
+        self.assertIsNone(self.pool.get())
+        self.assertTrue(router.closed)
+
+
+class PySAPRouterFingerprintDBTest(unittest.TestCase):
+
+    fingerprints_file = path.join(path.dirname(__file__), "..", "examples", "router_fingerprints.json")
+
+    def setUp(self):
+        self.tempdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def match_linear(self, fingerprints, target, error_text):
+        """Reference matching comparing every entry and field"""
+        matches = []
+        for finger in fingerprints.get(target, []):
+            if all(getattr(error_text, key).decode() == value
+                   for key, value in finger.items() if key in router_fingerprint_fields):
+                matches.append(finger)
+        return matches
+
+    def test_fingerprint_db_match(self):
+        """Test matching error texts against the indexed fingerprint database"""
+        with open(self.fingerprints_file) as fd:
+            fingerprints = json.load(fd)
+        db = SAPRouterFingerprintDB(fingerprints)
+
+        for target, entries in fingerprints.items():
+            for entry in entries:
+                error_text = SAPRouterError(SAPRouterError(**{field: entry[field]
+                                                              for field in router_fingerprint_fields}).build())
+                matches = db.match(target, error_text)
+                self.assertIn(entry, matches)
+                self.assertCountEqual(matches, self.match_linear(fingerprints, target, error_text))
+
+        self.assertListEqual(db.match("Unknown target", SAPRouterError()), [])
+        self.assertListEqual(db.match("Timeout", SAPRouterError(error="unknown error")), [])
+
+    def test_fingerprint_db_partial_entries(self):
+        """Test matching of fingerprint entries lacking some fields"""
+        db = SAPRouterFingerprintDB()
+        self.assertTrue(db.add("target", {"error": "some error", "line": "10", "comment": "1"}))
+        self.assertTrue(db.add("target", {"error": "some error", "comment": "2"}))
+        self.assertFalse(db.add("target", {"error": "some error", "comment": "2"}))
+
+        comments = [entry["comment"] for entry in db.match("target", SAPRouterError(error="some error", line="10"))]
+        self.assertCountEqual(comments, ["1", "2"])
+        comments = [entry["comment"] for entry in db.match("target", SAPRouterError(error="some error", line="20"))]
+        self.assertListEqual(comments, ["2"])
+
+        # Fields not present in the error text match any value
+        comments = [entry["comment"] for entry in db.match("target", {"error": " some error "})]
+        self.assertCountEqual(comments, ["1", "2"])
+
+    def test_fingerprint_db_json(self):
+        """Test loading the fingerprint database from a json file"""
+        fingerprints_file = path.join(self.tempdir, "fingerprints.json")
+        db = SAPRouterFingerprintDB({"target": [{"error": "some error", "version": "1"}],
+                                     "other target": [{"error": "other error", "version": "2"}]})
+        db.save(fingerprints_file)
+
+        db = SAPRouterFingerprintDB.from_json(fingerprints_file)
+        self.assertEqual(len(db.match("target", {"error": "some error"})), 1)
+        self.assertEqual(len(db.match("other target", {"error": "other error"})), 1)
+
+        db = SAPRouterFingerprintDB.from_json(fingerprints_file, targets=["target"])
+        self.assertEqual(len(db.match("target", {"error": "some error"})), 1)
+        self.assertListEqual(db.match("other target", {"error": "other error"}), [])
+
+
+class PySAPRouterRouteTableTest(unittest.TestCase):
+
+    def test_saprouter_route_table(self):
+        """Test SAPRouterRouteTable parsing and checks"""
+        table = SAPRouterRouteTable.from_string("""
+            # Comments and empty lines are skipped
+            D 10.0.0.5 * *
+            P * 10.0.0.* 3200-3299
+            S * sapserver *
+            P 192.168.* 10.0.1.1 sapdp00 secret
+        """)
+        self.assertEqual(len(table.entries), 4)
+
+        self.assertTrue(table.check("192.168.1.1", "10.0.0.1", 3200))
+        self.assertTrue(table.check("192.168.1.1", "10.0.0.1", "3299"))
+        self.assertFalse(table.check("192.168.1.1", "10.0.0.1", 3300))
+        self.assertFalse(table.check("10.0.0.5", "10.0.0.1", 3200))
+        self.assertFalse(table.check("192.168.1.1", "10.0.2.1", 3200))
+
+        # SAP protocol only entries
+        self.assertTrue(table.check("192.168.1.1", "SAPSERVER", 3200))
+        self.assertFalse(table.check("192.168.1.1", "sapserver", 3200,
+                                     talk_mode=ROUTER_TALK_MODE_NI_RAW_IO))
+
+        # Passwords
+        self.assertTrue(table.check("192.168.1.1", "10.0.1.1", "sapdp00", "secret"))
+        self.assertFalse(table.check("192.168.1.1", "10.0.1.1", "sapdp00", "wrong"))
+        self.assertFalse(table.check("172.16.1.1", "10.0.1.1", "sapdp00", "secret"))
+
+        # Services with wildcards
+        table = SAPRouterRouteTable.from_string("""
+            P * 10.0.0.1 32*
+            P * 10.0.0.1 sapdp??
+        """)
+        self.assertTrue(table.check("192.168.1.1", "10.0.0.1", 3200))
+        self.assertTrue(table.check("192.168.1.1", "10.0.0.1", "32"))
+        self.assertTrue(table.check("192.168.1.1", "10.0.0.1", "sapdp01"))
+        self.assertFalse(table.check("192.168.1.1", "10.0.0.1", 3300))
+        self.assertFalse(table.check("192.168.1.1", "10.0.0.1", "sapdp001"))
+        self.assertTrue(next(table.evaluate(["/H/10.0.0.1/S/3299"])).permitted)
+
+        with self.assertRaises(ValueError):
+            SAPRouterRouteTable.from_string("X * * *")
+        with self.assertRaises(ValueError):
+            SAPRouterRouteTable.from_string("P *")
+
+    def test_saprouter_route_table_hosts(self):
+        """Test SAPRouterRouteTable host patterns and SNC entries"""
+        self.assertEqual(router_host_intervals("10.0.0.0/30"), [(0x0a000000, 0x0a000003)])
+        self.assertEqual(router_host_intervals("10.0.0.1-10.0.0.9"), [(0x0a000001, 0x0a000009)])
+        self.assertEqual(router_host_intervals("10.0.*.*"), [(0x0a000000, 0x0a00ffff)])
+        self.assertEqual(router_host_intervals("10.1-2.0.*"), [(0x0a010000, 0x0a0100ff),
+                                                                (0x0a020000, 0x0a0200ff)])
+        self.assertIsNone(router_host_intervals("host.example.com"))
+        self.assertIsNone(router_host_intervals("10.0.0.256"))
+
+        table = SAPRouterRouteTable.from_string("""
+            D * 10.0.0.8/29 *
+            P * 10.0.0.0/24 3200
+            P 192.168.1.1-192.168.1.9 10.0.1.1-20 3200
+            KP "p:CN=client, O=Example" 10.0.2.* *
+            KT "p:CN=router, O=Example" * 10.0.3.1 3299
+            P * *.example.com 3200-3299
+        """)
+        self.assertEqual(table.entries[3].snc_name, "p:CN=client, O=Example")
+        self.assertTrue(table.check("172.16.0.1", "10.0.0.1", 3200))
+        self.assertFalse(table.check("172.16.0.1", "10.0.0.9", 3200))
+        self.assertTrue(table.check("192.168.1.5", "10.0.1.20", 3200))
+        self.assertFalse(table.check("192.168.1.10", "10.0.1.20", 3200))
+        self.assertFalse(table.check("192.168.1.5", "10.0.1.21", 3200))
+        self.assertFalse(table.check("172.16.0.1", "10.0.2.1", 3200))
+        self.assertTrue(table.check("172.16.0.1", "10.0.2.1", 3200, snc_name="p:CN=client, O=Example"))
+        self.assertEqual(table.lookup("172.16.0.1", "10.0.3.1", 3299).action, "KT")
+        self.assertTrue(table.check("172.16.0.1", "SAP.Example.com", 3210))
+        self.assertFalse(table.check("172.16.0.1", "example.com", 3210))
+
+        with self.assertRaises(ValueError):
+            SAPRouterRouteTable.from_string("KP 10.0.0.1 3200")
+
+    def test_saprouter_route_table_evaluate(self):
+        """Test SAPRouterRouteTable bulk evaluation"""
+        table = SAPRouterRouteTable.from_string("""
+            D 10.0.0.5 * *
+            P * 10.0.0.* 3200-3201
+            P * 10.0.1.1 3299 secret
+        """)
+        targets = [("10.0.0.0/30", 3200), ("10.0.0.1-2", 3202), ("10.0.1.1", 3299),
+                   "/H/10.0.1.1/S/3299/W/secret", "/H/host/S/3200"]
+        results = [(result.host, result.port, result.permitted) for result in table.evaluate(targets)]
+        self.assertListEqual(results, [("10.0.0.0", 3200, True), ("10.0.0.1", 3200, True),
+                                       ("10.0.0.2", 3200, True), ("10.0.0.3", 3200, True),
+                                       ("10.0.0.1", 3202, False), ("10.0.0.2", 3202, False),
+                                       ("10.0.1.1", 3299, False), ("10.0.1.1", 3299, True),
+                                       ("host", 3200, False)])
+
+        # Entries for specific source hosts only apply when a source is given
+        self.assertFalse(next(table.evaluate([("10.0.0.1", 3200)], source="10.0.0.5")).permitted)
+        self.assertTrue(next(table.evaluate([("10.0.1.1", 3299)], password="secret")).permitted)
+
+        # The index is rebuilt when adding entries
+        table.add("P", "*", "host", "3200")
+        self.assertTrue(next(table.evaluate(["/H/host/S/3200"])).permitted)
+
+
+class PySAPRouterServerTest(unittest.TestCase):
+
+    test_address = "127.0.0.1"
+
+    def start_server(self, server):
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        # Cleanups run in reverse order, so routers and client sockets are closed before the servers behind them
+        self.addCleanup(thread.join, 1)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1]
+
+    def setUp(self):
+        self.echo_port = self.start_server(SAPNIServerThreaded((self.test_address, 0),
+                                                               SAPNIEchoTestHandler))
+        table = SAPRouterRouteTable.from_string("P * %s %d" % (self.test_address, self.echo_port))
+        self.router_port = self.start_server(SAPRouterServer((self.test_address, 0),
+                                                             route_table=table,
+                                                             router_version=39))
+        self.route = "/H/%s/S/%d" % (self.test_address, self.router_port)
+
+    def test_saprouter_server_route(self):
+        """Test SAPRouterServer routes in NI and raw talk modes"""
+        conn = SAPRoutedStreamSocket.get_nisocket(self.test_address, self.echo_port, self.route)
+        self.assertEqual(conn.router_version, 39)
+        self.assertEqual(conn.sr(Raw(b"NI data")).payload.load, b"NI data")
+        conn.close()
+
+        conn = SAPRoutedStreamSocket.get_nisocket(self.test_address, self.echo_port, self.route,
+                                                  talk_mode=ROUTER_TALK_MODE_NI_RAW_IO,
+                                                  base_cls=Raw)
+        data = pack("!I", 8) + b"raw data"
+        conn.send(Raw(data))
+        self.assertEqual(conn.recv().load, data)
+        conn.close()
+
+    def test_saprouter_server_route_chain(self):
+        """Test SAPRouterServer routes through several routers"""
+        router_port = self.start_server(SAPRouterServer((self.test_address, 0)))
+        route = "/H/%s/S/%d%s" % (self.test_address, router_port, self.route)
+        conn = SAPRoutedStreamSocket.get_nisocket(self.test_address, self.echo_port, route)
+        self.assertEqual(conn.sr(Raw(b"chained")).payload.load, b"chained")
+        conn.close()
+
+    def test_saprouter_server_errors(self):
+        """Test SAPRouterServer error responses"""
+        # Not permitted by the route table
+        with self.assertRaises(SAPRouteException):
+            SAPRoutedStreamSocket.get_nisocket(self.test_address, self.echo_port + 1, self.route)
+
+        conn = SAPNIStreamSocket.get_nisocket(self.test_address, self.router_port)
+        request = build_route_request(SAPRouterRouteHop.from_string(self.route + "/H/127.0.0.1/S/1"),
+                                      ROUTER_TALK_MODE_NI_MSG_IO, 39)
+        response = conn.sr(request)
+        response.decode_payload_as(SAPRouter)
+        self.assertEqual(response.return_code, -94)
+        self.assertEqual(response.err_text_value.error, b"route permission denied")
+        self.assertEqual(response.err_text_value.return_code, b"-94")
+        conn.close()
+
+        # Connection refused by the target
+        router_port = self.start_server(SAPRouterServer((self.test_address, 0)))
+        conn = SAPNIStreamSocket.get_nisocket(self.test_address, router_port)
+        request = build_route_request(SAPRouterRouteHop.from_string("/H/127.0.0.1/S/%d/H/127.0.0.1/S/1" % router_port))
+        response = conn.sr(request)
+        response.decode_payload_as(SAPRouter)
+        self.assertEqual(response.return_code, -92)
+        conn.close()
+
+    def test_saprouter_server_shutdown(self):
+        """Test SAPRouterServer closes the established routes on shutdown"""
+        router = SAPRouterServer((self.test_address, 0))
+        router_port = self.start_server(router)
+        route = "/H/%s/S/%d" % (self.test_address, router_port)
+        conn = SAPRoutedStreamSocket.get_nisocket(self.test_address, self.echo_port, route)
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.sr(Raw(b"data")).payload.load, b"data")
+
+        router.shutdown()
+        conn.ins.settimeout(5)
+        self.assertEqual(conn.ins.recv(1), b"")
+
+    def test_saprouter_server_info(self):
+        """Test SAPRouterServer information requests"""
+        routed = SAPRoutedStreamSocket.get_nisocket(self.test_address, self.echo_port, self.route)
+        self.addCleanup(routed.close)
+
+        conn = SAPNIStreamSocket.get_nisocket(self.test_address, self.router_port)
+        self.addCleanup(conn.close)
+        conn.send(SAPRouter(type=SAPRouter.SAPROUTER_ADMIN, adm_command=2))
+        clients = list(router_info_clients(bytes(conn.recv().payload)))
+        self.assertEqual(len(clients), 2)
+        self.assertEqual([(client.routed, client.partner, client.service) for client in clients
+                          if client.routed], [(True, self.test_address, str(self.echo_port))])
+
+        response = conn.recv()
+        response.decode_payload_as(SAPRouterInfoServer)
+        self.assertEqual(response.port, self.router_port)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=1)